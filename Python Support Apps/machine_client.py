@@ -2,11 +2,43 @@ import requests
 import time
 import random
 import json
+import argparse
+import gzip
+import hashlib
+import hmac
+import os
+import sqlite3
+import struct
 
 # CONFIGURATION
 SERVER_URL = "http://127.0.0.1:8000/api/ingest/"
+BATCH_URL = "http://127.0.0.1:8000/api/ingest/batch/"
 MACHINE_ID = "i6" # Change to 'i3' or 'test' as needed
 
+# Per-machine API key (admin: Machine api keys). Required unless the server
+# runs with TELEMETRY_REQUIRE_API_KEY=0; left empty, requests go unsigned.
+API_KEY_ID = os.getenv("MPE_API_KEY_ID", "")
+API_KEY_SECRET = os.getenv("MPE_API_KEY_SECRET", "")
+
+# Production mode settings
+SPOOL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "telemetry_spool.db")
+SPOOL_MAX_ROWS = 7 * 24 * 3600  # ~1 week of 1 Hz samples; oldest are dropped beyond this
+SAMPLE_INTERVAL = 1.0           # Seconds between sensor reads
+SEND_INTERVAL = 5.0             # Seconds between uploads while the server is reachable
+BATCH_SIZE = 500                # Samples per upload (server accepts up to 5000)
+MAX_BATCHES_PER_FLUSH = 10      # Cap catch-up work per cycle so sampling keeps its rhythm
+BACKOFF_BASE = 2.0              # First retry delay after a failure (seconds)
+BACKOFF_MAX = 300.0             # Longest retry delay (seconds)
+MAX_SERVER_ERRORS = 5           # 500s in a row for the same batch before it is set aside
+TIMEOUT = (5, 15)               # (connect, read) seconds
+
+# Compact columnar upload format - must match core/telemetry.py on the server.
+COLUMNAR_CONTENT_TYPE = "application/vnd.mpe.telemetry"
+COLUMNAR_HEADER = struct.Struct("<4sBBHId")
+STATUS_CODES = ("RUNNING", "STOPPED", "IDLE", "FAULT", "SETUP", "OFFLINE")
+# Overload or proxy errors: the batch is fine, keep retrying it however long it takes.
+TRANSIENT_SERVER_ERRORS = (502, 503, 504)
+
 def generate_sensor_data():
     """
     Simulates reading values from a PLC or Sensor.
@@ -15,16 +47,16 @@ def generate_sensor_data():
     # Simulate a running machine with slight fluctuations
     target_ppm = 30.0
     target_temp = 175.0
-    
+
     current_ppm = round(target_ppm + random.uniform(-1.5, 1.5), 1)
     current_temp = round(target_temp + random.uniform(-0.5, 0.5), 1)
-    
+
     # Determine status based on random chance
     status = "RUNNING"
     if random.random() > 0.95:
         status = "STOPPED"
         current_ppm = 0
-        
+
     return {
         "machine_id": MACHINE_ID,
         "ppm": current_ppm,
@@ -33,28 +65,264 @@ def generate_sensor_data():
         "status": status
     }
 
+
+def encode_columnar(machine_id, samples):
+    """
+    Reference encoder for the compact columnar body (version 2): header,
+    machine id and first sequence number once, then parallel arrays of
+    timestamp offsets, ppm, temp, batch count, status code and sequence
+    offsets. Each sample needs a "ts" (epoch seconds) and a "seq", in
+    ascending seq order. Raises struct.error if a value does not fit its
+    column, e.g. samples more than ~24 days apart (int32 milliseconds).
+    """
+    machine = machine_id.encode("utf-8")
+    count = len(samples)
+    base_ts = samples[0]["ts"] if samples else time.time()
+    base_seq = samples[0]["seq"] if samples else 0
+    return b"".join([
+        COLUMNAR_HEADER.pack(b"MPT1", 2, len(machine), 0, count, base_ts),
+        machine,
+        struct.pack("<Q", base_seq),
+        struct.pack(f"<{count}i", *(round((s["ts"] - base_ts) * 1000) for s in samples)),
+        struct.pack(f"<{count}f", *(s["ppm"] for s in samples)),
+        struct.pack(f"<{count}f", *(s["temp"] for s in samples)),
+        struct.pack(f"<{count}i", *(s["batch_count"] for s in samples)),
+        bytes(STATUS_CODES.index(s["status"]) for s in samples),
+        struct.pack(f"<{count}I", *(s["seq"] - base_seq for s in samples)),
+    ])
+
+
+def sign_headers(body):
+    """X-MPE-* headers signing the exact request body - must match core/ingest_auth.py."""
+    if not API_KEY_ID:
+        return {}
+    timestamp = str(int(time.time()))
+    signature = hmac.new(API_KEY_SECRET.encode("utf-8"), timestamp.encode("ascii") + b"\n" + body, hashlib.sha256)
+    return {"X-MPE-Key": API_KEY_ID, "X-MPE-Timestamp": timestamp, "X-MPE-Signature": signature.hexdigest()}
+
+
+class Spool:
+    """
+    On-disk FIFO of samples waiting to be uploaded (SQLite, survives restarts
+    and power cuts). Samples are only removed once the server has answered.
+    The row id doubles as the sample's sequence number ("seq"): it only ever
+    increases (AUTOINCREMENT), so a batch resent after a lost response is
+    recognised by the server as duplicates.
+    """
+
+    def __init__(self, path=SPOOL_PATH, max_rows=SPOOL_MAX_ROWS):
+        self.max_rows = max_rows
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS samples (id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL)")
+        # Batches the server kept failing on, kept for inspection instead of blocking the spool.
+        self.db.execute("CREATE TABLE IF NOT EXISTS set_aside (id INTEGER PRIMARY KEY, payload TEXT NOT NULL)")
+        self.db.commit()
+
+    def append(self, sample):
+        with self.db:
+            self.db.execute("INSERT INTO samples (payload) VALUES (?)", (json.dumps(sample),))
+            # Bounded disk use during a very long outage: drop the oldest samples.
+            self.db.execute(
+                "DELETE FROM samples WHERE id <= (SELECT MAX(id) FROM samples) - ?", (self.max_rows,)
+            )
+
+    def peek(self, limit):
+        """Oldest `limit` samples as a list of (id, payload_json)."""
+        return self.db.execute("SELECT id, payload FROM samples ORDER BY id LIMIT ?", (limit,)).fetchall()
+
+    def remove_through(self, last_id):
+        with self.db:
+            self.db.execute("DELETE FROM samples WHERE id <= ?", (last_id,))
+
+    def set_aside(self, last_id):
+        """Move samples up to `last_id` out of the upload queue into the set_aside table."""
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO set_aside SELECT id, payload FROM samples WHERE id <= ?", (last_id,)
+            )
+            self.db.execute("DELETE FROM samples WHERE id <= ?", (last_id,))
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+
+
+class Uploader:
+    """
+    Sends spooled samples in batches over one keep-alive session: the
+    compact columnar format, gzip-compressed, by default. If the server
+    answers 415 (it cannot decode the encoding) the uploader falls back to
+    plain NDJSON. A batch that cannot be encoded, or that the server keeps
+    answering 500 to, is set aside in the spool so later samples still go out.
+    """
+
+    def __init__(self, spool, url=BATCH_URL, compact=True):
+        self.spool = spool
+        self.url = url
+        self.compact = compact
+        self.session = requests.Session()
+        self.failures = 0
+        self.server_errors = (None, 0)  # (first row id of the batch, 500s in a row)
+
+    def encode(self, rows):
+        """(headers, body) for a list of spooled (id, payload_json) rows."""
+        samples = [json.loads(payload) for _, payload in rows]
+        for sample, (row_id, _) in zip(samples, rows):
+            # The server only accepts seq alongside ts (it dedups on both).
+            if "ts" in sample:
+                sample["seq"] = row_id
+        ndjson = "\n".join(json.dumps(s) for s in samples).encode("utf-8")
+        if self.compact:
+            body = None
+            if all(s.get("machine_id") == MACHINE_ID and s.get("status") in STATUS_CODES and "ts" in s for s in samples):
+                try:
+                    body = encode_columnar(MACHINE_ID, samples)
+                    headers = {"Content-Type": COLUMNAR_CONTENT_TYPE}
+                except (struct.error, TypeError):
+                    # e.g. a batch spanning a long outage: offsets overflow their columns
+                    pass
+            if body is None:
+                # e.g. samples spooled by an older client version without "ts"
+                body = ndjson
+                headers = {"Content-Type": "application/x-ndjson"}
+            headers["Content-Encoding"] = "gzip"
+            return headers, gzip.compress(body)
+        return {"Content-Type": "application/x-ndjson"}, ndjson
+
+    def backoff(self):
+        """Delay before the next attempt: exponential with jitter, capped at BACKOFF_MAX."""
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** (self.failures - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def send_batch(self, rows):
+        """
+        Upload one batch. Returns True if the server took responsibility for it
+        (stored, or rejected as invalid - resending would not help), False if it
+        should be retried later.
+        """
+        try:
+            headers, body = self.encode(rows)
+        except Exception as e:
+            # Retrying would fail the same way; don't let it block (or crash) the spool.
+            print(f"[ERROR] Cannot encode samples {rows[0][0]}-{rows[-1][0]} ({e!r}); setting them aside")
+            self.spool.set_aside(rows[-1][0])
+            return True
+        headers.update(sign_headers(body))
+        try:
+            response = self.session.post(self.url, data=body, headers=headers, timeout=TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            print(f"[OFFLINE] {type(e).__name__}; {len(self.spool)} samples spooled")
+            return False
+
+        if response.status_code == 200:
+            result = response.json()
+            if result.get("rejected"):
+                print(f"[WARN] Server rejected {result['rejected']} of {len(rows)} samples")
+            print(f"[OK] Uploaded {result.get('accepted', 0)} samples ({len(body)} bytes)")
+            return True
+        if response.status_code == 415 and self.compact:
+            print("[WARN] Server cannot decode compressed uploads; switching to plain NDJSON")
+            self.compact = False
+            return self.send_batch(rows)
+        if response.status_code in (401, 403):
+            # Resending will not help until the key is fixed, but the samples are kept.
+            print(f"[ERROR] Server refused the API key: {response.text[:200]}")
+            return False
+        if response.status_code == 400:
+            # Nothing in the batch was valid; keeping it would block the spool forever.
+            print(f"[ERROR] Server rejected batch: {response.text[:200]}")
+            return True
+        if response.status_code >= 500 and response.status_code not in TRANSIENT_SERVER_ERRORS:
+            first_id, errors = self.server_errors
+            errors = errors + 1 if first_id == rows[0][0] else 1
+            self.server_errors = (rows[0][0], errors)
+            if errors >= MAX_SERVER_ERRORS:
+                print(f"[ERROR] Server returned {response.status_code} {errors} times; setting the batch aside")
+                self.spool.set_aside(rows[-1][0])
+                return True
+
+        print(f"[ERROR] Server returned {response.status_code}; will retry")
+        return False
+
+    def flush(self):
+        """Upload spooled samples oldest first. Returns False if the server could not be reached."""
+        for _ in range(MAX_BATCHES_PER_FLUSH):
+            rows = self.spool.peek(BATCH_SIZE)
+            if not rows:
+                break
+            if not self.send_batch(rows):
+                self.failures += 1
+                return False
+            self.spool.remove_through(rows[-1][0])
+            self.failures = 0
+        return True
+
+
+def run_production():
+    """
+    Store-and-forward loop: every reading goes to the local spool first, and
+    the spool is uploaded in batches. While the server is unreachable the
+    spool keeps growing and uploads back off exponentially; once it is back,
+    the backlog is replayed in order.
+    """
+    spool = Spool()
+    uploader = Uploader(spool)
+    print(f"--- Starting Telemetry Client for {MACHINE_ID} (production mode) ---")
+    print(f"Target: {BATCH_URL}")
+    print(f"Spool: {SPOOL_PATH} ({len(spool)} samples pending)")
+
+    next_sample = time.monotonic()
+    next_send = next_sample + SEND_INTERVAL
+    while True:
+        now = time.monotonic()
+        if now >= next_sample:
+            sample = generate_sensor_data()
+            sample["ts"] = time.time()
+            spool.append(sample)
+            next_sample += SAMPLE_INTERVAL
+            if next_sample < now:  # fell behind (e.g. a slow upload); don't burst to catch up
+                next_sample = now + SAMPLE_INTERVAL
+
+        if now >= next_send:
+            ok = uploader.flush()
+            next_send = time.monotonic() + (SEND_INTERVAL if ok else uploader.backoff())
+
+        time.sleep(max(0.0, min(next_sample, next_send) - time.monotonic()))
+
+
 def main():
     print(f"--- Starting Telemetry Client for {MACHINE_ID} ---")
     print(f"Target: {SERVER_URL}")
-    
+
     while True:
         # 1. Read Sensors
         payload = generate_sensor_data()
-        
+
         # 2. Send to Django
         try:
-            response = requests.post(SERVER_URL, json=payload)
-            
+            body = json.dumps(payload).encode("utf-8")
+            headers = {"Content-Type": "application/json", **sign_headers(body)}
+            response = requests.post(SERVER_URL, data=body, headers=headers, timeout=TIMEOUT)
+
             if response.status_code == 200:
                 print(f"[OK] Sent: {payload['ppm']}ppm | {payload['temp']}C")
             else:
                 print(f"[ERROR] Server returned {response.status_code}: {response.text}")
-                
-        except requests.exceptions.ConnectionError:
+
+        except requests.exceptions.RequestException:
             print("[ERROR] Could not connect to server. Is Django running?")
-            
+
         # 3. Wait before next update
         time.sleep(1.0) # Send every 1 second
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="MPE machine telemetry client")
+    parser.add_argument("--production", action="store_true",
+                        help="Spool samples to disk and upload them in gzip batches (survives outages)")
+    args = parser.parse_args()
+
+    if args.production:
+        run_production()
+    else:
+        main()
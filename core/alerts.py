@@ -0,0 +1,212 @@
+"""
+Alert rules evaluated incrementally on telemetry ingest.
+
+Each machine keeps a few fields of in-memory state (when each failing
+condition started, the last batch count and when it changed, which alerts
+are open), so evaluating a sample is O(1) and needs no query. The database
+is only written when an alert is raised or cleared. Thresholds and open
+alerts are re-read at most every ALERT_REFRESH_SECONDS, which is also how
+several worker processes converge on the same set of open alerts; the
+partial unique constraint on Alert stops them opening duplicates.
+
+Only machines in ringbuffer.known_machine_ids() are evaluated (and keep
+state), so samples for arbitrary machine_ids cannot grow it.
+"""
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import ringbuffer
+from .models import Alert, MachineAlertSettings
+
+logger = logging.getLogger(__name__)
+
+ALERT_REFRESH_SECONDS = 30
+# A temperature reading must stay out of band this long before alerting,
+# so a single noisy sample does not open and close an alert.
+TEMP_HOLD_SECONDS = 10
+
+_DEFAULTS = MachineAlertSettings()
+
+
+class _MachineState:
+    __slots__ = ("since", "last_batch", "batch_changed_at", "open", "last_ts")
+
+    def __init__(self):
+        self.since = {}
+        self.last_batch = None
+        self.batch_changed_at = None
+        self.open = set()
+        self.last_ts = None
+
+
+_lock = threading.Lock()
+_states = {}
+_settings = {}
+_loaded_at = None
+
+
+def _refresh(known: frozenset, force: bool = False) -> None:
+    global _loaded_at
+    if not force and _loaded_at is not None and time.monotonic() - _loaded_at < ALERT_REFRESH_SECONDS:
+        return
+
+    _settings.clear()
+    _settings.update({s.machine_id: s for s in MachineAlertSettings.objects.all()})
+
+    open_kinds = {}
+    for machine_id, kind in Alert.objects.filter(cleared_at__isnull=True).values_list("machine_id", "kind"):
+        open_kinds.setdefault(machine_id, set()).add(kind)
+    for machine_id in _states.keys() - known - open_kinds.keys():
+        del _states[machine_id]
+    for machine_id in open_kinds.keys() - _states.keys():
+        _states[machine_id] = _MachineState()
+    for machine_id, state in _states.items():
+        state.open = open_kinds.get(machine_id, set())
+
+    _loaded_at = time.monotonic()
+
+
+def reset() -> None:
+    """Forget all in-memory state; the next evaluation reloads from the database."""
+    global _loaded_at
+    with _lock:
+        _states.clear()
+        _settings.clear()
+        _loaded_at = None
+
+
+def forget(machine_ids) -> None:
+    """Drop the in-memory state of `machine_ids` (their Alert rows are the caller's business)."""
+    with _lock:
+        for machine_id in machine_ids:
+            _states.pop(machine_id, None)
+
+
+def _message(kind: str, row, cfg) -> str:
+    if kind == Alert.KIND_TEMP:
+        band = f"{cfg.temp_min if cfg.temp_min is not None else '-'}-{cfg.temp_max if cfg.temp_max is not None else '-'}"
+        return f"Seal temperature {row.temp:.1f}°C outside {band}°C"
+    if kind == Alert.KIND_PPM_LOW:
+        return f"Packs/min {row.ppm:.1f} below target {cfg.ppm_target:g} for over {cfg.ppm_grace_seconds}s"
+    if kind == Alert.KIND_STOPPED:
+        return f"Stopped for over {cfg.stopped_seconds}s"
+    return f"Batch count stuck at {row.batch_count} for over {cfg.batch_stall_seconds}s while running"
+
+
+def _value(kind: str, row):
+    return {Alert.KIND_TEMP: row.temp, Alert.KIND_PPM_LOW: row.ppm, Alert.KIND_BATCH_STALLED: row.batch_count}.get(kind)
+
+
+class _Changes:
+    """Alert transitions collected while evaluating a batch, written in one go."""
+
+    def __init__(self):
+        self.raised = []
+        self.cleared = []
+        self._unsaved_open = {}
+
+    def raise_alert(self, row, kind, ts, cfg):
+        alert = Alert(
+            machine_id=row.machine_id,
+            kind=kind,
+            message=_message(kind, row, cfg)[:200],
+            value=_value(kind, row),
+            raised_at=ts,
+        )
+        self.raised.append(alert)
+        self._unsaved_open[(row.machine_id, kind)] = alert
+
+    def clear_alert(self, machine_id, kind, ts):
+        alert = self._unsaved_open.pop((machine_id, kind), None)
+        if alert is not None:
+            alert.cleared_at = ts
+        else:
+            self.cleared.append((machine_id, kind, ts))
+
+    def save(self):
+        if not (self.raised or self.cleared):
+            return
+        with transaction.atomic():
+            # Clear first: a new episode of the same rule can only open once the old one is closed.
+            for machine_id, kind, ts in self.cleared:
+                Alert.objects.filter(machine_id=machine_id, kind=kind, cleared_at__isnull=True).update(cleared_at=ts)
+            Alert.objects.bulk_create(self.raised, ignore_conflicts=True)
+
+
+def _update(changes, state, row, cfg, kind, failing, ts, hold_seconds):
+    if failing:
+        since = state.since.setdefault(kind, ts)
+        if kind not in state.open and (ts - since).total_seconds() >= hold_seconds:
+            state.open.add(kind)
+            changes.raise_alert(row, kind, ts, cfg)
+    else:
+        state.since.pop(kind, None)
+        if kind in state.open:
+            state.open.discard(kind)
+            changes.clear_alert(row.machine_id, kind, ts)
+
+
+def _check(changes, state, row, cfg):
+    ts = row.created_at or timezone.now()
+    if state.last_ts is not None and ts < state.last_ts:
+        return  # late (replayed) sample: the rules have already moved past it
+    state.last_ts = ts
+    running = row.status == "RUNNING"
+
+    temp_bad = (cfg.temp_min is not None and row.temp < cfg.temp_min) or (
+        cfg.temp_max is not None and row.temp > cfg.temp_max
+    )
+    _update(changes, state, row, cfg, Alert.KIND_TEMP, temp_bad, ts, TEMP_HOLD_SECONDS)
+
+    ppm_low = cfg.ppm_target is not None and running and row.ppm < cfg.ppm_target
+    _update(changes, state, row, cfg, Alert.KIND_PPM_LOW, ppm_low, ts, cfg.ppm_grace_seconds)
+
+    stopped = cfg.stopped_seconds is not None and row.status == "STOPPED"
+    _update(changes, state, row, cfg, Alert.KIND_STOPPED, stopped, ts, cfg.stopped_seconds or 0)
+
+    if row.batch_count != state.last_batch or state.batch_changed_at is None:
+        state.last_batch = row.batch_count
+        state.batch_changed_at = ts
+    stalled = (
+        cfg.batch_stall_seconds is not None
+        and running
+        and (ts - state.batch_changed_at).total_seconds() >= cfg.batch_stall_seconds
+    )
+    _update(changes, state, row, cfg, Alert.KIND_BATCH_STALLED, stalled, ts, 0)
+
+
+def evaluate(rows) -> None:
+    """
+    Run the alert rules over freshly ingested telemetry rows (in arrival
+    order). Never raises: a failure here must not fail ingest.
+    """
+    global _loaded_at
+    if not getattr(settings, "TELEMETRY_ALERTS_ENABLED", True) or not rows:
+        return
+    try:
+        known = ringbuffer.known_machine_ids()
+        with _lock:
+            _refresh(known)
+            changes = _Changes()
+            for row in rows:
+                if row.machine_id not in known:
+                    continue
+                cfg = _settings.get(row.machine_id, _DEFAULTS)
+                if not cfg.is_enabled:
+                    continue
+                state = _states.get(row.machine_id)
+                if state is None:
+                    state = _states[row.machine_id] = _MachineState()
+                _check(changes, state, row, cfg)
+        # Outside the lock: other ingest threads only need the in-memory state.
+        changes.save()
+    except Exception as e:
+        logger.exception("Alert evaluation failed: %s", e)
+        # In-memory state may now disagree with the database; reload it next time.
+        _loaded_at = None
@@ -0,0 +1,185 @@
+"""
+Batch anomaly detection over recent telemetry, run by the
+`detect_anomalies` management command; results go to TelemetryAnomaly.
+
+Each machine's samples over the analysed range are loaded with one
+values_list query and analysed as NumPy arrays. Rolling means and
+standard deviations come from cumulative sums, so the cost is O(samples)
+with no Python loop per sample. Two detectors run on ppm and temp:
+
+    zscore        samples more than `z` standard deviations from the mean of
+                  the `window` samples before them; consecutive flagged
+                  samples form one anomaly
+    change_point  points where the mean of the next `window` samples differs
+                  from the mean of the previous `window` by more than `shift`
+                  pooled standard deviations (a level shift, e.g. a heater
+                  settling at a new temperature)
+
+Windows are counted in samples (300 = 5 minutes at 1 Hz). ppm is only
+analysed while the machine is RUNNING: it drops to zero on every stop,
+which is not an anomaly. Hours already compacted into blocks are not
+analysed. Results replace earlier ones for the same machines and range,
+so re-running over a range is safe.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+from django.db import transaction
+
+from .blocks import get_compact_mark
+from .models import MachineTelemetry, TelemetryAnomaly
+
+METRICS = ("ppm", "temp")
+WINDOW = 300
+Z_THRESHOLD = 4.0
+SHIFT_THRESHOLD = 3.0
+# Standard deviations are floored so that a nearly flat series (ppm pinned
+# to its set point) does not turn every small wobble into an anomaly.
+MIN_STD = {"ppm": 0.5, "temp": 0.2}
+
+# start/end are sample indices, end exclusive.
+Finding = namedtuple("Finding", "kind start end score value baseline")
+
+
+def _window_stats(x: np.ndarray, window: int, min_std: float):
+    """Mean and (floored) std of every `window` consecutive samples; entry i covers x[i:i + window]."""
+    c1 = np.concatenate(([0.0], np.cumsum(x)))
+    c2 = np.concatenate(([0.0], np.cumsum(x * x)))
+    mean = (c1[window:] - c1[:-window]) / window
+    var = (c2[window:] - c2[:-window]) / window - mean * mean
+    return mean, np.maximum(np.sqrt(np.maximum(var, 0.0)), min_std)
+
+
+def _runs(mask: np.ndarray):
+    """(starts, ends) of the runs of True in `mask`, ends exclusive."""
+    edges = np.diff(mask.astype(np.int8), prepend=0, append=0)
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def zscore_anomalies(x: np.ndarray, window: int = WINDOW, z: float = Z_THRESHOLD, min_std: float = 0.0) -> list:
+    """Runs of samples whose z-score against the trailing window exceeds `z`."""
+    n = len(x)
+    if n <= window:
+        return []
+    mean, std = _window_stats(x, window, min_std)
+    # Sample i is scored against x[i - window:i], i.e. mean[i - window].
+    scores = np.zeros(n)
+    scores[window:] = np.abs(x[window:] - mean[:-1]) / std[:-1]
+    starts, ends = _runs(scores > z)
+    if not len(starts):
+        return []
+
+    # reduceat over [start, end) pairs; the odd segments are the gaps between runs.
+    bounds = np.column_stack((starts, ends)).ravel()
+    peaks = np.maximum.reduceat(np.append(scores, 0.0), bounds)[::2]
+    means = np.add.reduceat(np.append(x, 0.0), bounds)[::2] / (ends - starts)
+    baselines = mean[starts - window]
+    return [
+        Finding(TelemetryAnomaly.KIND_ZSCORE, int(s), int(e), float(p), float(v), float(b))
+        for s, e, p, v, b in zip(starts, ends, peaks, means, baselines)
+    ]
+
+
+def change_points(x: np.ndarray, window: int = WINDOW, shift: float = SHIFT_THRESHOLD, min_std: float = 0.0) -> list:
+    """Level shifts: the strongest split point of each run where the before/after means differ by more than `shift`."""
+    n = len(x)
+    if n < 2 * window:
+        return []
+    mean, std = _window_stats(x, window, min_std)
+    # Split point i (window <= i <= n - window) compares x[i - window:i] with x[i:i + window].
+    before, after = mean[:-window], mean[window:]
+    pooled = np.sqrt((std[:-window] ** 2 + std[window:] ** 2) / 2)
+    scores = np.zeros(n)
+    scores[window:n - window + 1] = np.abs(after - before) / pooled
+
+    found = []
+    for s, e in zip(*_runs(scores > shift)):
+        i = int(s + np.argmax(scores[s:e]))
+        found.append(
+            Finding(
+                TelemetryAnomaly.KIND_CHANGE_POINT,
+                i - window,
+                i + window,
+                float(scores[i]),
+                float(after[i - window]),
+                float(before[i - window]),
+            )
+        )
+    return found
+
+
+def analyse_machine(machine_id: str, start, end, window: int = WINDOW, z: float = Z_THRESHOLD,
+                    shift: float = SHIFT_THRESHOLD) -> list:
+    """Unsaved TelemetryAnomaly rows for one machine's raw telemetry in [start, end)."""
+    rows = list(
+        MachineTelemetry.objects.filter(machine_id=machine_id, created_at__gte=start, created_at__lt=end)
+        .order_by("created_at")
+        .values_list("created_at", "ppm", "temp", "status")
+    )
+    if not rows:
+        return []
+    # Timestamps stay Python datetimes; only the flagged ones are looked up.
+    created, ppm, temp, status = zip(*rows)
+    series = {"ppm": np.array(ppm, dtype=np.float64), "temp": np.array(temp, dtype=np.float64)}
+    running = np.flatnonzero(np.array(status, dtype=object) == "RUNNING")
+
+    out = []
+    for metric in METRICS:
+        index = running if metric == "ppm" else np.arange(len(rows))
+        x = series[metric][index]
+        if not len(x):
+            continue
+        # Centred, so the sums of squares keep their precision.
+        centre = float(x.mean())
+        x = x - centre
+        findings = zscore_anomalies(x, window, z, MIN_STD[metric]) + change_points(x, window, shift, MIN_STD[metric])
+        for f in findings:
+            out.append(
+                TelemetryAnomaly(
+                    machine_id=machine_id,
+                    metric=metric,
+                    kind=f.kind,
+                    window_start=created[index[f.start]],
+                    window_end=created[index[f.end - 1]],
+                    sample_count=f.end - f.start,
+                    score=round(f.score, 2),
+                    value=round(f.value + centre, 3),
+                    baseline=round(f.baseline + centre, 3),
+                )
+            )
+    return out
+
+
+def detect_anomalies(start, end, machine_ids=None, window: int = WINDOW, z: float = Z_THRESHOLD,
+                     shift: float = SHIFT_THRESHOLD, log=None) -> int:
+    """
+    Analyse every machine with telemetry in [start, end) (or just
+    `machine_ids`) and replace its stored anomalies in that range.
+    Returns the number of anomalies written.
+    """
+    compacted = get_compact_mark()
+    if compacted and start < compacted:
+        start = compacted
+    if start >= end:
+        return 0
+    if machine_ids is None:
+        machine_ids = list(
+            MachineTelemetry.objects.filter(created_at__gte=start, created_at__lt=end)
+            .order_by("machine_id")
+            .values_list("machine_id", flat=True)
+            .distinct()
+        )
+
+    written = 0
+    for machine_id in machine_ids:
+        found = analyse_machine(machine_id, start, end, window, z, shift)
+        with transaction.atomic():
+            TelemetryAnomaly.objects.filter(
+                machine_id=machine_id, window_start__gte=start, window_start__lt=end
+            ).delete()
+            TelemetryAnomaly.objects.bulk_create(found, batch_size=1000)
+        written += len(found)
+        if log and found:
+            log(f"{machine_id}: {len(found)} anomaly(ies)")
+    return written
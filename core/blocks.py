@@ -0,0 +1,404 @@
+"""
+Cold storage for old raw telemetry: one MachineTelemetryBlock per machine
+and hour instead of ~3600 MachineTelemetry rows of 100+ bytes each.
+
+A block stores its samples column by column, compressed the way Facebook's
+Gorilla paper does it:
+
+    timestamps   delta-of-delta in microseconds, as variable-length bit codes
+                 (a regular 1 Hz clock costs little more than a bit a sample)
+    ppm, temp    each float XORed with the previous one; only the meaningful
+                 bits of the XOR are stored, and nothing but a 0 bit when the
+                 value did not change
+    batch_count  delta-of-delta, like the timestamps
+    status       run-length encoded against a per-block table of strings
+
+Block layout (little-endian header, then one big-endian bit stream):
+
+    header       magic b"MTB1", sample count (u4), status runs (u4),
+                 distinct statuses (u1)
+    statuses     per distinct status: length (u1) + UTF-8
+    runs         run lengths (u4 each), then status table indices (u1 each)
+    bit stream   timestamps, ppm, temp, batch_count, padded to a byte
+
+seq is not kept: it only matters for deduplicating replays, and those
+arrive within seconds, long before data is compacted.
+
+The `compact_telemetry` command moves raw rows older than N days into
+blocks (compact_before). iter_samples() reads both tiers merged in time
+order, so the history API and exports do not care where a sample lives.
+"""
+
+import heapq
+import struct
+from datetime import datetime, timedelta, timezone as dt_timezone
+from operator import itemgetter
+
+import numpy as np
+from django.db import transaction
+
+from .models import MachineTelemetry, MachineTelemetryBlock, TelemetryRollupMark
+
+COMPACT_MARK_NAME = "compact_telemetry"
+BLOCK_SPAN = timedelta(hours=1)
+
+BLOCK_MAGIC = b"MTB1"
+_HEADER = struct.Struct("<4sIIB")
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+# Value widths of the delta-of-delta codes after the single 0 bit for "no
+# change": "10" + w[0] bits, "110" + w[1], "1110" + w[2], "1111" + w[3].
+# Timestamps are in microseconds, so their buckets are wider than the paper's.
+_TS_WIDTHS = (14, 20, 32, 64)
+_COUNT_WIDTHS = (7, 12, 32, 64)
+
+
+class _BitWriter:
+    def __init__(self):
+        self.out = bytearray()
+        self._acc = 0
+        self._bits = 0
+
+    def write(self, value: int, nbits: int) -> None:
+        self._acc = (self._acc << nbits) | value
+        self._bits += nbits
+        if self._bits >= 64:
+            spare = self._bits & 7
+            self.out += (self._acc >> spare).to_bytes(self._bits >> 3, "big")
+            self._acc &= (1 << spare) - 1
+            self._bits = spare
+
+    def getvalue(self) -> bytes:
+        if self._bits:
+            pad = -self._bits & 7
+            self.out += (self._acc << pad).to_bytes((self._bits + pad) >> 3, "big")
+            self._acc = self._bits = 0
+        return bytes(self.out)
+
+
+class _BitReader:
+    def __init__(self, data: bytes):
+        # Padding lets read() always take a 9-byte window.
+        self._data = bytes(data) + bytes(9)
+        self.pos = 0
+
+    def bit(self) -> int:
+        pos = self.pos
+        self.pos = pos + 1
+        return (self._data[pos >> 3] >> (7 - (pos & 7))) & 1
+
+    def read(self, nbits: int) -> int:
+        byte, shift = divmod(self.pos, 8)
+        self.pos += nbits
+        window = int.from_bytes(self._data[byte:byte + 9], "big")
+        return (window >> (72 - shift - nbits)) & ((1 << nbits) - 1)
+
+
+def _write_ints(w: _BitWriter, values: list, widths: tuple) -> None:
+    w.write(values[0] & 0xFFFFFFFFFFFFFFFF, 64)
+    prev, prev_delta = values[0], 0
+    last = len(widths) - 1
+    for value in values[1:]:
+        delta = value - prev
+        dod = delta - prev_delta
+        prev, prev_delta = value, delta
+        if dod == 0:
+            w.write(0, 1)
+            continue
+        for i, width in enumerate(widths):
+            if i == last or -(1 << (width - 1)) <= dod < (1 << (width - 1)):
+                break
+        if i == last:
+            w.write(0b1111, 4)
+        else:
+            w.write(((1 << (i + 1)) - 1) << 1, i + 2)
+        w.write(dod & ((1 << width) - 1), width)
+
+
+def _read_ints(r: _BitReader, count: int, widths: tuple) -> list:
+    value = r.read(64)
+    if value >> 63:
+        value -= 1 << 64
+    out = [value]
+    delta = 0
+    last = len(widths) - 1
+    for _ in range(count - 1):
+        if r.bit():
+            i = 0
+            while i < last and r.bit():
+                i += 1
+            width = widths[i]
+            dod = r.read(width)
+            if dod >> (width - 1):
+                dod -= 1 << width
+            delta += dod
+        value += delta
+        out.append(value)
+    return out
+
+
+def _write_floats(w: _BitWriter, values) -> None:
+    bits = np.ascontiguousarray(values, dtype="<f8").view("<u8").tolist()
+    prev = bits[0]
+    w.write(prev, 64)
+    lead, trail = 65, 65  # no window yet
+    for value in bits[1:]:
+        xor = value ^ prev
+        prev = value
+        if not xor:
+            w.write(0, 1)
+            continue
+        new_lead = min(64 - xor.bit_length(), 31)
+        new_trail = (xor & -xor).bit_length() - 1
+        if new_lead >= lead and new_trail >= trail:
+            # Fits the previous window of meaningful bits.
+            w.write(0b10, 2)
+            w.write(xor >> trail, 64 - lead - trail)
+        else:
+            lead, trail = new_lead, new_trail
+            size = 64 - lead - trail
+            w.write(0b11, 2)
+            w.write(lead, 5)
+            w.write(size & 63, 6)  # 64 is stored as 0
+            w.write(xor >> trail, size)
+
+
+def _read_floats(r: _BitReader, count: int) -> np.ndarray:
+    value = r.read(64)
+    out = [value]
+    lead = trail = size = 0
+    for _ in range(count - 1):
+        if r.bit():
+            if r.bit():
+                lead = r.read(5)
+                size = r.read(6) or 64
+                trail = 64 - lead - size
+            value ^= r.read(size) << trail
+        out.append(value)
+    return np.array(out, dtype="<u8").view("<f8")
+
+
+def encode_block(ts_us, ppm, temp, batch_count, status) -> bytes:
+    """
+    Compress one machine's samples (equal-length sequences, in time order;
+    ts_us as integer epoch microseconds) into a block.
+    """
+    count = len(ts_us)
+    if not count:
+        raise ValueError("A block needs at least one sample")
+
+    names, index = np.unique(np.asarray(status, dtype=object), return_inverse=True)
+    if len(names) > 255:
+        raise ValueError("Too many distinct statuses for one block")
+    starts = np.flatnonzero(np.diff(index, prepend=-1))
+    lengths = np.diff(np.append(starts, count))
+
+    out = bytearray(_HEADER.pack(BLOCK_MAGIC, count, len(starts), len(names)))
+    for name in names:
+        encoded = str(name).encode("utf-8")
+        out += struct.pack("<B", len(encoded)) + encoded
+    out += lengths.astype("<u4").tobytes()
+    out += index[starts].astype("u1").tobytes()
+
+    w = _BitWriter()
+    _write_ints(w, [int(t) for t in ts_us], _TS_WIDTHS)
+    _write_floats(w, ppm)
+    _write_floats(w, temp)
+    _write_ints(w, [int(b) for b in batch_count], _COUNT_WIDTHS)
+    return bytes(out) + w.getvalue()
+
+
+def decode_block(data) -> dict:
+    """
+    A block's samples as NumPy arrays: ts (datetime64[us], UTC), ppm and
+    temp (float64), batch_count (int64), status (object, str).
+    """
+    data = bytes(data)
+    magic, count, runs, distinct = _HEADER.unpack_from(data)
+    if magic != BLOCK_MAGIC:
+        raise ValueError("Not a telemetry block")
+    pos = _HEADER.size
+    names = []
+    for _ in range(distinct):
+        size = data[pos]
+        names.append(data[pos + 1:pos + 1 + size].decode("utf-8"))
+        pos += 1 + size
+    lengths = np.frombuffer(data, dtype="<u4", count=runs, offset=pos)
+    pos += 4 * runs
+    index = np.frombuffer(data, dtype="u1", count=runs, offset=pos)
+    pos += runs
+
+    r = _BitReader(data[pos:])
+    ts = np.array(_read_ints(r, count, _TS_WIDTHS), dtype=np.int64).astype("datetime64[us]")
+    ppm = _read_floats(r, count)
+    temp = _read_floats(r, count)
+    batch_count = np.array(_read_ints(r, count, _COUNT_WIDTHS), dtype=np.int64)
+    status = np.repeat(np.array(names, dtype=object)[index], lengths)
+    return {"ts": ts, "ppm": ppm, "temp": temp, "batch_count": batch_count, "status": status}
+
+
+def _to_us(dt: datetime) -> int:
+    return (dt - EPOCH) // _MICROSECOND
+
+
+def _hour_start(dt: datetime) -> datetime:
+    return dt.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+# -----------------------------------------------------------------------------
+# Compaction
+# -----------------------------------------------------------------------------
+
+def get_compact_mark():
+    """Raw telemetry before this time has been moved into blocks (None if never compacted)."""
+    mark = TelemetryRollupMark.objects.filter(name=COMPACT_MARK_NAME).first()
+    return mark.position if mark else None
+
+
+def compact_hour(machine_id: str, hour_start: datetime) -> int:
+    """
+    Move the raw rows of one machine-hour into its block, merging with the
+    block if the hour was compacted before (late samples). A sample whose
+    timestamp is already in the block is a replay and is dropped. Returns
+    the number of raw rows moved.
+    """
+    end = hour_start + BLOCK_SPAN
+    with transaction.atomic():
+        raw = MachineTelemetry.objects.filter(machine_id=machine_id, created_at__gte=hour_start, created_at__lt=end)
+        rows = list(raw.order_by("created_at").values_list("id", "created_at", "ppm", "temp", "batch_count", "status"))
+        if not rows:
+            return 0
+        ids, created, ppm, temp, batch_count, status = zip(*rows)
+        columns = {
+            "ts": np.array([_to_us(dt) for dt in created], dtype=np.int64),
+            "ppm": np.array(ppm, dtype=np.float64),
+            "temp": np.array(temp, dtype=np.float64),
+            "batch_count": np.array(batch_count, dtype=np.int64),
+            "status": np.array(status, dtype=object),
+        }
+
+        block = (
+            MachineTelemetryBlock.objects.select_for_update()
+            .filter(machine_id=machine_id, hour_start=hour_start)
+            .first()
+        )
+        if block is not None:
+            old = decode_block(block.data)
+            old["ts"] = old["ts"].astype(np.int64)
+            fresh = ~np.isin(columns["ts"], old["ts"])
+            merged = {k: np.concatenate((old[k], columns[k][fresh])) for k in columns}
+            order = np.argsort(merged["ts"], kind="stable")
+            columns = {k: v[order] for k, v in merged.items()}
+        else:
+            block = MachineTelemetryBlock(machine_id=machine_id, hour_start=hour_start)
+
+        block.data = encode_block(columns["ts"], columns["ppm"], columns["temp"], columns["batch_count"], columns["status"])
+        block.sample_count = len(columns["ts"])
+        block.save()
+        raw.filter(id__in=ids).delete()
+    return len(ids)
+
+
+def compact_before(cutoff: datetime, log=None) -> dict:
+    """
+    Move all raw telemetry before `cutoff` (rounded down to the hour) into
+    blocks, one machine-hour per transaction, then advance the compaction
+    mark. Interrupted runs simply resume: whatever is still raw is picked up.
+    """
+    cutoff = _hour_start(cutoff)
+    machine_ids = list(
+        MachineTelemetry.objects.filter(created_at__lt=cutoff)
+        .order_by("machine_id")
+        .values_list("machine_id", flat=True)
+        .distinct()
+    )
+
+    blocks = rows = 0
+    for machine_id in machine_ids:
+        moved = hours = 0
+        after = None
+        while True:
+            # Jump to the next hour that has data rather than walking empty ones.
+            qs = MachineTelemetry.objects.filter(machine_id=machine_id, created_at__lt=cutoff)
+            if after is not None:
+                qs = qs.filter(created_at__gte=after)
+            first = qs.order_by("created_at").values_list("created_at", flat=True).first()
+            if first is None:
+                break
+            hour = _hour_start(first)
+            moved += compact_hour(machine_id, hour)
+            hours += 1
+            after = hour + BLOCK_SPAN
+        blocks += hours
+        rows += moved
+        if log:
+            log(f"{machine_id}: {moved} row(s) into {hours} block(s)")
+
+    mark = get_compact_mark()
+    if mark is None or mark < cutoff:
+        TelemetryRollupMark.objects.update_or_create(name=COMPACT_MARK_NAME, defaults={"position": cutoff})
+    return {"blocks": blocks, "rows": rows}
+
+
+def delete_blocks_before(cutoff: datetime) -> int:
+    """Delete blocks whose whole hour is before `cutoff`. Returns the number deleted."""
+    deleted, _ = MachineTelemetryBlock.objects.filter(hour_start__lte=cutoff - BLOCK_SPAN).delete()
+    return deleted
+
+
+# -----------------------------------------------------------------------------
+# Reading
+# -----------------------------------------------------------------------------
+
+def iter_blocks(machine_id: str, start: datetime, end: datetime):
+    """Yield decode_block() arrays of each block overlapping [start, end), trimmed to it, oldest first."""
+    blocks = (
+        MachineTelemetryBlock.objects.filter(
+            machine_id=machine_id, hour_start__gt=start - BLOCK_SPAN, hour_start__lt=end
+        )
+        .order_by("hour_start")
+        .values_list("data", flat=True)
+    )
+    lo = np.datetime64(_to_us(start), "us")
+    hi = np.datetime64(_to_us(end), "us")
+    # Blocks are tens of KB, so only a few are fetched per round trip.
+    for data in blocks.iterator(chunk_size=24):
+        columns = decode_block(data)
+        keep = (columns["ts"] >= lo) & (columns["ts"] < hi)
+        if keep.all():
+            yield columns
+        elif keep.any():
+            yield {k: v[keep] for k, v in columns.items()}
+
+
+def _cold_samples(machine_id: str, start: datetime, end: datetime):
+    for columns in iter_blocks(machine_id, start, end):
+        created = [EPOCH + timedelta(microseconds=us) for us in columns["ts"].astype(np.int64).tolist()]
+        yield from zip(
+            created,
+            columns["ppm"].tolist(),
+            columns["temp"].tolist(),
+            columns["batch_count"].tolist(),
+            columns["status"].tolist(),
+        )
+
+
+def iter_samples(machine_id: str, start: datetime, end: datetime, chunk_size: int = 5000):
+    """
+    (created_at, ppm, temp, batch_count, status) of one machine over
+    [start, end), oldest first, from blocks and raw rows alike. Ranges after
+    the compaction mark cost no block query.
+    """
+    hot = (
+        MachineTelemetry.objects.filter(machine_id=machine_id, created_at__gte=start, created_at__lt=end)
+        .order_by("created_at")
+        .values_list("created_at", "ppm", "temp", "batch_count", "status")
+        .iterator(chunk_size=chunk_size)
+    )
+    mark = get_compact_mark()
+    if mark is None or start >= mark:
+        return hot
+    # Late samples can leave raw rows inside compacted hours until the next
+    # compaction, hence a merge rather than cold-then-hot.
+    return heapq.merge(_cold_samples(machine_id, start, end), hot, key=itemgetter(0))
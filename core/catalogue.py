@@ -0,0 +1,108 @@
+"""
+Catalogue version and the pre-serialised product feed cache.
+
+Every ShopProduct, MachineProduct or SiteConfiguration (price visibility)
+save or delete bumps a version counter (core/signals.py); code that changes products
+with QuerySet.update() or bulk_create() bypasses the signals and must call
+bump_version() itself. api_products caches each page
+it builds under the current version as the finished JSON bytes plus a
+gzipped copy, so a repeat request costs a cache lookup, and a client that
+still holds the page's ETag gets a 304 before the page is even looked up.
+Shop facet counts (api_product_facets) are cached the same way. The
+search typeahead (core/suggest.py) rebuilds its index on the same
+version.
+
+The counter lives in the database (CatalogueVersion), so all worker
+processes agree on it, and is cached for CATALOGUE_VERSION_CACHE_SECONDS.
+A bump clears the cached value once its transaction commits. Pages of an
+old version are never invalidated, just no longer asked for; they expire
+after CATALOGUE_CACHE_SECONDS.
+
+Pages are keyed on the query parameters the views read (PAGE_PARAMS and
+the facets), nothing else, and live in their own "catalogue" cache, so
+made-up parameters cannot mint entries and shop traffic cannot evict the
+default cache's telemetry entries.
+"""
+
+import gzip
+import hashlib
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import facets
+from .models import CatalogueVersion
+
+VERSION_CACHE_KEY = "shop:catalogue:version"
+PAGE_CACHE_PREFIX = "shop:catalogue:page:"
+# Bump when the feed's JSON changes shape, so ETags issued by older code stop matching.
+FEED_FORMAT = 1
+# Single-valued parameters a page depends on (facet selections come on top).
+PAGE_PARAMS = ("in_stock", "q", "fields", "limit", "cursor")
+PAGE_CACHE = "catalogue"
+
+Version = namedtuple("Version", "number updated_at")
+Page = namedtuple("Page", "body gzipped")
+
+
+def get_version() -> Version:
+    version = cache.get(VERSION_CACHE_KEY)
+    if version is None:
+        row = CatalogueVersion.objects.filter(pk=1).values_list("version", "updated_at").first()
+        if row is None:
+            obj, _ = CatalogueVersion.objects.get_or_create(pk=1)
+            row = (obj.version, obj.updated_at)
+        version = Version(*row)
+        cache.set(VERSION_CACHE_KEY, version, timeout=settings.CATALOGUE_VERSION_CACHE_SECONDS)
+    return version
+
+
+def bump_version() -> None:
+    """Move the catalogue to a new version. Part of the caller's transaction, if any."""
+    if not CatalogueVersion.objects.filter(pk=1).update(version=F("version") + 1, updated_at=timezone.now()):
+        CatalogueVersion.objects.get_or_create(pk=1, defaults={"version": 1})
+    # Only once committed: until then other requests must keep building from the old data.
+    transaction.on_commit(lambda: cache.delete(VERSION_CACHE_KEY))
+
+
+def page_params(query) -> list:
+    """
+    Sorted (name, value) pairs of `query` (request.GET) that a page depends
+    on, as the views read them: the last value of a PAGE_PARAMS entry and
+    the set of values picked per facet. Anything else is ignored.
+    """
+    params = [(name, query.get(name)) for name in PAGE_PARAMS if query.get(name)]
+    params += [(facet, v) for facet, values in facets.selection(query).items() for v in sorted(set(values))]
+    return sorted(params)
+
+
+def page_key(version: Version, query, kind: str = "") -> str:
+    """
+    Cache key and ETag seed for one request's page; `query` is request.GET
+    and `kind` tells apart responses other than the feed (e.g. "facets").
+    Only page_params() count, so anything a cached page echoes back must
+    come from them too.
+    """
+    canonical = "&".join(f"{k}={v}" for k, v in page_params(query))
+    digest = hashlib.sha1(canonical.encode("utf-8")).hexdigest()[:16]
+    key = f"{version.number}-{FEED_FORMAT}-{digest}"
+    return f"{kind}-{key}" if kind else key
+
+
+def etag(key: str) -> str:
+    # Weak: the same page is served both plain and gzipped.
+    return f'W/"{key}"'
+
+
+def get_page(key: str):
+    return caches[PAGE_CACHE].get(PAGE_CACHE_PREFIX + key)
+
+
+def store_page(key: str, body: bytes) -> Page:
+    page = Page(body, gzip.compress(body, compresslevel=6))
+    caches[PAGE_CACHE].set(PAGE_CACHE_PREFIX + key, page, timeout=settings.CATALOGUE_CACHE_SECONDS)
+    return page
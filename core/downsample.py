@@ -0,0 +1,56 @@
+"""
+Largest-Triangle-Three-Buckets (LTTB) downsampling for telemetry charts.
+
+Keeps the visual shape of a series (peaks, dips, steps) while reducing it
+to a fixed number of points. Each bucket is scored with NumPy array maths;
+only the walk from bucket to bucket is a Python loop, so the cost is
+O(len(series)) with a loop of `threshold` iterations.
+"""
+
+import numpy as np
+
+
+def lttb_indices(x, y, threshold: int) -> np.ndarray:
+    """
+    Indices of the points LTTB keeps from (x, y), in ascending order.
+    `x` must be sorted ascending. Returns every index when the series
+    already has `threshold` points or fewer.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # First and last points are always kept; the rest is split into
+    # threshold - 2 buckets of (almost) equal size.
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    out = np.empty(threshold, dtype=np.int64)
+    out[0] = 0
+    out[-1] = n - 1
+
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+
+        # Twice the triangle area between the last kept point, each
+        # candidate in this bucket and the average of the next bucket.
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(np.argmax(area))
+        out[i + 1] = a
+
+    return out
+
+
+def lttb(x, y, threshold: int):
+    """Downsample (x, y) to at most `threshold` points; returns (x, y) arrays."""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    idx = lttb_indices(x, y, threshold)
+    return x[idx], y[idx]
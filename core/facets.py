@@ -0,0 +1,215 @@
+"""
+Shop facets: category plus a few ShopProduct.specifications keys
+(material, size, machine compatibility).
+
+Each active product's facet values are copied into ShopProductFacet, one
+(product, facet, value) row apiece, whenever the product is saved or
+deleted (core/signals.py), and ShopFacetCount keeps the number of products
+per value. Unfiltered counts are read from ShopFacetCount; narrowing and
+narrowed counts run against ShopProductFacet's (facet, value, product)
+index. Neither reads specifications JSON. Code that changes products with
+QuerySet.update() or bulk_create() bypasses the signals and must run
+refresh_products() (or `manage.py refresh_shop_facets`); code saving many
+products one by one should do so inside signals.catalogue_batch(), which
+runs it once at the end instead of a refresh per save.
+
+Specification keys are matched case-insensitively, ignoring spaces,
+hyphens and underscores, against SPEC_KEYS. A list value, or a
+compatibility string such as "KP500, KP700", gives one row per item.
+
+Selections combine values of one facet with OR and different facets with
+AND. Each facet's counts ignore the selection in that facet itself, so
+ticking "Steel" still shows how many "Brass" products there are.
+"""
+
+import re
+
+from django.db import transaction
+from django.db.models import Count, F, Q
+
+from .models import ShopFacetCount, ShopProduct, ShopProductFacet
+
+FACETS = {
+    "category": "Category",
+    "material": "Material",
+    "size": "Size",
+    "compatibility": "Machine compatibility",
+}
+# Normalised specifications keys read for each facet (category comes from the column).
+SPEC_KEYS = {
+    "material": ("material",),
+    "size": ("size", "dimensions"),
+    "compatibility": ("machinecompatibility", "compatibility", "compatiblewith", "compatiblemachines", "fits"),
+}
+SPLIT_FACETS = {"compatibility"}
+MAX_VALUES = 50
+VALUE_MAX_LENGTH = ShopProductFacet._meta.get_field("value").max_length
+
+_KEY_JUNK = re.compile(r"[\s_\-]+")
+_SPLIT = re.compile(r"\s*[,;/]\s*")
+
+
+def _spec_key(key) -> str:
+    return _KEY_JUNK.sub("", str(key)).lower()
+
+
+def product_facets(category: str, specifications) -> set:
+    """(facet, value) pairs for a product with this category and specifications."""
+    found = {("category", category)} if category else set()
+    if not isinstance(specifications, dict):
+        return found
+    by_key = {_spec_key(k): v for k, v in specifications.items()}
+    for facet, keys in SPEC_KEYS.items():
+        for key in keys:
+            raw = by_key.get(key)
+            if raw in (None, "", []):
+                continue
+            items = raw if isinstance(raw, list) else [raw]
+            for item in items:
+                if isinstance(item, (dict, list)) or item is None:
+                    continue
+                text = str(item).strip()
+                parts = _SPLIT.split(text) if facet in SPLIT_FACETS else [text]
+                found.update((facet, p[:VALUE_MAX_LENGTH]) for p in parts if p)
+            break
+    return found
+
+
+def _pairs_q(pairs) -> Q:
+    q = Q()
+    for facet, value in pairs:
+        q |= Q(facet=facet, value=value)
+    return q
+
+
+def _adjust_counts(pairs, delta: int) -> None:
+    if not pairs:
+        return
+    if delta > 0:
+        ShopFacetCount.objects.bulk_create(
+            [ShopFacetCount(facet=f, value=v) for f, v in pairs], ignore_conflicts=True
+        )
+    ShopFacetCount.objects.filter(_pairs_q(pairs)).update(count=F("count") + delta)
+
+
+def refresh_product(product: ShopProduct) -> None:
+    """Bring one product's facet rows, and the counts, in line with its stored fields."""
+    with transaction.atomic():
+        # Locking the product row serialises concurrent refreshes of it, and
+        # reading it back under the lock means the last one to run writes the
+        # facets of what is stored, whichever save came first.
+        row = (
+            ShopProduct.objects.select_for_update()
+            .filter(pk=product.pk)
+            .values_list("category", "specifications", "is_active")
+            .first()
+        )
+        if row is None:
+            return
+        category, specifications, is_active = row
+        wanted = product_facets(category, specifications) if is_active else set()
+        existing = set(ShopProductFacet.objects.filter(product=product).values_list("facet", "value"))
+        removed, added = existing - wanted, wanted - existing
+        if removed:
+            ShopProductFacet.objects.filter(_pairs_q(removed), product=product).delete()
+            _adjust_counts(removed, -1)
+        if added:
+            ShopProductFacet.objects.bulk_create([ShopProductFacet(product=product, facet=f, value=v) for f, v in added])
+            _adjust_counts(added, 1)
+
+
+def forget_product(product: ShopProduct) -> None:
+    """Take a product that is about to be deleted out of the counts (its rows go by cascade)."""
+    _adjust_counts(list(ShopProductFacet.objects.filter(product=product).values_list("facet", "value")), -1)
+
+
+def refresh_products() -> int:
+    """Rebuild the facet rows and counts of every product. Returns the rows written."""
+    rows = [
+        ShopProductFacet(product_id=pk, facet=f, value=v)
+        for pk, category, specifications in ShopProduct.objects.filter(is_active=True).values_list(
+            "id", "category", "specifications"
+        ).iterator(chunk_size=2000)
+        for f, v in product_facets(category, specifications)
+    ]
+    with transaction.atomic():
+        ShopProductFacet.objects.all().delete()
+        ShopProductFacet.objects.bulk_create(rows, batch_size=2000)
+        ShopFacetCount.objects.all().delete()
+        ShopFacetCount.objects.bulk_create(
+            ShopFacetCount(facet=f, value=v, count=n)
+            for f, v, n in ShopProductFacet.objects.values_list("facet", "value").annotate(n=Count("id")).order_by()
+        )
+    return len(rows)
+
+
+def selection(query) -> dict:
+    """{facet: [values]} picked in `query` (request.GET), facets with no value left out."""
+    picked = {}
+    for facet in FACETS:
+        values = [v for v in query.getlist(facet) if v]
+        if values:
+            picked[facet] = values
+    return picked
+
+
+def _picked_ids(facet: str, values):
+    return ShopProductFacet.objects.filter(facet=facet, value__in=values).values("product_id")
+
+
+def narrow(queryset, picked: dict):
+    """`queryset` restricted to products matching every facet in `picked`."""
+    for facet, values in picked.items():
+        if facet == "category":
+            queryset = queryset.filter(category__in=values)
+        else:
+            queryset = queryset.filter(id__in=_picked_ids(facet, values))
+    return queryset
+
+
+def _value_counts(facets, picked: dict, products=None):
+    """(facet, value, count) rows for `facets` over the products matching `picked`, and `products` if given."""
+    if not picked and products is None:
+        return ShopFacetCount.objects.filter(facet__in=facets, count__gt=0).values_list("facet", "value", "count")
+    rows = ShopProductFacet.objects.filter(facet__in=facets)
+    for facet, values in picked.items():
+        rows = rows.filter(product_id__in=_picked_ids(facet, values))
+    if products is not None:
+        rows = rows.filter(product_id__in=products.values("id"))
+    return rows.values_list("facet", "value").annotate(n=Count("*")).order_by("facet", "-n", "value")
+
+
+def facet_counts(picked: dict, products=None) -> list:
+    """
+    Facets with their value counts over the active products matching
+    `picked`. Pass `products` when the shop is also narrowed by something
+    other than facets (a text search, in_stock); without it the counts come
+    from the facet table alone, or straight from ShopFacetCount when nothing
+    is picked. One query for the unpicked facets plus one per picked facet.
+    """
+    counts = {}
+    unpicked = [f for f in FACETS if f not in picked]
+    groups = [(unpicked, picked)] if unpicked else []
+    groups += [([f], {g: v for g, v in picked.items() if g != f}) for f in picked]
+    for facets, others in groups:
+        for facet, value, n in _value_counts(facets, others, products):
+            values = counts.setdefault(facet, [])
+            if len(values) < MAX_VALUES:
+                values.append((value, n))
+
+    category_labels = dict(ShopProduct.CATEGORY_CHOICES)
+    out = []
+    for facet, label in FACETS.items():
+        chosen = set(picked.get(facet, ()))
+        values = [
+            {
+                "value": value,
+                "label": category_labels.get(value, value) if facet == "category" else value,
+                "count": n,
+                "selected": value in chosen,
+            }
+            for value, n in counts.get(facet, [])
+        ]
+        if values:
+            out.append({"name": facet, "label": label, "values": values})
+    return out
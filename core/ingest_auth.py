@@ -0,0 +1,182 @@
+"""
+Per-machine authentication for the ingest endpoints.
+
+A machine client signs every request with its MachineApiKey:
+
+    X-MPE-Key        key_id
+    X-MPE-Timestamp  epoch seconds (an integer) when the request was signed
+    X-MPE-Signature  hex HMAC-SHA256(secret, "<timestamp>\n" + raw body)
+
+The body is signed exactly as sent (i.e. after gzip), so the server checks
+it before decoding anything. Keys are cached in process for
+TELEMETRY_API_KEY_CACHE_SECONDS, so verifying a request is one dict lookup
+and one HMAC, with no query. The cache holds at most MAX_CACHED_KEYS
+entries, least recently used first out, so a client cycling through made-up
+key ids cannot grow it. Saving or deleting a key (or its machine) drops the
+entry in this process straight away (core/signals.py); other worker
+processes notice a revoked key when their entry expires.
+
+TELEMETRY_REQUIRE_API_KEY is on by default and unsigned requests get 401.
+To roll keys out to existing clients: turn it off, create a MachineApiKey
+per machine in the admin, set MPE_API_KEY_ID / MPE_API_KEY_SECRET in the
+environment of each client (Python Support Apps/machine_client.py), and
+turn it back on once every machine sends signed requests. While it is off,
+`manage.py check` (and so every deploy) warns about it. A request that does
+carry a key is always verified.
+"""
+
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import checks
+
+from .models import MachineApiKey
+
+# How far a request's timestamp may be from the server clock. Bounds how
+# long a captured request can be replayed.
+SIGNATURE_MAX_SKEW_SECONDS = 300
+# Entries (known and unknown key ids) cached per process.
+MAX_CACHED_KEYS = 1024
+
+KEY_HEADER = "X-MPE-Key"
+TIMESTAMP_HEADER = "X-MPE-Timestamp"
+SIGNATURE_HEADER = "X-MPE-Signature"
+
+IngestKey = namedtuple("IngestKey", "key_id secret telemetry_id")
+
+
+class IngestAuthError(Exception):
+    def __init__(self, message: str, status: int = 401):
+        super().__init__(message)
+        self.status = status
+
+
+_lock = threading.Lock()
+_keys = OrderedDict()  # key_id -> (IngestKey or None, expires_at), least recently used first
+
+
+def sign(secret: str, timestamp: str, body: bytes) -> str:
+    return hmac.new(secret.encode("utf-8"), timestamp.encode("ascii") + b"\n" + body, hashlib.sha256).hexdigest()
+
+
+def invalidate(key_id: str = None) -> None:
+    """Forget one cached key, or all of them."""
+    with _lock:
+        if key_id is None:
+            _keys.clear()
+        else:
+            _keys.pop(key_id, None)
+
+
+def _cached(key_id: str):
+    """(True, IngestKey or None) if key_id is cached and fresh, else (False, None)."""
+    with _lock:
+        entry = _keys.get(key_id)
+        if entry is None:
+            return False, None
+        if entry[1] <= time.monotonic():
+            del _keys[key_id]
+            return False, None
+        _keys.move_to_end(key_id)
+        return True, entry[0]
+
+
+def _load(key_id: str):
+    row = (
+        MachineApiKey.objects.filter(key_id=key_id, is_active=True, machine__is_active=True)
+        .exclude(machine__telemetry_id="")
+        .values_list("secret", "machine__telemetry_id")
+        .first()
+    )
+    key = IngestKey(key_id, row[0], row[1]) if row else None
+    # Unknown ids are cached too, so a client with a bad key cannot cause a query per request.
+    with _lock:
+        _keys[key_id] = (key, time.monotonic() + settings.TELEMETRY_API_KEY_CACHE_SECONDS)
+        _keys.move_to_end(key_id)
+        while len(_keys) > MAX_CACHED_KEYS:
+            _keys.popitem(last=False)
+    return key
+
+
+def _signature_headers(request):
+    """(key_id, timestamp, signature) from the request, or None if it is unsigned and that is allowed."""
+    key_id = request.headers.get(KEY_HEADER, "")
+    if not key_id:
+        if settings.TELEMETRY_REQUIRE_API_KEY:
+            raise IngestAuthError(f"Missing {KEY_HEADER} header")
+        return None
+
+    timestamp = request.headers.get(TIMESTAMP_HEADER, "")
+    signature = request.headers.get(SIGNATURE_HEADER, "")
+    if not timestamp or not signature:
+        raise IngestAuthError(f"{TIMESTAMP_HEADER} and {SIGNATURE_HEADER} are required with {KEY_HEADER}")
+    try:
+        # int(), not float(): "nan" would compare false against the limit and pass.
+        skew = abs(time.time() - int(timestamp))
+    except ValueError:
+        raise IngestAuthError(f"Invalid {TIMESTAMP_HEADER}")
+    if skew > SIGNATURE_MAX_SKEW_SECONDS:
+        raise IngestAuthError(f"{TIMESTAMP_HEADER} is more than {SIGNATURE_MAX_SKEW_SECONDS}s from server time")
+    return key_id, timestamp, signature
+
+
+def _verify(key, timestamp: str, signature: str, body: bytes):
+    if key is None or not hmac.compare_digest(sign(key.secret, timestamp, body), signature):
+        raise IngestAuthError("Invalid API key or signature")
+    return key
+
+
+def authenticate(request):
+    """
+    The IngestKey that signed `request`, or None for an unsigned request
+    when keys are not required. Raises IngestAuthError otherwise.
+    """
+    headers = _signature_headers(request)
+    if headers is None:
+        return None
+    key_id, timestamp, signature = headers
+    found, key = _cached(key_id)
+    if not found:
+        key = _load(key_id)
+    return _verify(key, timestamp, signature, request.body)
+
+
+async def aauthenticate(request):
+    """authenticate() for async views; only a cache miss leaves the event loop."""
+    headers = _signature_headers(request)
+    if headers is None:
+        return None
+    key_id, timestamp, signature = headers
+    found, key = _cached(key_id)
+    if not found:
+        key = await sync_to_async(_load)(key_id)
+    return _verify(key, timestamp, signature, request.body)
+
+
+def check_machines(key, samples) -> None:
+    """Refuse (403) a signed request carrying data for any machine other than the key's."""
+    if key is None:
+        return
+    for data in samples:
+        if isinstance(data, dict) and data.get("machine_id") != key.telemetry_id:
+            raise IngestAuthError(
+                f"API key {key.key_id} may only send data for machine_id '{key.telemetry_id}'", status=403
+            )
+
+
+def check_require_api_key(app_configs, **kwargs):
+    """System check: warn while unsigned ingest is allowed."""
+    if settings.TELEMETRY_REQUIRE_API_KEY:
+        return []
+    return [
+        checks.Warning(
+            "TELEMETRY_REQUIRE_API_KEY is off, so anyone can post telemetry for any machine_id.",
+            hint="Give every machine client a MachineApiKey, then set TELEMETRY_REQUIRE_API_KEY=1.",
+            id="core.W001",
+        )
+    ]
@@ -0,0 +1,306 @@
+import importlib.util
+import json
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client
+from django.utils import timezone
+
+from core import alerts, ringbuffer, writebehind
+from core.ingest_auth import KEY_HEADER, SIGNATURE_HEADER, TIMESTAMP_HEADER, sign
+from core.models import Alert, CustomerMachine, MachineApiKey, MachineTelemetry
+from core.telemetry import forget_latest
+
+# Everything under the prefix is deleted afterwards, so it must not be one
+# that real machine_ids could start with.
+MIN_PREFIX_LENGTH = 3
+
+
+def _load_sensor_generator():
+    """generate_sensor_data() from the real machine client, so load matches production payloads."""
+    path = Path(settings.BASE_DIR) / "Python Support Apps" / "machine_client.py"
+    spec = importlib.util.spec_from_file_location("machine_client", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.generate_sensor_data
+
+
+def _percentile(sorted_values: list, pct: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def _telemetry_bytes():
+    """On-disk size of the telemetry table (PostgreSQL, all partitions) or the whole database file (SQLite)."""
+    table = MachineTelemetry._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                "SELECT COALESCE(SUM(pg_total_relation_size(relid)), 0) FROM pg_partition_tree(%s::regclass)",
+                [table],
+            )
+        elif connection.vendor == "sqlite":
+            cursor.execute("SELECT page_count * page_size FROM pragma_page_count(), pragma_page_size()")
+        else:
+            return None
+        return int(cursor.fetchone()[0])
+
+
+def _git_revision() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=5,
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def _bench_owner(prefix: str):
+    """The inactive user that owns the run's CustomerMachines (and so their API keys)."""
+    user, _ = get_user_model().objects.get_or_create(username=f"{prefix}owner", defaults={"is_active": False})
+    return user
+
+
+def _bench_keys(prefix: str, machines: int) -> list:
+    """A CustomerMachine and MachineApiKey per simulated machine, so requests can be signed."""
+    owner = _bench_owner(prefix)
+    keys = []
+    for index in range(machines):
+        machine, _ = CustomerMachine.objects.get_or_create(
+            customer=owner, telemetry_id=f"{prefix}{index}", defaults={"name": f"Ingest benchmark {index}"}
+        )
+        keys.append(MachineApiKey.objects.create(machine=machine, label="bench_ingest"))
+    return keys
+
+
+def _cleanup(prefix: str, machine_ids: list, keep_data: bool) -> None:
+    """Remove the run's machines and keys and whatever ingest left behind for them in this process."""
+    _bench_owner(prefix).delete()  # cascades to its machines and their keys
+    ringbuffer.release(machine_ids)
+    forget_latest(machine_ids)
+    alerts.forget(machine_ids)
+    if not keep_data:
+        Alert.objects.filter(machine_id__in=machine_ids).delete()
+        MachineTelemetry.objects.filter(machine_id__startswith=prefix).delete()
+
+
+class _Sender:
+    """Posts signed JSON bodies either in-process (Django test client) or over HTTP (requests.Session)."""
+
+    def __init__(self, base_url: str, key):
+        self.key = key
+        self.base_url = base_url.rstrip("/") if base_url else ""
+        if self.base_url:
+            import requests
+
+            self.session = requests.Session()
+        else:
+            host = next((h.lstrip(".") for h in settings.ALLOWED_HOSTS if h != "*"), "localhost")
+            self.client = Client(HTTP_HOST=host)
+
+    def post(self, path: str, body: str):
+        """Returns (status_code, decoded JSON or None)."""
+        data = body.encode("utf-8")
+        timestamp = str(int(time.time()))
+        signed = {
+            KEY_HEADER: self.key.key_id,
+            TIMESTAMP_HEADER: timestamp,
+            SIGNATURE_HEADER: sign(self.key.secret, timestamp, data),
+        }
+        if self.base_url:
+            response = self.session.post(
+                self.base_url + path, data=data, headers={"Content-Type": "application/json", **signed}, timeout=30
+            )
+            status, content = response.status_code, response.content
+        else:
+            response = self.client.post(path, data=data, content_type="application/json", headers=signed)
+            status, content = response.status_code, response.content
+        try:
+            return status, json.loads(content)
+        except ValueError:
+            return status, None
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test telemetry ingest: N simulated machines sending samples at M Hz, either "
+        "in-process through the Django test client or over HTTP to a running server. "
+        "Reports rows/s, request latency percentiles and database growth as JSON. Each simulated "
+        "machine gets a temporary CustomerMachine and API key and signs its requests; they are "
+        "removed afterwards together with the generated rows, alerts, ring buffer slots and "
+        "cached latest samples (the last three only in this process's node/cache when --url is used)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--machines", type=int, default=10, help="Simulated machines (default 10).")
+        parser.add_argument("--hz", type=float, default=1.0, help="Samples per second per machine (default 1).")
+        parser.add_argument("--duration", type=float, default=30.0, help="Seconds to run (default 30).")
+        parser.add_argument(
+            "--url",
+            default="",
+            help="Base URL of a running server (e.g. http://127.0.0.1:8000). Omit to run in-process. "
+                 "The server must use the same database for the growth figures to mean anything.",
+        )
+        parser.add_argument(
+            "--mode",
+            choices=["single", "batch", "async"],
+            default="single",
+            help="single: one POST /api/ingest/ per sample. batch: POST /api/ingest/batch/ every --batch-size samples. "
+                 "async: like batch, against the write-behind /api/ingest/async/ (202 once queued).",
+        )
+        parser.add_argument("--batch-size", type=int, default=50, help="Samples per request in batch mode (default 50).")
+        parser.add_argument(
+            "--prefix",
+            default="bench-",
+            help=f"machine_id prefix for generated rows (default 'bench-', at least {MIN_PREFIX_LENGTH} "
+                 "characters). All telemetry under it is deleted afterwards.",
+        )
+        parser.add_argument("--keep-data", action="store_true", help="Keep the generated rows instead of deleting them.")
+        parser.add_argument("--output", default="", help="Write the JSON report to this file (default: print it).")
+
+    def handle(self, *args, **options):
+        machines = options["machines"]
+        hz = options["hz"]
+        duration = options["duration"]
+        batch_size = options["batch_size"] if options["mode"] != "single" else 1
+        if machines < 1 or hz <= 0 or duration <= 0 or batch_size < 1:
+            raise CommandError("--machines, --hz, --duration and --batch-size must be positive")
+        prefix = options["prefix"]
+        if len(prefix.strip()) < MIN_PREFIX_LENGTH:
+            raise CommandError(f"--prefix must be at least {MIN_PREFIX_LENGTH} characters")
+        real = (
+            CustomerMachine.objects.filter(telemetry_id__startswith=prefix)
+            .exclude(customer__username=f"{prefix}owner")
+            .values_list("telemetry_id", flat=True)
+            .first()
+        )
+        if real is not None:
+            raise CommandError(f"--prefix '{prefix}' matches the real machine '{real}'; its data would be deleted")
+        if not options["url"] and connection.vendor == "sqlite" and machines > 1:
+            self.stderr.write("Note: SQLite serialises writers; expect 'database is locked' errors under concurrency.")
+
+        generate = _load_sensor_generator()
+        keys = _bench_keys(prefix, machines)
+        machine_ids = [key.machine.telemetry_id for key in keys]
+        path = {"single": "/api/ingest/", "batch": "/api/ingest/batch/", "async": "/api/ingest/async/"}[options["mode"]]
+        ok_status = 202 if options["mode"] == "async" else 200
+        interval = batch_size / hz
+
+        latencies = []
+        totals = {"requests": 0, "errors": 0, "rows": 0}
+        lock = threading.Lock()
+        bytes_before = _telemetry_bytes()
+        started_at = timezone.now()
+        start = time.perf_counter()
+        deadline = start + duration
+
+        def run_machine(index: int):
+            sender = _Sender(options["url"], keys[index])
+            machine_id = machine_ids[index]
+            next_send = start + interval * (index / machines)  # spread machines across the interval
+            try:
+                while True:
+                    delay = next_send - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    if time.perf_counter() >= deadline:
+                        return
+
+                    samples = []
+                    for _ in range(batch_size):
+                        sample = generate()
+                        sample["machine_id"] = machine_id
+                        samples.append(sample)
+                    body = json.dumps(samples if options["mode"] != "single" else samples[0])
+
+                    t0 = time.perf_counter()
+                    try:
+                        status, data = sender.post(path, body)
+                    except Exception:
+                        status, data = None, None
+                    elapsed = time.perf_counter() - t0
+
+                    if status == ok_status and data:
+                        rows = data.get("accepted", 1)
+                    else:
+                        rows = 0
+                    with lock:
+                        latencies.append(elapsed)
+                        totals["requests"] += 1
+                        totals["rows"] += rows
+                        totals["errors"] += status != ok_status
+
+                    # Closed loop: a slow server delays the next request instead of piling them up.
+                    next_send = max(next_send + interval, time.perf_counter())
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=run_machine, args=(i,), daemon=True) for i in range(machines)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        if options["mode"] == "async" and not options["url"]:
+            writebehind.shutdown()  # flush, so the growth figures include every accepted row
+
+        bytes_after = _telemetry_bytes()
+        latencies.sort()
+        rows_per_s = totals["rows"] / elapsed
+        growth = None if bytes_before is None else bytes_after - bytes_before
+
+        report = {
+            "started_at": started_at.isoformat(),
+            "git_revision": _git_revision(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "target": options["url"] or "in-process",
+            "mode": options["mode"],
+            "machines": machines,
+            "hz": hz,
+            "batch_size": batch_size,
+            "duration_s": round(elapsed, 3),
+            "requests": totals["requests"],
+            "errors": totals["errors"],
+            "rows": totals["rows"],
+            "offered_rows_per_s": round(machines * hz, 2),
+            "rows_per_s": round(rows_per_s, 2),
+            "latency_ms": {
+                "mean": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+                "p50": round(_percentile(latencies, 50) * 1000, 2),
+                "p95": round(_percentile(latencies, 95) * 1000, 2),
+                "p99": round(_percentile(latencies, 99) * 1000, 2),
+                "max": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            },
+            "db_size_scope": {"postgresql": "telemetry table", "sqlite": "database file"}.get(connection.vendor),
+            "db_growth_bytes": growth,
+            "bytes_per_row": round(growth / totals["rows"], 1) if growth is not None and totals["rows"] else None,
+            "db_growth_bytes_per_hour": round(growth / elapsed * 3600) if growth is not None else None,
+        }
+
+        _cleanup(prefix, machine_ids, options["keep_data"])
+
+        text = json.dumps(report, indent=2)
+        if options["output"]:
+            Path(options["output"]).write_text(text + "\n")
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"{totals['rows']} rows in {elapsed:.1f}s ({rows_per_s:.0f} rows/s), "
+                    f"p95 {report['latency_ms']['p95']} ms, {totals['errors']} error(s). "
+                    f"Report written to {options['output']}."
+                )
+            )
+        else:
+            self.stdout.write(text)
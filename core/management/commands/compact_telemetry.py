@@ -0,0 +1,51 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from core.blocks import compact_before
+from core.rollups import get_rollup_mark
+
+
+class Command(BaseCommand):
+    help = (
+        "Move raw telemetry older than the cutoff into compressed per-machine, per-hour "
+        "blocks (MachineTelemetryBlock). History and exports read both tiers. Safe to run "
+        "repeatedly (e.g. daily from cron, before prune_telemetry)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than",
+            type=int,
+            required=True,
+            metavar="DAYS",
+            help="Compact raw telemetry older than this many days.",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Compact past the rollup high-water mark (those hours can then no longer be rolled up).",
+        )
+
+    def handle(self, *args, **options):
+        if options["older_than"] < 1:
+            raise CommandError("--older-than must be at least 1 day")
+
+        cutoff = timezone.now() - timedelta(days=options["older_than"])
+
+        mark = get_rollup_mark()
+        if not options["force"] and (mark is None or mark < cutoff):
+            raise CommandError(
+                "Raw telemetry before the cutoff has not all been rolled up yet "
+                "(run rollup_telemetry first, or pass --force)."
+            )
+
+        log = self.stdout.write if options["verbosity"] > 1 else None
+        result = compact_before(cutoff, log=log)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Compacted {result['rows']} row(s) into {result['blocks']} block(s) "
+                f"(telemetry before {cutoff.isoformat()})."
+            )
+        )
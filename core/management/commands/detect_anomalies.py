@@ -0,0 +1,45 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from core.anomalies import SHIFT_THRESHOLD, WINDOW, Z_THRESHOLD, detect_anomalies
+
+
+class Command(BaseCommand):
+    help = (
+        "Flag outliers (rolling z-scores) and level shifts in recent ppm/temp telemetry and "
+        "store them as TelemetryAnomaly rows, replacing earlier results for the same range. "
+        "Run periodically (e.g. hourly from cron)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hours", type=int, default=24, help="Analyse the last N hours (default 24).")
+        parser.add_argument("--machine", action="append", dest="machines", metavar="MACHINE_ID",
+                            help="Only this machine_id (repeatable). Default: every machine with data.")
+        parser.add_argument("--window", type=int, default=WINDOW,
+                            help=f"Rolling window in samples (default {WINDOW}, i.e. 5 minutes at 1 Hz).")
+        parser.add_argument("--z", type=float, default=Z_THRESHOLD,
+                            help=f"z-score above which a sample is an outlier (default {Z_THRESHOLD}).")
+        parser.add_argument("--shift", type=float, default=SHIFT_THRESHOLD,
+                            help=f"Mean shift, in standard deviations, that counts as a level shift (default {SHIFT_THRESHOLD}).")
+
+    def handle(self, *args, **options):
+        if options["hours"] < 1:
+            raise CommandError("--hours must be at least 1")
+        if options["window"] < 2:
+            raise CommandError("--window must be at least 2 samples")
+
+        end = timezone.now()
+        start = end - timedelta(hours=options["hours"])
+        log = self.stdout.write if options["verbosity"] > 1 else None
+        written = detect_anomalies(
+            start,
+            end,
+            machine_ids=options["machines"],
+            window=options["window"],
+            z=options["z"],
+            shift=options["shift"],
+            log=log,
+        )
+        self.stdout.write(self.style.SUCCESS(f"Stored {written} anomaly(ies) from {start.isoformat()} to {end.isoformat()}."))
@@ -0,0 +1,63 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from core.partitions import DELETE_BATCH_SIZE, ensure_partitions, prune_telemetry
+from core.rollups import get_rollup_mark
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply the raw telemetry retention policy. On PostgreSQL, drops whole monthly "
+        "partitions older than the cutoff and creates upcoming ones; everything else is "
+        "deleted in bounded primary-key batches. Run daily (e.g. from cron)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than",
+            type=int,
+            required=True,
+            metavar="DAYS",
+            help="Remove raw telemetry older than this many days.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=DELETE_BATCH_SIZE,
+            help=f"Rows per DELETE for data outside droppable partitions (default {DELETE_BATCH_SIZE}).",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Prune past the rollup high-water mark (drops raw data not yet rolled up).",
+        )
+
+    def handle(self, *args, **options):
+        if options["older_than"] < 1:
+            raise CommandError("--older-than must be at least 1 day")
+
+        cutoff = timezone.now() - timedelta(days=options["older_than"])
+
+        mark = get_rollup_mark()
+        if not options["force"] and (mark is None or mark < cutoff):
+            raise CommandError(
+                "Raw telemetry before the cutoff has not all been rolled up yet "
+                "(run rollup_telemetry first, or pass --force)."
+            )
+
+        created = ensure_partitions()
+        for name in created:
+            self.stdout.write(f"Created partition {name}")
+
+        result = prune_telemetry(cutoff, batch_size=max(1, options["batch_size"]))
+        for name in result["dropped_partitions"]:
+            self.stdout.write(f"Dropped partition {name}")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Pruned telemetry older than {cutoff.isoformat()}: "
+                f"{len(result['dropped_partitions'])} partition(s) dropped, {result['deleted_rows']} row(s) "
+                f"and {result['deleted_blocks']} compacted block(s) deleted."
+            )
+        )
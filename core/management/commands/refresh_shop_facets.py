@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from core.catalogue import bump_version
+from core.facets import refresh_products
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the shop facet table (ShopProductFacet) from every product's category and "
+        "specifications. Only needed after products were changed without save(), e.g. by "
+        "QuerySet.update() or an import."
+    )
+
+    def handle(self, *args, **options):
+        written = refresh_products()
+        bump_version()
+        self.stdout.write(self.style.SUCCESS(f"Stored {written} facet value(s)."))
@@ -0,0 +1,56 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from core.blocks import get_compact_mark
+from core.rollups import MINUTE, floor_time, run_rollups, set_rollup_mark
+
+
+class Command(BaseCommand):
+    help = (
+        "Build per-minute, per-hour and per-day telemetry rollups incrementally "
+        "from the stored high-water mark. Safe to run repeatedly (e.g. from cron)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--lag",
+            type=int,
+            default=60,
+            help=(
+                "Seconds to stay behind 'now' so late samples land before their minute is rolled up. "
+                "Keep it at least 60 so the status time of the newest samples can be closed (default 60)."
+            ),
+        )
+        parser.add_argument(
+            "--window-hours",
+            type=int,
+            default=6,
+            help="Hours of raw telemetry processed per step; the mark is saved after each step (default 6).",
+        )
+        parser.add_argument(
+            "--rebuild-from",
+            help="ISO datetime to move the high-water mark back to before running, to rebuild rollups from there.",
+        )
+
+    def handle(self, *args, **options):
+        if options["rebuild_from"]:
+            start = parse_datetime(options["rebuild_from"])
+            if start is None or start.tzinfo is None:
+                raise CommandError("--rebuild-from must be an ISO datetime with a timezone, e.g. 2026-01-01T00:00:00+00:00")
+            compacted = get_compact_mark()
+            if compacted and start < compacted:
+                raise CommandError(
+                    f"Raw telemetry before {compacted.isoformat()} has been compacted into blocks; "
+                    "rollups cannot be rebuilt from before then."
+                )
+            set_rollup_mark(floor_time(start, MINUTE))
+
+        log = self.stdout.write if options["verbosity"] > 1 else None
+        written = run_rollups(
+            lag=timedelta(seconds=max(0, options["lag"])),
+            window=timedelta(hours=max(1, options["window_hours"])),
+            log=log,
+        )
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} minute rollup(s)."))
@@ -0,0 +1,180 @@
+"""
+Generic per-machine metrics (MachineMetric) and the MetricKey registry.
+
+Machines post arbitrary named values (film_tension, seal_pressure, ...).
+Each name is resolved to a small MetricKey id through an in-process cache,
+so a stored value is just (machine, key, value, timestamp) and a new PLC
+signal needs no migration.
+"""
+
+import re
+
+from django.db import connection, transaction
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+
+from .models import CustomerMachine, MachineMetric, MetricKey
+from .telemetry import INGEST_CHUNK_SIZE, TelemetryError, _float, _text, parse_timestamp
+
+METRIC_KEY_RE = re.compile(r"^[A-Za-z0-9_.\-]{1,80}$")
+MAX_METRICS_PER_RECORD = 200
+# Caps on registering names, so a misbehaving client cannot fill the
+# registry (MetricKey ids are smallints, at most 32767). Records using a
+# name that could not be registered are rejected.
+MAX_NEW_KEYS_PER_REQUEST = 20
+MAX_METRIC_KEYS = 5000
+
+# key name -> MetricKey id. Ids never change once assigned, so entries never
+# go stale; a process only ever queries the registry for names it hasn't seen.
+_key_ids: dict = {}
+
+
+def resolve_keys(units: dict) -> dict:
+    """
+    Map metric names to MetricKey ids, registering up to
+    MAX_NEW_KEYS_PER_REQUEST unknown names while the registry holds fewer
+    than MAX_METRIC_KEYS. Names that could not be registered are left out.
+    `units` is {name: unit}; the unit is only used when a name is new.
+    """
+    missing = [name for name in units if name not in _key_ids]
+    if missing:
+        _key_ids.update(MetricKey.objects.filter(key__in=missing).values_list("key", "id"))
+        new = [name for name in missing if name not in _key_ids][:MAX_NEW_KEYS_PER_REQUEST]
+        if new:
+            # Concurrent requests can overshoot the total by a few requests' worth, well short of the id limit.
+            new = new[: max(0, MAX_METRIC_KEYS - MetricKey.objects.count())]
+        if new:
+            # ignore_conflicts: another worker may register the same name concurrently.
+            MetricKey.objects.bulk_create(
+                [MetricKey(key=name, unit=units[name]) for name in new], ignore_conflicts=True
+            )
+            _key_ids.update(MetricKey.objects.filter(key__in=new).values_list("key", "id"))
+    return {name: _key_ids[name] for name in units if name in _key_ids}
+
+
+def clean_record(data, now) -> tuple:
+    """
+    Validate one metrics record:
+
+        {"machine_id": "i6", "ts": 1718000000.5,
+         "metrics": {"film_tension": 12.4, "seal_pressure": {"value": 4.1, "unit": "bar"}}}
+
+    "ts" is optional (defaults to `now`). Returns (machine_id, timestamp,
+    [(name, value, unit), ...]).
+    """
+    if not isinstance(data, dict):
+        raise TelemetryError("Record must be a JSON object")
+
+    machine_id = _text(data, "machine_id", 50)
+    timestamp = parse_timestamp(data["ts"]) if data.get("ts") is not None else now
+
+    metrics = data.get("metrics")
+    if not isinstance(metrics, dict) or not metrics:
+        raise TelemetryError("'metrics' must be a non-empty object")
+    if len(metrics) > MAX_METRICS_PER_RECORD:
+        raise TelemetryError(f"Too many metrics (max {MAX_METRICS_PER_RECORD} per record)")
+
+    values = []
+    for name, raw in metrics.items():
+        if not METRIC_KEY_RE.match(name):
+            raise TelemetryError(f"Invalid metric name '{name[:80]}'")
+        unit = ""
+        if isinstance(raw, dict):
+            unit = raw.get("unit") or ""
+            if not isinstance(unit, str) or len(unit) > 20:
+                raise TelemetryError(f"'{name}' unit must be a string of at most 20 characters")
+        else:
+            raw = {"value": raw}
+        try:
+            value = _float(raw, "value")
+        except TelemetryError as e:
+            raise TelemetryError(f"{name}: {e}")
+        values.append((name, value, unit))
+    return machine_id, timestamp, values
+
+
+def ingest_metrics(records: list):
+    """
+    Validate every record, resolve machines (CustomerMachine.telemetry_id)
+    and metric names, then bulk-insert one narrow row per value in a single
+    transaction.
+
+    Returns (stored_value_count, results) with one result per record.
+    """
+    now = timezone.now()
+    cleaned = []
+    results = []
+    for index, data in enumerate(records):
+        try:
+            if isinstance(data, TelemetryError):
+                raise data
+            cleaned.append((index, clean_record(data, now)))
+        except TelemetryError as e:
+            results.append({"index": index, "status": "rejected", "error": str(e)})
+        else:
+            results.append({"index": index, "status": "accepted"})
+
+    telemetry_ids = {machine_id for _, (machine_id, _, _) in cleaned}
+    machines = {}
+    for telemetry_id, pk in (
+        CustomerMachine.objects.filter(telemetry_id__in=telemetry_ids, is_active=True)
+        .order_by("-id")
+        .values_list("telemetry_id", "id")
+    ):
+        machines[telemetry_id] = pk  # lowest id wins if a telemetry_id is reused
+
+    units = {}
+    for index, (machine_id, _, values) in cleaned:
+        if machine_id not in machines:
+            results[index] = {"index": index, "status": "rejected", "error": f"Unknown machine_id '{machine_id}'"}
+            continue
+        for name, _, unit in values:
+            units.setdefault(name, unit)
+
+    key_ids = resolve_keys(units) if units else {}
+    rows = []
+    for index, (machine_id, timestamp, values) in cleaned:
+        if machine_id not in machines:
+            continue
+        unknown = next((name for name, _, _ in values if name not in key_ids), None)
+        if unknown is not None:
+            results[index] = {
+                "index": index,
+                "status": "rejected",
+                "error": f"Metric '{unknown}' is not registered and no more new names are accepted now",
+            }
+            continue
+        rows.extend(
+            MachineMetric(machine_id=machines[machine_id], key_id=key_ids[name], value=value, timestamp=timestamp)
+            for name, value, _ in values
+        )
+    if rows:
+        with transaction.atomic():
+            MachineMetric.objects.bulk_create(rows, batch_size=INGEST_CHUNK_SIZE)
+    return len(rows), results
+
+
+def latest_values(machine_pks, since) -> dict:
+    """
+    Newest value of every metric key for each CustomerMachine in
+    `machine_pks`, reported since `since`, in one query:
+    {machine_pk: [(key, unit, value, timestamp), ...]} sorted by key.
+
+    Uses DISTINCT ON over the (machine, key, -timestamp) index on
+    PostgreSQL and a ROW_NUMBER() window elsewhere.
+    """
+    qs = MachineMetric.objects.filter(machine_id__in=list(machine_pks), timestamp__gte=since)
+    if connection.vendor == "postgresql":
+        qs = qs.order_by("machine_id", "key_id", "-timestamp").distinct("machine_id", "key_id")
+    else:
+        qs = qs.annotate(
+            _newest=Window(RowNumber(), partition_by=[F("machine_id"), F("key_id")], order_by=F("timestamp").desc())
+        ).filter(_newest=1)
+
+    out = {}
+    for machine_pk, key, unit, value, timestamp in qs.values_list("machine_id", "key__key", "key__unit", "value", "timestamp"):
+        out.setdefault(machine_pk, []).append((key, unit, value, timestamp))
+    for values in out.values():
+        values.sort()
+    return out
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0064_tooling_page_content_models"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="machinetelemetry",
+            index=models.Index(fields=["machine_id", "-created_at"], name="core_telem_machine_ts_idx"),
+        ),
+    ]
@@ -0,0 +1,64 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0065_machinetelemetry_machine_ts_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MachineTelemetryRollup",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("machine_id", models.CharField(max_length=50)),
+                (
+                    "resolution",
+                    models.CharField(
+                        choices=[("minute", "Minute"), ("hour", "Hour"), ("day", "Day")],
+                        max_length=10,
+                    ),
+                ),
+                ("bucket_start", models.DateTimeField()),
+                ("sample_count", models.PositiveIntegerField(default=0)),
+                ("ppm_min", models.FloatField()),
+                ("ppm_max", models.FloatField()),
+                ("ppm_avg", models.FloatField()),
+                ("temp_min", models.FloatField()),
+                ("temp_max", models.FloatField()),
+                ("temp_avg", models.FloatField()),
+                (
+                    "batch_delta",
+                    models.IntegerField(default=0, help_text="Packs counted in this bucket (counter resets handled)"),
+                ),
+                (
+                    "status_seconds",
+                    models.JSONField(
+                        blank=True,
+                        default=dict,
+                        help_text="Seconds spent in each status, e.g. {'RUNNING': 3540}",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["machine_id", "resolution", "bucket_start"],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="machinetelemetryrollup",
+            constraint=models.UniqueConstraint(
+                fields=("machine_id", "resolution", "bucket_start"),
+                name="core_rollup_machine_res_bucket",
+            ),
+        ),
+        migrations.CreateModel(
+            name="TelemetryRollupMark",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("name", models.CharField(max_length=50, unique=True)),
+                ("position", models.DateTimeField()),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
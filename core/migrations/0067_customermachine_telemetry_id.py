@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0066_telemetry_rollups"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="customermachine",
+            name="telemetry_id",
+            field=models.CharField(
+                blank=True,
+                db_index=True,
+                help_text="machine_id sent by this machine's telemetry client (e.g. i6). Links live data to this customer.",
+                max_length=50,
+            ),
+        ),
+    ]
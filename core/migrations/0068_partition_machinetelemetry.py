@@ -0,0 +1,97 @@
+"""
+Convert core_machinetelemetry into a PostgreSQL table partitioned by month
+on created_at, so old data can be removed by dropping whole partitions
+(see core/partitions.py and the prune_telemetry command).
+
+PostgreSQL requires the partition key in the primary key, so the table's
+key becomes (id, created_at); ids still come from one sequence and stay
+unique, and Django keeps treating `id` as the primary key.
+
+Other databases (local SQLite) are left as a single table.
+"""
+
+from datetime import datetime, timezone
+
+from django.db import migrations
+
+TABLE = "core_machinetelemetry"
+OLD_TABLE = "core_machinetelemetry_unpartitioned"
+SEQUENCE = "core_machinetelemetry_part_id_seq"
+MONTHS_AHEAD = 2
+
+
+def _month_start(dt):
+    return dt.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(dt):
+    return dt.replace(year=dt.year + 1, month=1) if dt.month == 12 else dt.replace(month=dt.month + 1)
+
+
+def partition_table(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != "postgresql":
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {TABLE} RENAME TO {OLD_TABLE}")
+        cursor.execute(f"ALTER TABLE {OLD_TABLE} RENAME CONSTRAINT {TABLE}_pkey TO {OLD_TABLE}_pkey")
+        cursor.execute("ALTER INDEX core_telem_machine_ts_idx RENAME TO core_telem_machine_ts_idx_old")
+
+        cursor.execute(f"CREATE SEQUENCE {SEQUENCE}")
+        cursor.execute(
+            f"""
+            CREATE TABLE {TABLE} (
+                id bigint NOT NULL DEFAULT nextval('{SEQUENCE}'),
+                machine_id varchar(50) NOT NULL,
+                ppm double precision NOT NULL,
+                temp double precision NOT NULL,
+                batch_count integer NOT NULL,
+                status varchar(20) NOT NULL,
+                created_at timestamp with time zone NOT NULL,
+                CONSTRAINT {TABLE}_pkey PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at)
+            """
+        )
+        cursor.execute(f"ALTER SEQUENCE {SEQUENCE} OWNED BY {TABLE}.id")
+        cursor.execute(f"CREATE INDEX core_telem_machine_ts_idx ON {TABLE} (machine_id, created_at DESC)")
+
+        # Catches rows outside every monthly partition so ingest never fails.
+        cursor.execute(f"CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT")
+
+        cursor.execute(f"SELECT min(created_at) FROM {OLD_TABLE}")
+        first = cursor.fetchone()[0]
+        now = datetime.now(timezone.utc)
+        month = _month_start(first or now)
+        last = _month_start(now)
+        for _ in range(MONTHS_AHEAD):
+            last = _next_month(last)
+        while month <= last:
+            upper = _next_month(month)
+            cursor.execute(
+                f"CREATE TABLE {TABLE}_p{month:%Y_%m} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)",
+                [month, upper],
+            )
+            month = upper
+
+        cursor.execute(
+            f"""
+            INSERT INTO {TABLE} (id, machine_id, ppm, temp, batch_count, status, created_at)
+            SELECT id, machine_id, ppm, temp, batch_count, status, created_at FROM {OLD_TABLE}
+            """
+        )
+        cursor.execute(f"SELECT setval('{SEQUENCE}', COALESCE((SELECT max(id) FROM {TABLE}), 0) + 1, false)")
+        cursor.execute(f"DROP TABLE {OLD_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0067_customermachine_telemetry_id"),
+    ]
+
+    operations = [
+        # Irreversible in place, but the partitioned table behaves exactly like
+        # the plain one for Django, so reversing just leaves it partitioned.
+        migrations.RunPython(partition_table, migrations.RunPython.noop),
+    ]
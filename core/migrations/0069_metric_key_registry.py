@@ -0,0 +1,83 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def register_keys(apps, schema_editor):
+    MachineMetric = apps.get_model("core", "MachineMetric")
+    MetricKey = apps.get_model("core", "MetricKey")
+    for name, unit in MachineMetric.objects.values_list("metric_key", "unit").order_by("metric_key").distinct():
+        key, _ = MetricKey.objects.get_or_create(key=name, defaults={"unit": unit})
+        MachineMetric.objects.filter(metric_key=name, key__isnull=True).update(key=key)
+
+
+def restore_key_names(apps, schema_editor):
+    MachineMetric = apps.get_model("core", "MachineMetric")
+    MetricKey = apps.get_model("core", "MetricKey")
+    for key in MetricKey.objects.all():
+        MachineMetric.objects.filter(key=key).update(metric_key=key.key, unit=key.unit)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0068_partition_machinetelemetry"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MetricKey",
+            fields=[
+                ("id", models.SmallAutoField(primary_key=True, serialize=False)),
+                ("key", models.CharField(max_length=80, unique=True)),
+                ("unit", models.CharField(blank=True, max_length=20)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "ordering": ["key"],
+            },
+        ),
+        migrations.AddField(
+            model_name="machinemetric",
+            name="key",
+            field=models.ForeignKey(
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="+",
+                to="core.metrickey",
+            ),
+        ),
+        migrations.RunPython(register_keys, restore_key_names),
+        migrations.RemoveField(
+            model_name="machinemetric",
+            name="metric_key",
+        ),
+        migrations.RemoveField(
+            model_name="machinemetric",
+            name="unit",
+        ),
+        migrations.AlterField(
+            model_name="machinemetric",
+            name="key",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="+",
+                to="core.metrickey",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="machinemetric",
+            name="machine",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="metrics",
+                to="core.customermachine",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="machinemetric",
+            index=models.Index(fields=["machine", "key", "-timestamp"], name="core_metric_mach_key_ts_idx"),
+        ),
+    ]
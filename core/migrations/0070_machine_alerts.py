@@ -0,0 +1,63 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0069_metric_key_registry"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MachineAlertSettings",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("machine_id", models.CharField(help_text="Telemetry machine_id (e.g. i6)", max_length=50, unique=True)),
+                ("is_enabled", models.BooleanField(default=True)),
+                ("temp_min", models.FloatField(blank=True, help_text="Alert when seal temperature drops below this (°C)", null=True)),
+                ("temp_max", models.FloatField(blank=True, help_text="Alert when seal temperature rises above this (°C)", null=True)),
+                ("ppm_target", models.FloatField(blank=True, help_text="Alert when packs/min stays below this while RUNNING", null=True)),
+                ("ppm_grace_seconds", models.PositiveIntegerField(default=60, help_text="How long ppm must stay below target before alerting")),
+                ("stopped_seconds", models.PositiveIntegerField(blank=True, default=300, help_text="Alert when STOPPED for longer than this", null=True)),
+                ("batch_stall_seconds", models.PositiveIntegerField(blank=True, help_text="Alert when batch_count does not change for this long while RUNNING", null=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "verbose_name_plural": "Machine alert settings",
+            },
+        ),
+        migrations.CreateModel(
+            name="Alert",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("machine_id", models.CharField(max_length=50)),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("temp_out_of_band", "Temperature out of band"),
+                            ("ppm_below_target", "Packs/min below target"),
+                            ("stopped", "Stopped too long"),
+                            ("batch_stalled", "Batch count stalled"),
+                        ],
+                        max_length=30,
+                    ),
+                ),
+                ("message", models.CharField(max_length=200)),
+                ("value", models.FloatField(blank=True, null=True)),
+                ("raised_at", models.DateTimeField()),
+                ("cleared_at", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "ordering": ["-raised_at"],
+                "indexes": [models.Index(fields=["machine_id", "cleared_at"], name="core_alert_machine_open_idx")],
+                "constraints": [
+                    models.UniqueConstraint(
+                        condition=models.Q(("cleared_at__isnull", True)),
+                        fields=("machine_id", "kind"),
+                        name="core_alert_one_open_per_kind",
+                    )
+                ],
+            },
+        ),
+    ]
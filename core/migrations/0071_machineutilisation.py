@@ -0,0 +1,38 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0070_machine_alerts"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MachineUtilisation",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("machine_id", models.CharField(max_length=50)),
+                ("period", models.CharField(choices=[("shift", "Shift"), ("day", "Day")], max_length=10)),
+                ("name", models.CharField(blank=True, help_text="Shift name, blank for days", max_length=30)),
+                ("period_start", models.DateTimeField()),
+                ("period_end", models.DateTimeField()),
+                ("elapsed_seconds", models.FloatField(default=0, help_text="Period time covered so far (up to the rollup mark)")),
+                ("reporting_seconds", models.FloatField(default=0, help_text="Seconds the machine reported a status other than OFFLINE")),
+                ("running_seconds", models.FloatField(default=0)),
+                ("status_seconds", models.JSONField(blank=True, default=dict)),
+                ("packs", models.FloatField(default=0, help_text="Packs produced, estimated from ppm")),
+                ("ppm_target", models.FloatField(blank=True, help_text="Target ppm used for performance", null=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "ordering": ["machine_id", "period", "period_start"],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("machine_id", "period", "period_start"),
+                        name="core_util_machine_period_start",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+import core.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0071_machineutilisation"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MachineApiKey",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("key_id", models.CharField(default=core.models._new_api_key_id, max_length=32, unique=True)),
+                ("secret", models.CharField(default=core.models._new_api_key_secret, max_length=64)),
+                ("label", models.CharField(blank=True, max_length=80)),
+                ("is_active", models.BooleanField(default=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "machine",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="api_keys",
+                        to="core.customermachine",
+                    ),
+                ),
+            ],
+        ),
+    ]
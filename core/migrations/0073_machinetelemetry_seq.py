@@ -0,0 +1,37 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0072_machineapikey"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="machinetelemetry",
+            name="seq",
+            field=models.BigIntegerField(
+                blank=True,
+                help_text="Client's per-machine sequence number; makes resent samples duplicates that ingest skips.",
+                null=True,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="machinetelemetry",
+            name="created_at",
+            field=models.DateTimeField(
+                default=django.utils.timezone.now,
+                help_text="Device time of the sample, or arrival time if the client sent none.",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="machinetelemetry",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("seq__isnull", False)),
+                fields=("machine_id", "seq", "created_at"),
+                name="core_telem_machine_seq_uniq",
+            ),
+        ),
+    ]
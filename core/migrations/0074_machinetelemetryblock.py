@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0073_machinetelemetry_seq"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MachineTelemetryBlock",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("machine_id", models.CharField(max_length=50)),
+                ("hour_start", models.DateTimeField()),
+                ("sample_count", models.PositiveIntegerField(default=0)),
+                ("data", models.BinaryField()),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "ordering": ["machine_id", "hour_start"],
+                "constraints": [
+                    models.UniqueConstraint(fields=("machine_id", "hour_start"), name="core_telem_block_machine_hour"),
+                ],
+            },
+        ),
+    ]
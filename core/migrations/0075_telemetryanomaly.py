@@ -0,0 +1,48 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0074_machinetelemetryblock"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TelemetryAnomaly",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("machine_id", models.CharField(max_length=50)),
+                (
+                    "metric",
+                    models.CharField(choices=[("ppm", "Packs/min"), ("temp", "Seal temperature")], max_length=10),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("zscore", "Outlier (rolling z-score)"), ("change_point", "Level shift")],
+                        max_length=20,
+                    ),
+                ),
+                ("window_start", models.DateTimeField()),
+                ("window_end", models.DateTimeField()),
+                ("sample_count", models.PositiveIntegerField(default=0)),
+                (
+                    "score",
+                    models.FloatField(
+                        help_text="Peak |z| for outliers; shift in pooled standard deviations for level shifts"
+                    ),
+                ),
+                ("value", models.FloatField(help_text="Mean over the flagged samples (outliers) or after the shift")),
+                ("baseline", models.FloatField(help_text="Mean of the window before")),
+                ("detected_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "verbose_name_plural": "Telemetry anomalies",
+                "ordering": ["-window_start"],
+                "indexes": [
+                    models.Index(fields=["machine_id", "-window_start"], name="core_anomaly_machine_ts_idx"),
+                ],
+            },
+        ),
+    ]
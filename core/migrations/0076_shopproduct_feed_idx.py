@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0075_telemetryanomaly"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="shopproduct",
+            index=models.Index(
+                condition=models.Q(("is_active", True)),
+                fields=["sort_order", "name", "id"],
+                name="core_shopprod_feed_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,77 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def fill_facets(apps, schema_editor):
+    from core.facets import product_facets
+
+    ShopProduct = apps.get_model("core", "ShopProduct")
+    ShopProductFacet = apps.get_model("core", "ShopProductFacet")
+    rows = [
+        ShopProductFacet(product_id=pk, facet=f, value=v)
+        for pk, category, specifications in ShopProduct.objects.filter(is_active=True)
+        .values_list("id", "category", "specifications")
+        .iterator(chunk_size=2000)
+        for f, v in product_facets(category, specifications)
+    ]
+    ShopProductFacet.objects.bulk_create(rows, batch_size=2000)
+
+    ShopFacetCount = apps.get_model("core", "ShopFacetCount")
+    ShopFacetCount.objects.bulk_create(
+        ShopFacetCount(facet=facet, value=value, count=n)
+        for facet, value, n in ShopProductFacet.objects.values_list("facet", "value")
+        .annotate(n=models.Count("id"))
+        .order_by()
+    )
+    if schema_editor.connection.vendor == "postgresql":
+        # Give the planner row estimates for the freshly filled table straight away.
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute("ANALYZE core_shopproductfacet")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0078_shopproduct_search"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ShopProductFacet",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("facet", models.CharField(max_length=30)),
+                ("value", models.CharField(max_length=100)),
+                (
+                    "product",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="facet_values",
+                        to="core.shopproduct",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [models.Index(fields=["facet", "value", "product"], name="core_shopfacet_value_idx")],
+                "constraints": [
+                    models.UniqueConstraint(fields=("product", "facet", "value"), name="core_shopfacet_unique"),
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="ShopFacetCount",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("facet", models.CharField(max_length=30)),
+                ("value", models.CharField(max_length=100)),
+                ("count", models.IntegerField(default=0)),
+            ],
+            options={
+                "ordering": ["facet", "-count", "value"],
+                "constraints": [
+                    models.UniqueConstraint(fields=("facet", "value"), name="core_shopfacetcount_unique"),
+                ],
+            },
+        ),
+        migrations.RunPython(fill_facets, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,9 @@
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.utils import timezone
 import django.db.models.deletion
+import secrets
 # Cloudinary storage is used in production (Railway) but local dev machines may not have
 # Cloudinary credentials configured. If Cloudinary isn't configured, importing the storage
 # backend raises ImproperlyConfigured and Django management commands fail.
@@ -515,6 +517,14 @@ class ShopProduct(models.Model):
 
     class Meta:
         ordering = ["sort_order", "name"]
+        indexes = [
+            # Keyset pagination of the product feed (api_products).
+            models.Index(
+                fields=["sort_order", "name", "id"],
+                condition=models.Q(is_active=True),
+                name="core_shopprod_feed_idx",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.name}"
@@ -533,6 +543,63 @@ class ShopProduct(models.Model):
         super().save(*args, **kwargs)
 
 
+class CatalogueVersion(models.Model):
+    """
+    Singleton (pk=1) counter bumped whenever the shop catalogue changes, i.e.
+    on every ShopProduct, MachineProduct or SiteConfiguration save/delete
+    (core/signals.py). Keys the cached product feed and its ETags
+    (core/catalogue.py) and the search suggestion index (core/suggest.py).
+    """
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Catalogue v{self.version}"
+
+
+class ShopProductFacet(models.Model):
+    """
+    One facet value (category, or a specifications key such as material) of
+    an active ShopProduct, kept in step on save (core/facets.py) so the shop
+    can narrow and count products without reading their JSON.
+    """
+    product = models.ForeignKey(ShopProduct, on_delete=models.CASCADE, related_name="facet_values")
+    facet = models.CharField(max_length=30)
+    value = models.CharField(max_length=100)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["product", "facet", "value"], name="core_shopfacet_unique"),
+        ]
+        indexes = [
+            # Narrowing (facet, value -> products) and counting, from the index alone.
+            models.Index(fields=["facet", "value", "product"], name="core_shopfacet_value_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.facet}={self.value}"
+
+
+class ShopFacetCount(models.Model):
+    """
+    Number of active products with each facet value, kept up to date as
+    ShopProductFacet rows come and go, so the shop's unfiltered facet
+    counts are a read of a few dozen rows.
+    """
+    facet = models.CharField(max_length=30)
+    value = models.CharField(max_length=100)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ["facet", "-count", "value"]
+        constraints = [
+            models.UniqueConstraint(fields=["facet", "value"], name="core_shopfacetcount_unique"),
+        ]
+
+    def __str__(self):
+        return f"{self.facet}={self.value} ({self.count})"
+
+
 class CustomerContact(models.Model):
     """Reusable contact record for checkout + enquiries."""
     user = models.ForeignKey(
@@ -698,6 +765,12 @@ class CustomerMachine(models.Model):
     name = models.CharField(max_length=140)
     machine_type = models.CharField(max_length=30, default="tray_sealer")
     serial_number = models.CharField(max_length=80, blank=True)
+    telemetry_id = models.CharField(
+        max_length=50,
+        blank=True,
+        db_index=True,
+        help_text="machine_id sent by this machine's telemetry client (e.g. i6). Links live data to this customer.",
+    )
     notes = models.TextField(blank=True)
     is_active = models.BooleanField(default=True)
 
@@ -705,6 +778,32 @@ class CustomerMachine(models.Model):
         return f"{self.name}"
 
 
+def _new_api_key_id():
+    return secrets.token_hex(8)
+
+
+def _new_api_key_secret():
+    return secrets.token_urlsafe(32)
+
+
+class MachineApiKey(models.Model):
+    """
+    Ingest credential for one CustomerMachine. The machine's client sends
+    key_id and signs each request body with secret (HMAC-SHA256, see
+    core/ingest_auth.py); it may only send data for the machine's
+    telemetry_id. Untick is_active to revoke.
+    """
+    machine = models.ForeignKey(CustomerMachine, on_delete=models.CASCADE, related_name="api_keys")
+    key_id = models.CharField(max_length=32, unique=True, default=_new_api_key_id)
+    secret = models.CharField(max_length=64, default=_new_api_key_secret)
+    label = models.CharField(max_length=80, blank=True)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.machine} ({self.key_id})"
+
+
 class CustomerDocument(models.Model):
     customer = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="customer_documents")
     title = models.CharField(max_length=160)
@@ -717,32 +816,328 @@ class CustomerDocument(models.Model):
         return self.title
 
 
+class MetricKey(models.Model):
+    """
+    Registry of metric names sent to the generic metrics ingest API
+    (e.g. film_tension, seal_pressure). Each name gets a small integer id so
+    MachineMetric rows stay narrow; new names are registered on first use.
+    """
+    id = models.SmallAutoField(primary_key=True)
+    key = models.CharField(max_length=80, unique=True)
+    unit = models.CharField(max_length=20, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["key"]
+
+    def __str__(self):
+        return f"{self.key} ({self.unit})" if self.unit else self.key
+
+
 class MachineMetric(models.Model):
-    machine = models.ForeignKey("core.CustomerMachine", on_delete=models.CASCADE, related_name="metrics")
-    metric_key = models.CharField(max_length=80)
+    machine = models.ForeignKey("core.CustomerMachine", on_delete=models.CASCADE, related_name="metrics", db_index=False)
+    key = models.ForeignKey("core.MetricKey", on_delete=models.PROTECT, related_name="+", db_index=False)
     value = models.FloatField()
-    unit = models.CharField(max_length=20, blank=True)
     timestamp = models.DateTimeField()
 
     class Meta:
         ordering = ["-timestamp"]
+        indexes = [
+            # One machine's series for one key over a time range; also covers
+            # lookups by machine alone, so the FK columns need no own index.
+            models.Index(fields=["machine", "key", "-timestamp"], name="core_metric_mach_key_ts_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.machine_id} {self.key_id}={self.value} @ {self.timestamp}"
 
 
 class MachineTelemetry(models.Model):
+    # On PostgreSQL this table is partitioned by month on created_at
+    # (migration 0068, core/partitions.py).
     machine_id = models.CharField(max_length=50)
     ppm = models.FloatField()
     temp = models.FloatField()
     batch_count = models.IntegerField()
     status = models.CharField(max_length=20)
-    created_at = models.DateTimeField(auto_now_add=True)
+    seq = models.BigIntegerField(
+        null=True,
+        blank=True,
+        help_text="Client's per-machine sequence number; makes resent samples duplicates that ingest skips.",
+    )
+    created_at = models.DateTimeField(
+        default=timezone.now,
+        help_text="Device time of the sample, or arrival time if the client sent none.",
+    )
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            # Serves "latest sample for a machine" and per-machine time ranges
+            # without sorting the whole table.
+            models.Index(fields=["machine_id", "-created_at"], name="core_telem_machine_ts_idx"),
+        ]
+        constraints = [
+            # A partitioned PostgreSQL table only allows unique indexes that
+            # contain the partition key, hence created_at. A resent sample
+            # carries the same device time, so it still collides.
+            models.UniqueConstraint(
+                fields=["machine_id", "seq", "created_at"],
+                condition=models.Q(seq__isnull=False),
+                name="core_telem_machine_seq_uniq",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.machine_id} - {self.created_at}"
 
 
+class MachineTelemetryBlock(models.Model):
+    """
+    Raw MachineTelemetry of one machine over one hour, compressed into a
+    single row (core/blocks.py). Written by the `compact_telemetry`
+    management command for data old enough to be read rarely.
+    """
+    machine_id = models.CharField(max_length=50)
+    hour_start = models.DateTimeField()
+    sample_count = models.PositiveIntegerField(default=0)
+    data = models.BinaryField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["machine_id", "hour_start"]
+        constraints = [
+            models.UniqueConstraint(fields=["machine_id", "hour_start"], name="core_telem_block_machine_hour"),
+        ]
+
+    def __str__(self):
+        return f"{self.machine_id} block @ {self.hour_start}"
+
+
+class MachineTelemetryRollup(models.Model):
+    """
+    Aggregated MachineTelemetry for one machine over one minute, hour or day.
+    Built incrementally by the `rollup_telemetry` management command.
+    """
+    RESOLUTION_MINUTE = "minute"
+    RESOLUTION_HOUR = "hour"
+    RESOLUTION_DAY = "day"
+    RESOLUTION_CHOICES = [
+        (RESOLUTION_MINUTE, "Minute"),
+        (RESOLUTION_HOUR, "Hour"),
+        (RESOLUTION_DAY, "Day"),
+    ]
+    RESOLUTION_SECONDS = {
+        RESOLUTION_MINUTE: 60,
+        RESOLUTION_HOUR: 3600,
+        RESOLUTION_DAY: 86400,
+    }
+
+    machine_id = models.CharField(max_length=50)
+    resolution = models.CharField(max_length=10, choices=RESOLUTION_CHOICES)
+    bucket_start = models.DateTimeField()
+
+    sample_count = models.PositiveIntegerField(default=0)
+    ppm_min = models.FloatField()
+    ppm_max = models.FloatField()
+    ppm_avg = models.FloatField()
+    temp_min = models.FloatField()
+    temp_max = models.FloatField()
+    temp_avg = models.FloatField()
+    batch_delta = models.IntegerField(default=0, help_text="Packs counted in this bucket (counter resets handled)")
+    status_seconds = models.JSONField(default=dict, blank=True, help_text="Seconds spent in each status, e.g. {'RUNNING': 3540}")
+
+    class Meta:
+        ordering = ["machine_id", "resolution", "bucket_start"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["machine_id", "resolution", "bucket_start"],
+                name="core_rollup_machine_res_bucket",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.machine_id} {self.resolution} @ {self.bucket_start}"
+
+
+class TelemetryRollupMark(models.Model):
+    """High-water mark for incremental jobs over MachineTelemetry (one row per job name)."""
+    name = models.CharField(max_length=50, unique=True)
+    position = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.position}"
+
+
+class MachineUtilisation(models.Model):
+    """
+    Utilisation and OEE inputs for one machine over one shift or calendar
+    day, rebuilt from the rollups by the `rollup_telemetry` command so
+    readers never scan raw telemetry. Ratios are derived from the stored
+    seconds and pack counts.
+    """
+    PERIOD_SHIFT = "shift"
+    PERIOD_DAY = "day"
+    PERIOD_CHOICES = [
+        (PERIOD_SHIFT, "Shift"),
+        (PERIOD_DAY, "Day"),
+    ]
+
+    machine_id = models.CharField(max_length=50)
+    period = models.CharField(max_length=10, choices=PERIOD_CHOICES)
+    name = models.CharField(max_length=30, blank=True, help_text="Shift name, blank for days")
+    period_start = models.DateTimeField()
+    period_end = models.DateTimeField()
+
+    elapsed_seconds = models.FloatField(default=0, help_text="Period time covered so far (up to the rollup mark)")
+    reporting_seconds = models.FloatField(default=0, help_text="Seconds the machine reported a status other than OFFLINE")
+    running_seconds = models.FloatField(default=0)
+    status_seconds = models.JSONField(default=dict, blank=True)
+    packs = models.FloatField(default=0, help_text="Packs produced, estimated from ppm")
+    ppm_target = models.FloatField(null=True, blank=True, help_text="Target ppm used for performance")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["machine_id", "period", "period_start"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["machine_id", "period", "period_start"],
+                name="core_util_machine_period_start",
+            ),
+        ]
+
+    @property
+    def utilisation(self):
+        """Share of elapsed calendar time spent RUNNING."""
+        return self.running_seconds / self.elapsed_seconds if self.elapsed_seconds else None
+
+    @property
+    def availability(self):
+        """Share of reporting (powered-on) time spent RUNNING."""
+        return self.running_seconds / self.reporting_seconds if self.reporting_seconds else None
+
+    @property
+    def performance(self):
+        """Packs produced against what the target ppm would give over the running time."""
+        if not self.ppm_target or not self.running_seconds:
+            return None
+        return self.packs / (self.ppm_target * self.running_seconds / 60)
+
+    @property
+    def oee(self):
+        """Availability x performance (quality is not measured, so taken as 100%)."""
+        if self.availability is None or self.performance is None:
+            return None
+        return self.availability * min(self.performance, 1.0)
+
+    def __str__(self):
+        return f"{self.machine_id} {self.period} {self.name} @ {self.period_start}".replace("  ", " ")
+
+
+class MachineAlertSettings(models.Model):
+    """
+    Alert thresholds for one telemetry machine_id. Leave a threshold empty
+    to disable that rule. Machines without a row use the field defaults.
+    """
+    machine_id = models.CharField(max_length=50, unique=True, help_text="Telemetry machine_id (e.g. i6)")
+    is_enabled = models.BooleanField(default=True)
+    temp_min = models.FloatField(null=True, blank=True, help_text="Alert when seal temperature drops below this (°C)")
+    temp_max = models.FloatField(null=True, blank=True, help_text="Alert when seal temperature rises above this (°C)")
+    ppm_target = models.FloatField(null=True, blank=True, help_text="Alert when packs/min stays below this while RUNNING")
+    ppm_grace_seconds = models.PositiveIntegerField(default=60, help_text="How long ppm must stay below target before alerting")
+    stopped_seconds = models.PositiveIntegerField(null=True, blank=True, default=300, help_text="Alert when STOPPED for longer than this")
+    batch_stall_seconds = models.PositiveIntegerField(null=True, blank=True, help_text="Alert when batch_count does not change for this long while RUNNING")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "Machine alert settings"
+
+    def __str__(self):
+        return f"Alert settings for {self.machine_id}"
+
+
+class Alert(models.Model):
+    """One alert episode for a machine: raised when a rule starts failing, cleared when it recovers."""
+    KIND_TEMP = "temp_out_of_band"
+    KIND_PPM_LOW = "ppm_below_target"
+    KIND_STOPPED = "stopped"
+    KIND_BATCH_STALLED = "batch_stalled"
+    KIND_CHOICES = [
+        (KIND_TEMP, "Temperature out of band"),
+        (KIND_PPM_LOW, "Packs/min below target"),
+        (KIND_STOPPED, "Stopped too long"),
+        (KIND_BATCH_STALLED, "Batch count stalled"),
+    ]
+
+    machine_id = models.CharField(max_length=50)
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES)
+    message = models.CharField(max_length=200)
+    value = models.FloatField(null=True, blank=True)
+    raised_at = models.DateTimeField()
+    cleared_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-raised_at"]
+        indexes = [
+            models.Index(fields=["machine_id", "cleared_at"], name="core_alert_machine_open_idx"),
+        ]
+        constraints = [
+            # At most one open alert per machine and rule, even with several
+            # worker processes evaluating the same machine.
+            models.UniqueConstraint(
+                fields=["machine_id", "kind"],
+                condition=models.Q(cleared_at__isnull=True),
+                name="core_alert_one_open_per_kind",
+            ),
+        ]
+
+    @property
+    def is_active(self):
+        return self.cleared_at is None
+
+    def __str__(self):
+        return f"{self.machine_id}: {self.get_kind_display()} @ {self.raised_at}"
+
+
+class TelemetryAnomaly(models.Model):
+    """
+    A stretch of one machine's ppm or temp series flagged by the
+    `detect_anomalies` management command (core/anomalies.py).
+    """
+    KIND_ZSCORE = "zscore"
+    KIND_CHANGE_POINT = "change_point"
+    KIND_CHOICES = [
+        (KIND_ZSCORE, "Outlier (rolling z-score)"),
+        (KIND_CHANGE_POINT, "Level shift"),
+    ]
+    METRIC_CHOICES = [
+        ("ppm", "Packs/min"),
+        ("temp", "Seal temperature"),
+    ]
+
+    machine_id = models.CharField(max_length=50)
+    metric = models.CharField(max_length=10, choices=METRIC_CHOICES)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    window_start = models.DateTimeField()
+    window_end = models.DateTimeField()
+    sample_count = models.PositiveIntegerField(default=0)
+    score = models.FloatField(help_text="Peak |z| for outliers; shift in pooled standard deviations for level shifts")
+    value = models.FloatField(help_text="Mean over the flagged samples (outliers) or after the shift")
+    baseline = models.FloatField(help_text="Mean of the window before")
+    detected_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["-window_start"]
+        verbose_name_plural = "Telemetry anomalies"
+        indexes = [
+            models.Index(fields=["machine_id", "-window_start"], name="core_anomaly_machine_ts_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.machine_id} {self.metric} {self.get_kind_display()} @ {self.window_start}"
+
+
 class Distributor(models.Model):
     country_name = models.CharField(max_length=100)
     flag_code = models.CharField(max_length=5)
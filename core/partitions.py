@@ -0,0 +1,168 @@
+"""
+Time-based storage and retention for MachineTelemetry.
+
+On PostgreSQL the table is partitioned by month on created_at (migration
+0068): one partition per calendar month plus a DEFAULT partition for
+anything outside them. Retention drops whole monthly partitions, which is
+instant and leaves no dead rows to vacuum. Rows older than the cutoff that
+sit in a partially expired month (or in the default partition) are deleted
+in bounded primary-key batches.
+
+On other databases (local SQLite) the table is a single table and
+retention uses the bounded batched delete only.
+"""
+
+import logging
+import re
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import OperationalError, connection, transaction
+
+from .blocks import delete_blocks_before
+from .models import MachineTelemetry
+
+TABLE = MachineTelemetry._meta.db_table
+DEFAULT_PARTITION = f"{TABLE}_default"
+MONTHS_AHEAD = 2
+DELETE_BATCH_SIZE = 5000
+# How long DETACH PARTITION may wait for its lock. The ACCESS EXCLUSIVE
+# request queues every later reader and insert behind it, so it gives up
+# quickly rather than stalling ingest behind a long query.
+DETACH_LOCK_TIMEOUT = "5s"
+
+logger = logging.getLogger(__name__)
+
+_PARTITION_RE = re.compile(rf"^{TABLE}_p(\d{{4}})_(\d{{2}})$")
+
+
+def month_start(dt: datetime) -> datetime:
+    return dt.astimezone(dt_timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(dt: datetime) -> datetime:
+    return dt.replace(year=dt.year + 1, month=1) if dt.month == 12 else dt.replace(month=dt.month + 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f"{TABLE}_p{month:%Y_%m}"
+
+
+def is_partitioned() -> bool:
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = %s",
+            [TABLE],
+        )
+        return cursor.fetchone() is not None
+
+
+def list_partitions() -> list:
+    """Monthly partitions as (name, month_start), oldest first."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = %s
+            """,
+            [TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+
+    out = []
+    for name in names:
+        m = _PARTITION_RE.match(name)
+        if m:
+            out.append((name, datetime(int(m.group(1)), int(m.group(2)), 1, tzinfo=dt_timezone.utc)))
+    return sorted(out, key=lambda p: p[1])
+
+
+def ensure_partitions(now=None, months_ahead: int = MONTHS_AHEAD) -> list:
+    """
+    Create monthly partitions from the current month up to `months_ahead`
+    months ahead. Rows for a new month that already landed in the default
+    partition are moved into it. Returns the names created.
+    """
+    if not is_partitioned():
+        return []
+
+    existing = {name for name, _ in list_partitions()}
+    month = month_start(now or datetime.now(dt_timezone.utc))
+    created = []
+    for _ in range(months_ahead + 1):
+        upper = next_month(month)
+        name = partition_name(month)
+        if name not in existing:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)")
+                cursor.execute(
+                    f"""
+                    WITH moved AS (
+                        DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s RETURNING *
+                    )
+                    INSERT INTO {name} SELECT * FROM moved
+                    """,
+                    [month, upper],
+                )
+                cursor.execute(
+                    f"ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)",
+                    [month, upper],
+                )
+            created.append(name)
+        month = upper
+    return created
+
+
+def drop_partitions_before(cutoff: datetime) -> list:
+    """Drop monthly partitions whose whole month is before `cutoff`. Returns the names dropped."""
+    if not is_partitioned():
+        return []
+
+    dropped = []
+    for name, month in list_partitions():
+        if next_month(month) > cutoff:
+            break
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute("SELECT set_config('lock_timeout', %s, true)", [DETACH_LOCK_TIMEOUT])
+                cursor.execute(f"ALTER TABLE {TABLE} DETACH PARTITION {name}")
+                cursor.execute(f"DROP TABLE {name}")
+        except OperationalError as e:
+            # Busy; its rows are left to the batched delete and the next run retries the drop.
+            logger.warning("Could not detach partition %s: %s", name, e)
+            break
+        dropped.append(name)
+    return dropped
+
+
+def delete_before(cutoff: datetime, batch_size: int = DELETE_BATCH_SIZE) -> int:
+    """
+    Delete rows older than `cutoff` in primary-key batches of `batch_size`,
+    one short transaction per batch, so the table is never locked for long
+    and rows are never loaded as model instances.
+    """
+    deleted = 0
+    while True:
+        ids = list(
+            MachineTelemetry.objects.filter(created_at__lt=cutoff)
+            .order_by("id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        if not ids:
+            return deleted
+        count, _ = MachineTelemetry.objects.filter(id__in=ids, created_at__lt=cutoff).delete()
+        deleted += count
+
+
+def prune_telemetry(cutoff: datetime, batch_size: int = DELETE_BATCH_SIZE) -> dict:
+    """
+    Apply the retention policy: drop expired partitions, delete the remainder
+    in batches, and delete compacted blocks that are wholly expired.
+    """
+    dropped = drop_partitions_before(cutoff)
+    deleted = delete_before(cutoff, batch_size=batch_size)
+    blocks = delete_blocks_before(cutoff)
+    return {"dropped_partitions": dropped, "deleted_rows": deleted, "deleted_blocks": blocks}
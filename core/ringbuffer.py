@@ -0,0 +1,279 @@
+"""
+Recent telemetry per machine in a memory-mapped ring buffer.
+
+Live charts only need the last few minutes, so ingest also appends every
+sample to a fixed-size ring per machine_id, and the live API reads a slice
+of it instead of querying MachineTelemetry. The rings live in one file
+(TELEMETRY_RING_PATH) mapped with MAP_SHARED, so every worker process on
+the node writes and reads the same memory.
+
+File layout (little-endian):
+
+    header     64 bytes    magic b"MPERING2", slots (u4), capacity (u4)
+    directory  slots x 72  machine_id (UTF-8, NUL-padded, 56 bytes),
+                           head (u8, samples ever written to the slot),
+                           updated (f8, epoch seconds of the last append)
+    samples    slots x capacity x _SAMPLE_DTYPE
+
+Only machines with an active CustomerMachine (by telemetry_id) are
+buffered, since the live API serves nothing else; machine_ids are chosen
+by the client and must not be able to claim slots. A machine takes a free
+slot on its first sample. When none is free it takes the least recently
+updated slot, provided that one has been idle for EVICT_IDLE_SECONDS;
+otherwise the machine is not buffered and the live API falls back to the
+database. Writers hold an exclusive flock
+on the file, readers a shared one (no locking where fcntl is missing,
+i.e. single-process development on Windows). The file is rebuilt from
+scratch if it does not match the configured slots/capacity, so all
+workers must share those settings.
+"""
+
+import contextlib
+import logging
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from . import telemetry
+from .models import CustomerMachine
+
+logger = logging.getLogger(__name__)
+
+RING_MAGIC = b"MPERING2"
+_HEADER = struct.Struct("<8sII")
+_HEADER_BYTES = 64
+_SLOT_DTYPE = np.dtype([("machine_id", "S56"), ("head", "<u8"), ("updated", "<f8")])
+_SAMPLE_DTYPE = np.dtype(
+    [("ts", "<f8"), ("ppm", "<f4"), ("temp", "<f4"), ("batch_count", "<i4"), ("status", "u1")], align=True
+)
+UNKNOWN_STATUS = 255
+# A slot idle this long may be taken over by another machine when none is free.
+EVICT_IDLE_SECONDS = 600
+# How long a process trusts its list of known machine_ids.
+KNOWN_IDS_SECONDS = 60
+
+
+class RingBuffer:
+    def __init__(self, path: str, slots: int, capacity: int):
+        self.path = path
+        self.slots = slots
+        self.capacity = capacity
+        self._slot_of = {}
+        self._status_index = {status: i for i, status in enumerate(telemetry.STATUS_CODES)}
+        self._lock_pid = None
+        self._lock_fd = None
+        self._thread_lock = threading.Lock()
+
+        size = _HEADER_BYTES + slots * _SLOT_DTYPE.itemsize + slots * capacity * _SAMPLE_DTYPE.itemsize
+        with self._locked(exclusive=True):
+            self._prepare_file(size)
+        self._map = np.memmap(path, dtype=np.uint8, mode="r+", shape=(size,))
+        directory_end = _HEADER_BYTES + slots * _SLOT_DTYPE.itemsize
+        self._directory = self._map[_HEADER_BYTES:directory_end].view(_SLOT_DTYPE)
+        self._samples = self._map[directory_end:].view(_SAMPLE_DTYPE).reshape(slots, capacity)
+
+    def _prepare_file(self, size: int) -> None:
+        header = _HEADER.pack(RING_MAGIC, self.slots, self.capacity)
+        with os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600), "r+b") as f:
+            f.seek(0)
+            if f.read(_HEADER.size) == header and os.fstat(f.fileno()).st_size == size:
+                return
+            logger.info("Initialising telemetry ring buffer %s (%d slots x %d samples)", self.path, self.slots, self.capacity)
+            f.truncate(0)
+            f.truncate(size)
+            f.seek(0)
+            f.write(header)
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive: bool):
+        # flock() excludes other processes only: threads of this process share
+        # the descriptor, hence the thread lock as well.
+        with self._thread_lock:
+            if fcntl is None:
+                yield
+                return
+            # A flock belongs to the open file description, which a forked
+            # worker would share with its parent, so each process opens its own.
+            if self._lock_pid != os.getpid():
+                self._lock_fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                self._lock_pid = os.getpid()
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _slot(self, machine_id: str, create: bool):
+        name = machine_id.encode("utf-8")
+        if len(name) > _SLOT_DTYPE["machine_id"].itemsize:
+            return None
+        names = self._directory["machine_id"]
+        slot = self._slot_of.get(machine_id)
+        # Another process may have evicted or released the slot since.
+        if slot is not None and names[slot] == name:
+            return slot
+        self._slot_of.pop(machine_id, None)
+        found = np.flatnonzero(names == name)
+        if found.size:
+            slot = int(found[0])
+        elif create:
+            free = np.flatnonzero(names == b"")
+            if free.size:
+                slot = int(free[0])
+            else:
+                slot = int(np.argmin(self._directory["updated"]))
+                if self._directory["updated"][slot] > time.time() - EVICT_IDLE_SECONDS:
+                    return None
+                logger.info("Telemetry ring slot %d passes from %s to %s", slot, names[slot].decode("utf-8", "replace"), machine_id)
+            self._directory[slot] = (name, 0, time.time())
+        else:
+            return None
+        self._slot_of[machine_id] = slot
+        return slot
+
+    def release(self, machine_ids) -> int:
+        """Free the slots of `machine_ids`. Returns the number freed."""
+        freed = 0
+        with self._locked(exclusive=True):
+            for machine_id in machine_ids:
+                slot = self._slot(machine_id, create=False)
+                if slot is not None:
+                    self._directory[slot] = (b"", 0, 0.0)
+                    self._slot_of.pop(machine_id, None)
+                    freed += 1
+        return freed
+
+    def append(self, rows) -> None:
+        """Append saved MachineTelemetry rows (arrival order) to their machines' rings."""
+        by_machine = {}
+        for row in rows:
+            by_machine.setdefault(row.machine_id, []).append(row)
+
+        now = time.time()
+        with self._locked(exclusive=True):
+            for machine_id, items in by_machine.items():
+                slot = self._slot(machine_id, create=True)
+                if slot is None:
+                    continue
+                items = items[-self.capacity:]
+                block = np.array(
+                    [
+                        (
+                            r.created_at.timestamp(),
+                            r.ppm,
+                            r.temp,
+                            r.batch_count,
+                            self._status_index.get(r.status, UNKNOWN_STATUS),
+                        )
+                        for r in items
+                    ],
+                    dtype=_SAMPLE_DTYPE,
+                )
+                head = int(self._directory["head"][slot])
+                self._samples[slot, (head + np.arange(len(block))) % self.capacity] = block
+                self._directory["head"][slot] = head + len(block)
+                self._directory["updated"][slot] = now
+
+    def recent(self, machine_id: str, since: float = None):
+        """
+        Copy of the buffered samples of `machine_id` (by ts, oldest first) as a
+        structured array, optionally only those with ts >= `since` (epoch
+        seconds). None if the machine has no ring.
+        """
+        with self._locked(exclusive=False):
+            slot = self._slot(machine_id, create=False)
+            if slot is None:
+                return None
+            head = int(self._directory["head"][slot])
+            start = head % self.capacity
+            ring = self._samples[slot]
+            if head <= self.capacity:
+                out = ring[:head].copy()
+            else:
+                out = np.concatenate((ring[start:], ring[:start]))
+        # Arrival order; late (replayed) samples are put back in time order.
+        out = out[np.argsort(out["ts"], kind="stable")]
+        if since is not None:
+            out = out[out["ts"] >= since]
+        return out
+
+
+_ring = None
+_ring_failed = False
+_ring_lock = threading.Lock()
+_known = (frozenset(), 0.0)  # (telemetry_ids, expires_at)
+
+
+def get_ring():
+    """The process's RingBuffer, or None if it is disabled or could not be opened."""
+    global _ring, _ring_failed
+    if _ring is None and not _ring_failed:
+        with _ring_lock:
+            if _ring is None and not _ring_failed:
+                path = getattr(settings, "TELEMETRY_RING_PATH", "")
+                if not path:
+                    _ring_failed = True
+                    return None
+                try:
+                    _ring = RingBuffer(path, settings.TELEMETRY_RING_SLOTS, settings.TELEMETRY_RING_SAMPLES)
+                except Exception as e:
+                    logger.exception("Telemetry ring buffer unavailable: %s", e)
+                    _ring_failed = True
+    return _ring
+
+
+def known_machine_ids() -> frozenset:
+    """telemetry_ids of active CustomerMachines, cached per process for KNOWN_IDS_SECONDS."""
+    global _known
+    ids, expires = _known
+    if expires <= time.monotonic():
+        ids = frozenset(
+            CustomerMachine.objects.filter(is_active=True).exclude(telemetry_id="").values_list("telemetry_id", flat=True)
+        )
+        _known = (ids, time.monotonic() + KNOWN_IDS_SECONDS)
+    return ids
+
+
+def forget_known_machines() -> None:
+    """Reload known_machine_ids() on next use (CustomerMachine changed, core/signals.py)."""
+    global _known
+    _known = (frozenset(), 0.0)
+
+
+def append(rows) -> None:
+    """Buffer freshly saved rows of known machines. Never raises: a failure here must not fail ingest."""
+    ring = get_ring()
+    if ring is None or not rows:
+        return
+    try:
+        known = known_machine_ids()
+        rows = [r for r in rows if r.machine_id in known]
+        if rows:
+            ring.append(rows)
+    except Exception as e:
+        logger.exception("Telemetry ring buffer append failed: %s", e)
+
+
+def release(machine_ids) -> int:
+    """Free the ring slots of `machine_ids` (e.g. after a load test). Returns the number freed."""
+    ring = get_ring()
+    return 0 if ring is None else ring.release(machine_ids)
+
+
+def recent(machine_id: str, since: float = None):
+    """RingBuffer.recent() on the shared ring; None if there is no ring or no slot for the machine."""
+    ring = get_ring()
+    return None if ring is None else ring.recent(machine_id, since)
+
+
+def status_name(code: int):
+    return telemetry.STATUS_CODES[code] if code < len(telemetry.STATUS_CODES) else None
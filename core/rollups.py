@@ -0,0 +1,402 @@
+"""
+Telemetry rollups: per-minute, per-hour and per-day aggregates of
+MachineTelemetry, plus the read helper that picks a resolution for a range.
+
+Rollups are rebuilt bucket-by-bucket from the level below (raw -> minute ->
+hour -> day). Rebuilding a bucket replaces it completely, so running the
+job twice over the same range gives the same result.
+"""
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import transaction
+from django.db.models import Avg, Max, Min
+from django.db.models.functions import TruncDay, TruncHour, TruncMinute
+from django.utils import timezone
+
+from .blocks import get_compact_mark, iter_samples
+from .models import MachineTelemetry, MachineTelemetryRollup, TelemetryRollupMark
+from .utilisation import build_utilisation
+
+ROLLUP_MARK_NAME = "rollup_telemetry"
+# Earliest minute that received samples after it was rolled up (device
+# timestamps from a store-and-forward replay); run_rollups() redoes it.
+REDO_MARK_NAME = "rollup_telemetry:redo"
+# run_rollups() stays at least this far behind now, so only samples older
+# than this can land behind the high-water mark.
+ROLLUP_LAG = timedelta(seconds=60)
+
+# A gap longer than this between two samples is treated as "no data"
+# (machine or client offline) rather than time spent in the last status.
+MAX_SAMPLE_GAP = timedelta(seconds=60)
+
+MINUTE = MachineTelemetryRollup.RESOLUTION_MINUTE
+HOUR = MachineTelemetryRollup.RESOLUTION_HOUR
+DAY = MachineTelemetryRollup.RESOLUTION_DAY
+
+# Finest first; raw samples are nominally one per second.
+RESOLUTIONS = [
+    ("raw", timedelta(seconds=1)),
+    (MINUTE, timedelta(minutes=1)),
+    (HOUR, timedelta(hours=1)),
+    (DAY, timedelta(days=1)),
+]
+
+_TRUNC = {MINUTE: TruncMinute, HOUR: TruncHour, DAY: TruncDay}
+
+
+def floor_time(ts: datetime, resolution: str) -> datetime:
+    """Start of the UTC bucket containing `ts`."""
+    ts = ts.astimezone(dt_timezone.utc)
+    if resolution == MINUTE:
+        return ts.replace(second=0, microsecond=0)
+    if resolution == HOUR:
+        return ts.replace(minute=0, second=0, microsecond=0)
+    if resolution == DAY:
+        return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError(f"Unknown resolution: {resolution}")
+
+
+def _ceil_time(ts: datetime, resolution: str) -> datetime:
+    start = floor_time(ts, resolution)
+    if start == ts:
+        return start
+    return start + timedelta(seconds=MachineTelemetryRollup.RESOLUTION_SECONDS[resolution])
+
+
+# -----------------------------------------------------------------------------
+# Building
+# -----------------------------------------------------------------------------
+
+class _Bucket:
+    __slots__ = ("count", "ppm_min", "ppm_max", "ppm_sum", "temp_min", "temp_max", "temp_sum", "batch_delta", "status_seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.ppm_min = self.ppm_max = None
+        self.temp_min = self.temp_max = None
+        self.ppm_sum = self.temp_sum = 0.0
+        self.batch_delta = 0
+        self.status_seconds = {}
+
+    def add_status(self, status: str, seconds: float):
+        if seconds > 0:
+            self.status_seconds[status] = self.status_seconds.get(status, 0) + seconds
+
+    def as_row(self, machine_id: str, resolution: str, bucket_start: datetime) -> MachineTelemetryRollup:
+        return MachineTelemetryRollup(
+            machine_id=machine_id,
+            resolution=resolution,
+            bucket_start=bucket_start,
+            sample_count=self.count,
+            ppm_min=self.ppm_min,
+            ppm_max=self.ppm_max,
+            ppm_avg=self.ppm_sum / self.count,
+            temp_min=self.temp_min,
+            temp_max=self.temp_max,
+            temp_avg=self.temp_sum / self.count,
+            batch_delta=self.batch_delta,
+            status_seconds={k: round(v, 1) for k, v in self.status_seconds.items()},
+        )
+
+
+def _replace_buckets(resolution: str, start: datetime, end: datetime, rows) -> int:
+    with transaction.atomic():
+        MachineTelemetryRollup.objects.filter(
+            resolution=resolution, bucket_start__gte=start, bucket_start__lt=end
+        ).delete()
+        MachineTelemetryRollup.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def build_minute_rollups(start: datetime, end: datetime) -> int:
+    """
+    Rebuild minute rollups for buckets in [start, end) from raw telemetry.
+    `start` and `end` must be minute-aligned.
+
+    Samples up to MAX_SAMPLE_GAP either side of the window are read as
+    context only: the ones before give the batch counter its starting value,
+    the ones after close the status time of the last sample in the window.
+    The result is therefore the same whichever way the range is split.
+    """
+    rows = (
+        MachineTelemetry.objects.filter(
+            created_at__gte=start - MAX_SAMPLE_GAP, created_at__lt=end + MAX_SAMPLE_GAP
+        )
+        .order_by("machine_id", "created_at")
+        .values_list("machine_id", "created_at", "ppm", "temp", "batch_count", "status")
+    )
+
+    buckets = {}
+    prev = None  # (machine_id, created_at, batch_count, status, bucket or None for context rows)
+
+    for machine_id, ts, ppm, temp, batch, status in rows.iterator(chunk_size=5000):
+        if prev is not None and prev[0] != machine_id:
+            prev = None
+
+        if prev is not None and prev[4] is not None:
+            # Time until the next sample counts towards the previous status.
+            prev[4].add_status(prev[3], min(ts - prev[1], MAX_SAMPLE_GAP).total_seconds())
+
+        bucket = None
+        if start <= ts < end:
+            key = (machine_id, floor_time(ts, MINUTE))
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = _Bucket()
+
+            bucket.count += 1
+            bucket.ppm_sum += ppm
+            bucket.temp_sum += temp
+            bucket.ppm_min = ppm if bucket.ppm_min is None else min(bucket.ppm_min, ppm)
+            bucket.ppm_max = ppm if bucket.ppm_max is None else max(bucket.ppm_max, ppm)
+            bucket.temp_min = temp if bucket.temp_min is None else min(bucket.temp_min, temp)
+            bucket.temp_max = temp if bucket.temp_max is None else max(bucket.temp_max, temp)
+
+            if prev is not None and ts - prev[1] <= MAX_SAMPLE_GAP:
+                # A lower reading means the counter was reset (new batch).
+                bucket.batch_delta += batch - prev[2] if batch >= prev[2] else batch
+
+        prev = (machine_id, ts, batch, status, bucket)
+
+    out = [b.as_row(machine_id, MINUTE, bucket_start) for (machine_id, bucket_start), b in buckets.items()]
+    return _replace_buckets(MINUTE, start, end, out)
+
+
+def build_coarse_rollups(resolution: str, start: datetime, end: datetime) -> int:
+    """
+    Rebuild hour or day rollups for buckets in [start, end) from the next
+    finer rollup level. `start` and `end` must be aligned to `resolution`.
+    """
+    source = MINUTE if resolution == HOUR else HOUR
+    rows = (
+        MachineTelemetryRollup.objects.filter(resolution=source, bucket_start__gte=start, bucket_start__lt=end)
+        .order_by("machine_id", "bucket_start")
+        .values_list(
+            "machine_id", "bucket_start", "sample_count",
+            "ppm_min", "ppm_max", "ppm_avg", "temp_min", "temp_max", "temp_avg",
+            "batch_delta", "status_seconds",
+        )
+    )
+
+    buckets = {}
+    for (machine_id, ts, count, ppm_min, ppm_max, ppm_avg, temp_min, temp_max, temp_avg,
+         batch_delta, status_seconds) in rows.iterator(chunk_size=5000):
+        key = (machine_id, floor_time(ts, resolution))
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = _Bucket()
+        bucket.count += count
+        bucket.ppm_sum += ppm_avg * count
+        bucket.temp_sum += temp_avg * count
+        bucket.ppm_min = ppm_min if bucket.ppm_min is None else min(bucket.ppm_min, ppm_min)
+        bucket.ppm_max = ppm_max if bucket.ppm_max is None else max(bucket.ppm_max, ppm_max)
+        bucket.temp_min = temp_min if bucket.temp_min is None else min(bucket.temp_min, temp_min)
+        bucket.temp_max = temp_max if bucket.temp_max is None else max(bucket.temp_max, temp_max)
+        bucket.batch_delta += batch_delta
+        for status, seconds in (status_seconds or {}).items():
+            bucket.add_status(status, seconds)
+
+    out = [
+        b.as_row(machine_id, resolution, bucket_start)
+        for (machine_id, bucket_start), b in buckets.items()
+        if b.count
+    ]
+    return _replace_buckets(resolution, start, end, out)
+
+
+def get_rollup_mark():
+    mark = TelemetryRollupMark.objects.filter(name=ROLLUP_MARK_NAME).first()
+    return mark.position if mark else None
+
+
+def set_rollup_mark(position: datetime) -> None:
+    TelemetryRollupMark.objects.update_or_create(name=ROLLUP_MARK_NAME, defaults={"position": position})
+
+
+def note_late_samples(rows) -> None:
+    """
+    Called after ingest: if any of `rows` is old enough to be behind the
+    rollup high-water mark, move the redo mark back to cover it. Costs no
+    query for samples younger than ROLLUP_LAG, i.e. normal live traffic.
+    """
+    oldest = min((row.created_at for row in rows), default=None)
+    if oldest is None or oldest >= timezone.now() - ROLLUP_LAG:
+        return
+    # The status time of the sample before a late one changes too.
+    minute = floor_time(oldest - MAX_SAMPLE_GAP, MINUTE)
+    if not TelemetryRollupMark.objects.filter(name=REDO_MARK_NAME, position__gt=minute).update(position=minute):
+        TelemetryRollupMark.objects.get_or_create(name=REDO_MARK_NAME, defaults={"position": minute})
+
+
+def _roll_window(start: datetime, end: datetime) -> int:
+    written = build_minute_rollups(start, end)
+    build_coarse_rollups(HOUR, floor_time(start, HOUR), _ceil_time(end, HOUR))
+    build_coarse_rollups(DAY, floor_time(start, DAY), _ceil_time(end, DAY))
+    build_utilisation(start, end)
+    return written
+
+
+def _redo_late(position: datetime, window: timedelta, log=None) -> int:
+    """Rebuild the rolled-up range [redo mark, position) that late samples landed in."""
+    redo = TelemetryRollupMark.objects.filter(name=REDO_MARK_NAME).first()
+    if redo is None:
+        return 0
+    # Claim the mark first: samples arriving during the rebuild set a new one.
+    if not TelemetryRollupMark.objects.filter(pk=redo.pk, position=redo.position).delete()[0]:
+        return 0
+
+    # Minute rollups are rebuilt from raw rows; hours already compacted into
+    # blocks keep their rollups (their late samples join the block later).
+    compacted = get_compact_mark()
+    start = max(redo.position, compacted) if compacted else redo.position
+    written = 0
+    try:
+        while start < position:
+            end = min(start + window, position)
+            written += _roll_window(start, end)
+            if log:
+                log(f"Re-rolled {start.isoformat()} -> {end.isoformat()} (late samples)")
+            start = end
+    except Exception:
+        TelemetryRollupMark.objects.get_or_create(name=REDO_MARK_NAME, defaults={"position": start})
+        raise
+    return written
+
+
+def run_rollups(now=None, lag=ROLLUP_LAG, window=timedelta(hours=6), log=None) -> int:
+    """
+    Advance the rollups from the stored high-water mark up to `now - lag`
+    (rounded down to the minute), one `window` at a time, refreshing the
+    shift and day utilisation rows each window touches. Minutes behind the
+    mark that received late samples (note_late_samples) are rebuilt first.
+
+    The mark is saved after each window, so an interrupted run resumes where
+    it stopped. Returns the number of minute buckets written.
+    """
+    now = now or timezone.now()
+    cutoff = floor_time(now - lag, MINUTE)
+
+    position = get_rollup_mark()
+    if position is None:
+        first = MachineTelemetry.objects.order_by("created_at").values_list("created_at", flat=True).first()
+        if first is None:
+            return 0
+        position = floor_time(first, MINUTE)
+
+    written = _redo_late(position, window, log)
+    while position < cutoff:
+        window_end = min(position + window, cutoff)
+        written += _roll_window(position, window_end)
+        set_rollup_mark(window_end)
+        if log:
+            log(f"Rolled up {position.isoformat()} -> {window_end.isoformat()}")
+        position = window_end
+
+    return written
+
+
+# -----------------------------------------------------------------------------
+# Reading
+# -----------------------------------------------------------------------------
+
+def choose_resolution(start: datetime, end: datetime, max_points: int) -> str:
+    """
+    Finest resolution that returns at most `max_points` buckets for the
+    range, i.e. the coarsest level the caller actually needs. Returns
+    "raw" when the range is short enough to read samples directly.
+    """
+    span = max(end - start, timedelta(seconds=1))
+    for name, step in RESOLUTIONS:
+        if span / step <= max_points:
+            return name
+    return DAY
+
+
+def telemetry_series(machine_id: str, start: datetime, end: datetime, resolution: str) -> list:
+    """
+    Points for one machine over [start, end) at the given resolution, as
+    dicts with ts/ppm/temp (averages for rollups) plus min/max and
+    batch_delta for rolled-up levels. Raw samples are read from compacted
+    blocks and MachineTelemetry alike.
+
+    Rollups are read up to the high-water mark; anything newer is
+    aggregated from raw telemetry on the fly so the newest data is never
+    missing from a chart.
+    """
+    if resolution == "raw":
+        return [
+            {"ts": ts, "ppm": ppm, "temp": temp, "batch_count": batch, "status": status}
+            for ts, ppm, temp, batch, status in iter_samples(machine_id, start, end)
+        ]
+
+    points = []
+    mark = get_rollup_mark()
+    rolled_end = min(end, floor_time(mark, resolution)) if mark else start
+
+    if rolled_end > start:
+        rows = (
+            MachineTelemetryRollup.objects.filter(
+                machine_id=machine_id,
+                resolution=resolution,
+                bucket_start__gte=floor_time(start, resolution),
+                bucket_start__lt=rolled_end,
+            )
+            .order_by("bucket_start")
+            .values_list("bucket_start", "ppm_avg", "temp_avg", "ppm_min", "ppm_max", "temp_min", "temp_max", "batch_delta")
+        )
+        for ts, ppm, temp, ppm_min, ppm_max, temp_min, temp_max, batch_delta in rows:
+            points.append(
+                {
+                    "ts": ts, "ppm": ppm, "temp": temp,
+                    "ppm_min": ppm_min, "ppm_max": ppm_max,
+                    "temp_min": temp_min, "temp_max": temp_max,
+                    "batch_delta": batch_delta,
+                }
+            )
+
+    tail_start = max(start, rolled_end)
+    if tail_start < end:
+        rows = (
+            MachineTelemetry.objects.filter(machine_id=machine_id, created_at__gte=tail_start, created_at__lt=end)
+            .annotate(bucket=_TRUNC[resolution]("created_at", tzinfo=dt_timezone.utc))
+            .values("bucket")
+            .annotate(
+                ppm_avg=Avg("ppm"), temp_avg=Avg("temp"),
+                ppm_min=Min("ppm"), ppm_max=Max("ppm"),
+                temp_min=Min("temp"), temp_max=Max("temp"),
+            )
+            .order_by("bucket")
+        )
+        for row in rows:
+            points.append(
+                {
+                    "ts": row["bucket"], "ppm": row["ppm_avg"], "temp": row["temp_avg"],
+                    "ppm_min": row["ppm_min"], "ppm_max": row["ppm_max"],
+                    "temp_min": row["temp_min"], "temp_max": row["temp_max"],
+                    "batch_delta": None,
+                }
+            )
+
+    return points
+
+
+def rollup_sparklines(machine_ids, start: datetime, resolution: str = HOUR, field: str = "ppm_avg") -> dict:
+    """
+    {machine_id: [values oldest first]} of one rollup column for many
+    machines since `start`, in a single query. Meant for small overview
+    charts, so the not-yet-rolled-up tail is left out.
+    """
+    rows = (
+        MachineTelemetryRollup.objects.filter(
+            machine_id__in=list(machine_ids),
+            resolution=resolution,
+            bucket_start__gte=floor_time(start, resolution),
+        )
+        .order_by("machine_id", "bucket_start")
+        .values_list("machine_id", field)
+    )
+    out = {}
+    for machine_id, value in rows:
+        out.setdefault(machine_id, []).append(value)
+    return out
@@ -0,0 +1,94 @@
+"""
+Ranked full-text search over ShopProduct, used by the search and shop pages
+and the api_products `q` filter.
+
+The index lives outside the Django model (migration 0078):
+
+    PostgreSQL  core_shopproduct.search_vector, a tsvector column generated
+                from name and SKU (weight A) and description (weight C),
+                stored and kept current by the database on every write,
+                with a GIN index
+    SQLite      core_shopproduct_fts, an external-content FTS5 table over
+                the same columns, kept in sync by triggers
+
+Each word of the query must match, as a prefix, somewhere in the product
+("bel sea" finds "Belt seal"). Ranking uses ts_rank / bm25 with name and SKU
+weighted above description. Other databases fall back to a plain
+case-insensitive substring filter with no ranking.
+"""
+
+import re
+
+from django.db import connection
+from django.db.models import FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = "core_shopproduct_fts"
+# Longer queries are cut short; more words only narrow the results further.
+MAX_TERMS = 8
+# bm25 column weights for (name, sku, description).
+FTS_WEIGHTS = (10.0, 10.0, 1.0)
+
+
+def _terms(query: str) -> list:
+    return re.findall(r"[^\W_]+", query.lower())[:MAX_TERMS]
+
+
+def _match(terms: list):
+    """
+    (matching ids SQL, rank SQL, params) for the current database, or None
+    if it has no text index. Product columns are left unqualified so the
+    SQL still works when Django aliases the table inside a subquery.
+    """
+    if connection.vendor == "postgresql":
+        tsquery = " & ".join(f"{t}:*" for t in terms)
+        return (
+            "SELECT id FROM core_shopproduct WHERE search_vector @@ to_tsquery('english', %s)",
+            "ts_rank(search_vector, to_tsquery('english', %s))",
+            [tsquery],
+        )
+    if connection.vendor == "sqlite":
+        match = " AND ".join(f'"{t}"*' for t in terms)
+        weights = ", ".join(str(w) for w in FTS_WEIGHTS)
+        return (
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s",
+            # bm25 is lower for better matches; `id` is the outer product's.
+            f"(SELECT -bm25({FTS_TABLE}, {weights}) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND rowid = id)",
+            [match],
+        )
+    return None
+
+
+def filter_products(queryset, query: str):
+    """`queryset` narrowed to products matching `query`, in its existing order."""
+    terms = _terms(query)
+    if not terms:
+        return queryset.none()
+    match = _match(terms)
+    if match is None:
+        return queryset.filter(
+            Q(name__icontains=query) | Q(description__icontains=query) | Q(sku__icontains=query)
+        )
+    ids, _, params = match
+    return queryset.filter(id__in=RawSQL(ids, params))
+
+
+def search_products(queryset, query: str):
+    """
+    `queryset` narrowed to products matching `query`, annotated with
+    `search_rank` (higher is better) and ordered best first.
+    """
+    terms = _terms(query)
+    if not terms:
+        return queryset.none()
+    match = _match(terms)
+    if match is None:
+        return filter_products(queryset, query).annotate(
+            search_rank=Value(0.0, output_field=FloatField())
+        ).order_by("sort_order", "name")
+    ids, rank, params = match
+    return (
+        queryset.filter(id__in=RawSQL(ids, params))
+        .annotate(search_rank=RawSQL(rank, params, output_field=FloatField()))
+        .order_by("-search_rank", "sort_order", "name")
+    )
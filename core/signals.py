@@ -0,0 +1,71 @@
+"""
+Model signal receivers that keep caches in step with the database.
+Connected from CoreConfig.ready().
+"""
+
+import contextlib
+import threading
+
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import catalogue, facets, ingest_auth, ringbuffer
+from .models import CustomerMachine, MachineApiKey, MachineProduct, ShopProduct, SiteConfiguration
+
+_batch = threading.local()
+
+
+@contextlib.contextmanager
+def catalogue_batch():
+    """
+    Save many ShopProducts without a facet refresh and version bump per
+    save: both run once, for the whole catalogue, when the block exits
+    (also when it raises, for whatever was saved before).
+    """
+    _batch.active = True
+    try:
+        yield
+    finally:
+        _batch.active = False
+        facets.refresh_products()
+        catalogue.bump_version()
+
+
+def _in_batch() -> bool:
+    return getattr(_batch, "active", False)
+
+
+@receiver([post_save, post_delete], sender=MachineApiKey)
+def _api_key_changed(sender, instance, **kwargs):
+    ingest_auth.invalidate(instance.key_id)
+
+
+@receiver([post_save, post_delete], sender=CustomerMachine)
+def _customer_machine_changed(sender, instance, **kwargs):
+    # Keys carry the machine's telemetry_id and active flag; the ring buffer
+    # only takes machines it knows.
+    ingest_auth.invalidate()
+    ringbuffer.forget_known_machines()
+
+
+@receiver(post_save, sender=ShopProduct)
+def _shop_product_saved(sender, instance, raw=False, **kwargs):
+    if not raw and not _in_batch():
+        facets.refresh_product(instance)
+
+
+@receiver(pre_delete, sender=ShopProduct)
+def _shop_product_deleted(sender, instance, **kwargs):
+    # Before the cascade removes its facet rows.
+    if not _in_batch():
+        facets.forget_product(instance)
+
+
+@receiver([post_save, post_delete], sender=ShopProduct)
+@receiver([post_save, post_delete], sender=SiteConfiguration)
+@receiver([post_save, post_delete], sender=MachineProduct)
+def _catalogue_changed(sender, instance, **kwargs):
+    # SiteConfiguration decides whether prices are shown in the product feed;
+    # machine names are in the search suggestions (core/suggest.py).
+    if not _in_batch():
+        catalogue.bump_version()
@@ -0,0 +1,145 @@
+"""
+In-memory prefix index for the search box typeahead (api/search/suggest/).
+
+Each process keeps one sorted list of lowercase keys over active
+ShopProduct names and SKUs and active MachineProduct names, searched with
+bisect, so a suggestion costs a binary search plus a short scan and no
+query. Every word of a name is a key start ("seal" finds "Belt seal"), as
+is every letter or digit run of a SKU, with or without its leading zeros
+("3418" finds "SKU003418").
+
+The index belongs to one catalogue version (core/catalogue.py). The first
+request that sees a newer version starts a rebuild (two queries) on a
+background thread, and suggestions come from the previous index until it
+is ready, so no keystroke waits for a rebuild.
+"""
+
+import logging
+import re
+import threading
+from bisect import bisect_left
+from collections import namedtuple
+
+from django.db import close_old_connections, connection
+
+from . import catalogue
+from .models import MachineProduct, ShopProduct
+
+KIND_MACHINE = "machine"
+KIND_PRODUCT = "product"
+MIN_QUERY_LENGTH = 2
+LIMIT = 8
+MAX_LIMIT = 20
+# Matching keys looked at per request before ranking; bounds the cost of a short prefix.
+SCAN_LIMIT = 200
+
+Entry = namedtuple("Entry", "kind label sku slug")
+Index = namedtuple("Index", "version keys positions entries")
+
+logger = logging.getLogger(__name__)
+
+_WORD = re.compile(r"[^\W_]+")
+# Letter runs and digit runs, the latter also without leading zeros.
+_SKU_RUN = re.compile(r"[^\W\d_]+|0*(\d+)")
+
+_index = None
+_rebuilding = False
+_lock = threading.Lock()
+
+
+def normalise(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def _starts(text: str, sku: bool):
+    """Offsets in `text` where a key starts: each word, and for SKUs each letter or digit run."""
+    starts = [0]
+    for m in (_SKU_RUN if sku else _WORD).finditer(text):
+        if m.start():
+            starts.append(m.start())
+        if sku and m.group(1) and m.start(1) != m.start():
+            starts.append(m.start(1))
+    return starts
+
+
+def build_index(version: int) -> Index:
+    entries, keys, positions = [], [], []
+
+    def add(entry, *texts):
+        n = len(entries)
+        entries.append(entry)
+        for text, sku in texts:
+            text = normalise(text)
+            if not text:
+                continue
+            for i in _starts(text, sku):
+                keys.append(text[i:])
+                # ~n marks a key from inside a label or SKU rather than its start.
+                positions.append(n if not i else ~n)
+
+    for name, slug in MachineProduct.objects.filter(is_active=True).values_list("name", "slug"):
+        add(Entry(KIND_MACHINE, name, "", slug), (name, False))
+    for name, sku, slug in ShopProduct.objects.filter(is_active=True).values_list("name", "sku", "slug"):
+        add(Entry(KIND_PRODUCT, name, sku, slug), (name, False), (sku, True))
+
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    return Index(version, [keys[i] for i in order], [positions[i] for i in order], entries)
+
+
+def _rebuild(version: int) -> None:
+    global _index, _rebuilding
+    try:
+        close_old_connections()
+        _index = build_index(version)
+    except Exception as e:
+        logger.exception("Rebuilding the search suggestion index failed: %s", e)
+    finally:
+        connection.close()
+        _rebuilding = False
+
+
+def get_index() -> Index:
+    """
+    The index for the current catalogue version. Only the first call in a
+    process builds it inline; after that a newer version is built on a
+    background thread while requests keep using the previous index.
+    """
+    global _index, _rebuilding
+    version = catalogue.get_version().number
+    index = _index
+    if index is None:
+        with _lock:
+            if _index is None:
+                _index = build_index(version)
+            return _index
+    if index.version != version:
+        with _lock:
+            if not _rebuilding:
+                _rebuilding = True
+                threading.Thread(target=_rebuild, args=(version,), name="search-suggest-index", daemon=True).start()
+    return index
+
+
+def suggest(query: str, limit: int = LIMIT) -> list:
+    """Up to `limit` entries with a name or SKU word starting with `query`, best first."""
+    query = normalise(query)
+    if len(query) < MIN_QUERY_LENGTH:
+        return []
+    index = get_index()
+    keys, positions = index.keys, index.positions
+
+    best = {}
+    i = bisect_left(keys, query)
+    end = min(len(keys), i + SCAN_LIMIT)
+    while i < end and keys[i].startswith(query):
+        n = positions[i]
+        whole = n >= 0
+        if not whole:
+            n = ~n
+        best[n] = best.get(n, False) or whole
+        i += 1
+
+    entries = index.entries
+    # Matches at the start of a label or SKU first, then machines before parts, then by name.
+    ranked = sorted(best, key=lambda n: (not best[n], entries[n].kind != KIND_MACHINE, entries[n].label.lower()))
+    return [entries[n] for n in ranked[:limit]]
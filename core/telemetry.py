@@ -0,0 +1,520 @@
+"""
+Telemetry ingest helpers used by the machine data API views.
+
+Parsing and validation live here (not in views.py) so the single-sample and
+batched ingest endpoints share exactly the same rules.
+"""
+
+import json
+import math
+import struct
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+from django.utils.dateparse import parse_datetime
+
+from . import alerts, ringbuffer, rollups
+from .models import MachineTelemetry
+
+# Upper bound on samples accepted in one batched request, and the number of
+# rows sent to the database per INSERT statement.
+INGEST_MAX_SAMPLES = 5000
+INGEST_CHUNK_SIZE = 500
+
+# Largest request body accepted after decompression, so a small gzip body
+# cannot expand into an unbounded amount of memory.
+INGEST_MAX_BODY_BYTES = 16 * 1024 * 1024
+
+LATEST_CACHE_PREFIX = "telemetry:latest:"
+
+# Range of MachineTelemetry.batch_count (a 32-bit IntegerField).
+INT_MIN, INT_MAX = -(2 ** 31), 2 ** 31 - 1
+
+# Compact columnar body, sent with Content-Type: application/vnd.mpe.telemetry
+# (usually also Content-Encoding: gzip). All integers are little-endian.
+#
+#   header   20 bytes  struct "<4sBBHId"
+#            magic       4s   b"MPT1"
+#            version     B    1
+#            id_length   B    length of the UTF-8 machine id (1-50)
+#            reserved    H    0
+#            count       I    number of samples N
+#            base_ts     d    epoch seconds of the first sample (float64)
+#   machine_id   id_length bytes, UTF-8
+#   ts_offset    N x int32    milliseconds relative to base_ts
+#   ppm          N x float32
+#   temp         N x float32
+#   batch_count  N x int32
+#   status       N x uint8    index into STATUS_CODES
+#
+# That is 17 bytes per sample against roughly 90 for the JSON object form.
+#
+# Version 2 adds the per-machine sequence number (MachineTelemetry.seq):
+#   base_seq     uint64       right after machine_id
+#   seq_offset   N x uint32   after status; seq = base_seq + seq_offset
+# for 21 bytes per sample. Version 1 bodies are still accepted.
+COLUMNAR_CONTENT_TYPE = "application/vnd.mpe.telemetry"
+COLUMNAR_MAGIC = b"MPT1"
+COLUMNAR_VERSION = 2
+COLUMNAR_HEADER = struct.Struct("<4sBBHId")
+COLUMNAR_BASE_SEQ = struct.Struct("<Q")
+COLUMNAR_BYTES_PER_SAMPLE = {1: 17, 2: 21}
+STATUS_CODES = ("RUNNING", "STOPPED", "IDLE", "FAULT", "SETUP", "OFFLINE")
+
+# Device timestamps further ahead of the server clock than this are refused;
+# older ones are accepted as they are (store-and-forward replays).
+MAX_FUTURE_SKEW_SECONDS = 300
+
+
+class TelemetryError(ValueError):
+    """Raised when a telemetry payload or sample cannot be accepted."""
+
+
+class UnsupportedEncoding(TelemetryError):
+    """Raised for a Content-Encoding the ingest endpoints cannot decode."""
+
+
+def _float(data: dict, key: str) -> float:
+    value = data.get(key)
+    if isinstance(value, bool) or value is None:
+        raise TelemetryError(f"'{key}' is required and must be a number")
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise TelemetryError(f"'{key}' must be a number")
+    if not math.isfinite(value):
+        raise TelemetryError(f"'{key}' must be finite")
+    return value
+
+
+def _int(data: dict, key: str) -> int:
+    value = data.get(key)
+    if isinstance(value, bool) or value is None:
+        raise TelemetryError(f"'{key}' is required and must be an integer")
+    try:
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        raise TelemetryError(f"'{key}' must be an integer")
+    # Out of range, the insert of the whole batch would fail rather than this sample.
+    if not INT_MIN <= value <= INT_MAX:
+        raise TelemetryError(f"'{key}' must be between {INT_MIN} and {INT_MAX}")
+    return value
+
+
+def _optional_seq(data: dict):
+    value = data.get("seq")
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value < 2 ** 63:
+        raise TelemetryError("'seq' must be a non-negative integer")
+    return value
+
+
+def _text(data: dict, key: str, max_length: int) -> str:
+    value = data.get(key)
+    if not isinstance(value, str) or not value.strip():
+        raise TelemetryError(f"'{key}' is required")
+    value = value.strip()
+    if len(value) > max_length:
+        raise TelemetryError(f"'{key}' must be at most {max_length} characters")
+    return value
+
+
+def parse_timestamp(value) -> datetime:
+    """
+    Device timestamp as an aware UTC datetime. Accepts epoch seconds (number)
+    or an ISO 8601 string; naive strings are taken as UTC.
+    """
+    if isinstance(value, bool):
+        raise TelemetryError("'ts' must be epoch seconds or an ISO 8601 string")
+    if isinstance(value, (int, float)):
+        if not math.isfinite(value):
+            raise TelemetryError("'ts' must be finite")
+        try:
+            return datetime.fromtimestamp(value, tz=dt_timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            raise TelemetryError("'ts' is out of range")
+    if isinstance(value, str):
+        try:
+            parsed = parse_datetime(value.strip())
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            raise TelemetryError("'ts' must be epoch seconds or an ISO 8601 string")
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=dt_timezone.utc)
+        return parsed
+    raise TelemetryError("'ts' must be epoch seconds or an ISO 8601 string")
+
+
+def clean_sample(data) -> MachineTelemetry:
+    """
+    Validate one decoded sample and return an unsaved MachineTelemetry.
+    Raises TelemetryError with a message suitable for the API response.
+    """
+    if not isinstance(data, dict):
+        raise TelemetryError("Sample must be a JSON object")
+
+    row = MachineTelemetry(
+        machine_id=_text(data, "machine_id", 50),
+        ppm=_float(data, "ppm"),
+        temp=_float(data, "temp"),
+        batch_count=_int(data, "batch_count"),
+        status=_text(data, "status", 20),
+        seq=_optional_seq(data),
+    )
+    if data.get("ts") is None:
+        # Replays are recognised by (machine_id, seq, created_at); with the
+        # arrival time as created_at a resent sample would never match.
+        if row.seq is not None:
+            raise TelemetryError("'seq' requires 'ts'")
+    else:
+        ts = parse_timestamp(data["ts"])
+        if ts > row.created_at + timedelta(seconds=MAX_FUTURE_SKEW_SECONDS):
+            raise TelemetryError(f"'ts' is more than {MAX_FUTURE_SKEW_SECONDS}s ahead of server time")
+        row.created_at = ts
+    return row
+
+
+def decode_body(body: bytes, content_encoding: str = "") -> bytes:
+    """
+    Undo the request's Content-Encoding. Only gzip (and identity) is
+    supported; the decompressed size is capped at INGEST_MAX_BODY_BYTES.
+    """
+    encoding = (content_encoding or "").strip().lower()
+    if encoding in ("", "identity"):
+        return body
+    if encoding not in ("gzip", "x-gzip"):
+        raise UnsupportedEncoding(f"Unsupported Content-Encoding '{content_encoding}'")
+
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    try:
+        data = decompressor.decompress(body, INGEST_MAX_BODY_BYTES)
+    except zlib.error as e:
+        raise TelemetryError(f"Invalid gzip body: {e}")
+    if decompressor.unconsumed_tail:
+        raise TelemetryError(f"Body too large (max {INGEST_MAX_BODY_BYTES} bytes uncompressed)")
+    if not decompressor.eof:
+        raise TelemetryError("Truncated gzip body")
+    return data
+
+
+def parse_samples(body: bytes) -> list:
+    """
+    Decode a batched ingest body.
+
+    Accepts either a JSON array of sample objects or NDJSON (one object per
+    line). Returns a list where each entry is the decoded sample, or a
+    TelemetryError for an NDJSON line that could not be decoded, so that a
+    single bad line is reported against its own index instead of failing the
+    whole request.
+    """
+    try:
+        text = body.decode("utf-8")
+    except UnicodeDecodeError:
+        raise TelemetryError("Body must be UTF-8 encoded")
+
+    stripped = text.lstrip()
+    if not stripped:
+        raise TelemetryError("Empty body")
+
+    if stripped.startswith("["):
+        try:
+            samples = json.loads(stripped)
+        except ValueError as e:
+            raise TelemetryError(f"Invalid JSON: {e}")
+    else:
+        samples = []
+        for line in stripped.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                samples.append(json.loads(line))
+            except ValueError as e:
+                samples.append(TelemetryError(f"Invalid JSON line: {e}"))
+
+    if len(samples) > INGEST_MAX_SAMPLES:
+        raise TelemetryError(f"Too many samples (max {INGEST_MAX_SAMPLES} per request)")
+    return samples
+
+
+def decode_columnar(body: bytes) -> list:
+    """
+    Decode the compact columnar body (layout above, version 1 or 2) into the
+    same list of sample dicts parse_samples() returns. A sample with an
+    unknown status code becomes a TelemetryError entry so it is rejected on
+    its own.
+    """
+    if len(body) < COLUMNAR_HEADER.size:
+        raise TelemetryError("Body too short for columnar header")
+    magic, version, id_length, _reserved, count, base_ts = COLUMNAR_HEADER.unpack_from(body)
+    if magic != COLUMNAR_MAGIC:
+        raise TelemetryError("Not a columnar telemetry body")
+    if version not in COLUMNAR_BYTES_PER_SAMPLE:
+        raise TelemetryError(f"Unsupported columnar version {version}")
+    if count > INGEST_MAX_SAMPLES:
+        raise TelemetryError(f"Too many samples (max {INGEST_MAX_SAMPLES} per request)")
+    fixed = COLUMNAR_HEADER.size + id_length + (COLUMNAR_BASE_SEQ.size if version >= 2 else 0)
+    if len(body) != fixed + count * COLUMNAR_BYTES_PER_SAMPLE[version]:
+        raise TelemetryError("Body length does not match columnar header")
+    if not math.isfinite(base_ts):
+        raise TelemetryError("'base_ts' must be finite")
+
+    offset = COLUMNAR_HEADER.size
+    try:
+        machine_id = body[offset:offset + id_length].decode("utf-8")
+    except UnicodeDecodeError:
+        raise TelemetryError("Machine id must be UTF-8 encoded")
+    offset += id_length
+    if version >= 2:
+        (base_seq,) = COLUMNAR_BASE_SEQ.unpack_from(body, offset)
+        offset += COLUMNAR_BASE_SEQ.size
+
+    ts_offsets = struct.unpack_from(f"<{count}i", body, offset)
+    offset += 4 * count
+    ppm = struct.unpack_from(f"<{count}f", body, offset)
+    offset += 4 * count
+    temp = struct.unpack_from(f"<{count}f", body, offset)
+    offset += 4 * count
+    batch_count = struct.unpack_from(f"<{count}i", body, offset)
+    offset += 4 * count
+    status = body[offset:offset + count]
+    offset += count
+    seq = [base_seq + o for o in struct.unpack_from(f"<{count}I", body, offset)] if version >= 2 else None
+
+    samples = []
+    for i in range(count):
+        if status[i] >= len(STATUS_CODES):
+            samples.append(TelemetryError(f"Unknown status code {status[i]}"))
+            continue
+        samples.append({
+            "machine_id": machine_id,
+            "ts": base_ts + ts_offsets[i] / 1000.0,
+            # float32 on the wire; trim the binary noise (30.1 -> 30.100000381)
+            "ppm": round(ppm[i], 4),
+            "temp": round(temp[i], 4),
+            "batch_count": batch_count[i],
+            "status": STATUS_CODES[status[i]],
+        })
+        if seq is not None:
+            samples[-1]["seq"] = seq[i]
+    return samples
+
+
+def validate_samples(samples: list):
+    """
+    clean_sample() every sample. Returns (rows, results): the unsaved rows
+    that passed, and one accept/reject entry per input sample, in order.
+    """
+    rows = []
+    results = []
+    for index, data in enumerate(samples):
+        try:
+            if isinstance(data, TelemetryError):
+                raise data
+            rows.append(clean_sample(data))
+        except TelemetryError as e:
+            results.append({"index": index, "status": "rejected", "error": str(e)})
+        else:
+            results.append({"index": index, "status": "accepted"})
+    return rows, results
+
+
+def _new_rows(rows) -> list:
+    """
+    `rows` less those repeating the machine_id, seq and created_at of a
+    stored row or of an earlier row in `rows`. Rows without seq are always new.
+    """
+    keyed = [r for r in rows if r.seq is not None]
+    if not keyed:
+        return list(rows)
+    stored = set(
+        MachineTelemetry.objects.filter(
+            machine_id__in={r.machine_id for r in keyed},
+            seq__in={r.seq for r in keyed},
+            created_at__gte=min(r.created_at for r in keyed),
+            created_at__lte=max(r.created_at for r in keyed),
+        ).values_list("machine_id", "seq", "created_at")
+    )
+    new = []
+    for row in rows:
+        if row.seq is not None:
+            key = (row.machine_id, row.seq, row.created_at)
+            if key in stored:
+                continue
+            stored.add(key)
+        new.append(row)
+    return new
+
+
+def insert_rows(rows) -> list:
+    """
+    Write validated rows with a chunked bulk_create in one transaction and
+    return the ones actually written. A row repeating the machine_id, seq
+    and created_at of a stored one is skipped, so resending a batch is
+    harmless; only the returned rows should go on to after_ingest().
+
+    Duplicates are found up front with one indexed query; ON CONFLICT DO
+    NOTHING still guards against a concurrent request storing the same
+    sample in between, which then at worst reaches after_ingest() twice.
+    """
+    with transaction.atomic():
+        rows = _new_rows(rows)
+        MachineTelemetry.objects.bulk_create(rows, batch_size=INGEST_CHUNK_SIZE, ignore_conflicts=True)
+    return rows
+
+
+def after_ingest(rows) -> None:
+    """
+    Everything that follows a write: the latest-sample cache, the live ring
+    buffer, the alert rules, and a rollup redo mark for late samples.
+    """
+    remember_latest(rows)
+    ringbuffer.append(rows)
+    alerts.evaluate(rows)
+    rollups.note_late_samples(rows)
+
+
+def ingest_samples(samples: list):
+    """
+    Validate every sample, then write the accepted ones (insert_rows).
+
+    Returns (accepted_count, results) where results holds one entry per
+    input sample, in order. Skipped duplicates count as accepted: the
+    client's data is stored either way.
+    """
+    rows, results = validate_samples(samples)
+    if rows:
+        after_ingest(insert_rows(rows))
+
+    return len(rows), results
+
+
+# -----------------------------------------------------------------------------
+# Latest sample per machine (cache)
+# -----------------------------------------------------------------------------
+
+def _latest_key(machine_id: str) -> str:
+    return f"{LATEST_CACHE_PREFIX}{machine_id}"
+
+
+def _latest_ttl() -> int:
+    return getattr(settings, "TELEMETRY_LATEST_CACHE_TTL", 5)
+
+
+def snapshot(row: MachineTelemetry) -> dict:
+    """Plain-dict copy of a telemetry row, as stored in the latest-value cache."""
+    return {
+        "machine_id": row.machine_id,
+        "ppm": row.ppm,
+        "temp": row.temp,
+        "batch_count": row.batch_count,
+        "status": row.status,
+        "created_at": row.created_at.isoformat() if row.created_at else "",
+    }
+
+
+def remember_latest(rows) -> None:
+    """
+    Store the newest sample (by created_at) of each machine in `rows` in the
+    cache, unless the cached one is newer still: a replayed or out-of-order
+    sample must not replace a fresher value.
+    """
+    newest = {}
+    for row in rows:
+        key = _latest_key(row.machine_id)
+        if key not in newest or row.created_at >= newest[key].created_at:
+            newest[key] = row
+    if not newest:
+        return
+
+    cached = cache.get_many(list(newest))
+    latest = {}
+    for key, row in newest.items():
+        current = parse_datetime((cached.get(key) or {}).get("created_at") or "")
+        if current is None or row.created_at >= current:
+            latest[key] = snapshot(row)
+    if latest:
+        cache.set_many(latest, timeout=_latest_ttl())
+
+
+def latest_rows(machine_ids) -> dict:
+    """
+    Newest MachineTelemetry row for each of `machine_ids`, in one query:
+    {machine_id: row}; machines that never reported are absent.
+
+    On PostgreSQL this is a LATERAL join doing one index probe per machine
+    (core_telem_machine_ts_idx), so its cost depends on the number of
+    machines, not on how much history they have; DISTINCT ON would have to
+    walk every index entry of every machine. Elsewhere a ROW_NUMBER()
+    window picks the newest row per machine.
+    """
+    machine_ids = list(machine_ids)
+    if not machine_ids:
+        return {}
+
+    if connection.vendor == "postgresql":
+        table = MachineTelemetry._meta.db_table
+        rows = MachineTelemetry.objects.raw(
+            f"""
+            SELECT t.* FROM unnest(%s::varchar[]) AS m(machine_id)
+            CROSS JOIN LATERAL (
+                SELECT * FROM {table}
+                WHERE {table}.machine_id = m.machine_id
+                ORDER BY created_at DESC
+                LIMIT 1
+            ) t
+            """,
+            [machine_ids],
+        )
+    else:
+        rows = (
+            MachineTelemetry.objects.filter(machine_id__in=machine_ids)
+            .annotate(_newest=Window(RowNumber(), partition_by=[F("machine_id")], order_by=F("created_at").desc()))
+            .filter(_newest=1)
+        )
+    return {row.machine_id: row for row in rows}
+
+
+def forget_latest(machine_ids) -> None:
+    """Drop the cached latest samples of `machine_ids`."""
+    cache.delete_many([_latest_key(machine_id) for machine_id in machine_ids])
+
+
+def get_latest(machine_id: str):
+    """
+    Latest sample for a machine as a dict, or None if it has never reported.
+
+    Served from the cache; on a miss, one indexed lookup refills it. "No data"
+    is cached too, so unknown machines don't hit the table on every poll.
+    """
+    key = _latest_key(machine_id)
+    value = cache.get(key)
+    if value is None:
+        row = MachineTelemetry.objects.filter(machine_id=machine_id).order_by("-created_at").first()
+        value = snapshot(row) if row else {}
+        cache.set(key, value, timeout=_latest_ttl())
+    return value or None
+
+
+def get_latest_many(machine_ids) -> dict:
+    """
+    Latest sample for several machines at once: {machine_id: dict or None}.
+    One cache round trip for all of them, and a single latest_rows() query
+    for the misses, whose results are cached like get_latest() does.
+    """
+    machine_ids = list(machine_ids)
+    cached = cache.get_many([_latest_key(m) for m in machine_ids])
+    missing = [m for m in machine_ids if _latest_key(m) not in cached]
+    if missing:
+        rows = latest_rows(missing)
+        fresh = {_latest_key(m): snapshot(rows[m]) if m in rows else {} for m in missing}
+        cache.set_many(fresh, timeout=_latest_ttl())
+        cached.update(fresh)
+    return {m: cached[_latest_key(m)] or None for m in machine_ids}
@@ -1,3 +1,1339 @@
-from django.test import TestCase
+import gzip
+import importlib.util
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import time
+from datetime import datetime, time as dt_time, timedelta, timezone as dt_timezone
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache, caches
+from django.core.management import CommandError, call_command
+from django.http import QueryDict
+from django.test import AsyncClient, Client, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (
+    alerts,
+    anomalies,
+    blocks,
+    catalogue,
+    downsample,
+    facets,
+    ingest_auth,
+    metrics,
+    ringbuffer,
+    rollups,
+    search,
+    suggest,
+    telemetry,
+    utilisation,
+    writebehind,
+)
+from .models import (
+    Alert,
+    CustomerMachine,
+    CustomerProfile,
+    MachineAlertSettings,
+    MachineApiKey,
+    MachineMetric,
+    MachineTelemetry,
+    MachineTelemetryRollup,
+    MachineUtilisation,
+    MetricKey,
+    ShopFacetCount,
+    ShopProduct,
+    ShopProductFacet,
+    TelemetryAnomaly,
+    TelemetryRollupMark,
+)
+
+T0 = datetime(2026, 3, 2, 10, 0, tzinfo=dt_timezone.utc)
+
+
+def sample(i=0, machine_id="TEST-1", **extra):
+    data = {
+        "machine_id": machine_id,
+        "ppm": 30.0 + i % 7,
+        "temp": 40.0 + i % 3,
+        "batch_count": i,
+        "status": "RUNNING",
+        "ts": (T0 + timedelta(seconds=i)).timestamp(),
+        "seq": i,
+    }
+    data.update(extra)
+    return {k: v for k, v in data.items() if v is not None}
+
+
+def load_machine_client():
+    """Python Support Apps/machine_client.py as a fresh module."""
+    path = os.path.join(settings.BASE_DIR, "Python Support Apps", "machine_client.py")
+    spec = importlib.util.spec_from_file_location("machine_client", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class TelemetryTestCase(TestCase):
+    """Fresh cache, a private ring buffer file and a customer machine "TEST-1" for every test."""
+
+    def setUp(self):
+        cache.clear()
+        self.customer = get_user_model().objects.create_user("acme")
+        self.machine = CustomerMachine.objects.create(customer=self.customer, name="Line 1", telemetry_id="TEST-1")
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        settings_override = override_settings(TELEMETRY_RING_PATH=os.path.join(self.tmp, "ring.dat"))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self._reset_ring()
+        self.addCleanup(self._reset_ring)
+
+    @staticmethod
+    def _reset_ring():
+        ringbuffer._ring = None
+        ringbuffer._ring_failed = False
+        ringbuffer.forget_known_machines()
+
+
+class IngestSamplesTests(TelemetryTestCase):
+    def test_partial_reject_reports_each_index(self):
+        samples = [sample(0), sample(1, ppm="fast"), telemetry.TelemetryError("Invalid JSON line"), sample(3)]
+        accepted, results = telemetry.ingest_samples(samples)
+
+        self.assertEqual(accepted, 2)
+        self.assertEqual([r["status"] for r in results], ["accepted", "rejected", "rejected", "accepted"])
+        self.assertEqual([r["index"] for r in results], [0, 1, 2, 3])
+        self.assertIn("'ppm'", results[1]["error"])
+        self.assertEqual(MachineTelemetry.objects.filter(machine_id="TEST-1").count(), 2)
+
+    def test_out_of_range_batch_count_is_rejected_alone(self):
+        samples = [
+            sample(0),
+            sample(1, batch_count=2 ** 64),
+            sample(2, batch_count=2 ** 31),
+            sample(3, batch_count=-(2 ** 31)),
+            sample(4, batch_count=float("inf")),
+        ]
+        accepted, results = telemetry.ingest_samples(samples)
+
+        self.assertEqual(accepted, 2)
+        self.assertEqual([r["status"] for r in results], ["accepted", "rejected", "rejected", "accepted", "rejected"])
+        self.assertIn("'batch_count' must be between", results[1]["error"])
+        self.assertEqual(MachineTelemetry.objects.filter(machine_id="TEST-1").count(), 2)
+
+    def test_replayed_batch_is_stored_and_buffered_once(self):
+        batch = [sample(i) for i in range(5)]
+        self.assertEqual(telemetry.ingest_samples(batch)[0], 5)
+        # The resend overlaps the first batch and repeats one sample within itself.
+        accepted, results = telemetry.ingest_samples(batch[2:] + [sample(5), sample(5)])
+
+        self.assertEqual(accepted, 5)
+        self.assertTrue(all(r["status"] == "accepted" for r in results))
+        self.assertEqual(MachineTelemetry.objects.filter(machine_id="TEST-1").count(), 6)
+        ring = ringbuffer.recent("TEST-1")
+        self.assertEqual(len(ring), 6)
+        self.assertEqual(len(set(ring["ts"])), 6)
+
+    def test_insert_rows_returns_only_new_rows(self):
+        first = telemetry.insert_rows([telemetry.clean_sample(sample(i)) for i in range(3)])
+        again = telemetry.insert_rows([telemetry.clean_sample(sample(i)) for i in range(4)])
+
+        self.assertEqual(len(first), 3)
+        self.assertEqual([r.seq for r in again], [3])
+
+    def test_samples_without_seq_are_never_deduplicated(self):
+        rows = [telemetry.clean_sample(sample(0, seq=None)) for _ in range(2)]
+        self.assertEqual(len(telemetry.insert_rows(rows)), 2)
+
+    def test_seq_requires_ts(self):
+        with self.assertRaisesMessage(telemetry.TelemetryError, "'seq' requires 'ts'"):
+            telemetry.clean_sample(sample(1, ts=None))
+        self.assertIsNone(telemetry.clean_sample(sample(1, ts=None, seq=None)).seq)
+
+
+class WriteBehindTests(TelemetryTestCase):
+    def test_flush_counts_and_buffers_only_new_rows(self):
+        buffer = writebehind.WriteBehindBuffer(max_rows=100, flush_rows=10, flush_interval=0.05)
+        # The flusher normally owns its connection; here it shares the test's transaction.
+        with mock.patch.object(writebehind, "close_old_connections"):
+            buffer._write([telemetry.clean_sample(sample(i)) for i in range(4)])
+            buffer._write([telemetry.clean_sample(sample(i)) for i in range(2, 6)])
+
+        self.assertEqual(buffer.written, 6)
+        self.assertEqual(MachineTelemetry.objects.filter(machine_id="TEST-1").count(), 6)
+        self.assertEqual(len(ringbuffer.recent("TEST-1")), 6)
+
+    def test_bad_row_is_dropped_and_later_batches_still_written(self):
+        buffer = writebehind.WriteBehindBuffer(max_rows=100, flush_rows=10, flush_interval=0.05)
+        bad = telemetry.clean_sample(sample(1))
+        bad.batch_count = 2 ** 40  # past validation, as a future bug might let through
+        with mock.patch.object(writebehind, "close_old_connections"), mock.patch.object(
+            writebehind.time, "sleep"
+        ) as sleep:
+            buffer._write([telemetry.clean_sample(sample(0)), bad, telemetry.clean_sample(sample(2))])
+            buffer._write([telemetry.clean_sample(sample(i)) for i in range(3, 6)])
+
+        sleep.assert_not_called()
+        self.assertEqual((buffer.written, buffer.dropped), (5, 1))
+        stored = MachineTelemetry.objects.filter(machine_id="TEST-1").values_list("seq", flat=True)
+        self.assertEqual(sorted(stored), [0, 2, 3, 4, 5])
+
+    def test_transient_errors_are_retried(self):
+        buffer = writebehind.WriteBehindBuffer(max_rows=100, flush_rows=10, flush_interval=0.05)
+        real_insert = telemetry.insert_rows
+        calls = []
+
+        def flaky(rows):
+            calls.append(len(rows))
+            if len(calls) == 1:
+                raise writebehind.OperationalError("server closed the connection unexpectedly")
+            return real_insert(rows)
+
+        with mock.patch.object(writebehind, "close_old_connections"), mock.patch.object(
+            writebehind, "connection"
+        ), mock.patch.object(writebehind.time, "sleep"), mock.patch.object(writebehind, "insert_rows", flaky):
+            buffer._write([telemetry.clean_sample(sample(i)) for i in range(3)])
+
+        self.assertEqual(calls, [3, 3])
+        self.assertEqual((buffer.written, buffer.dropped), (3, 0))
+
+    def test_after_ingest_failure_does_not_escape(self):
+        buffer = writebehind.WriteBehindBuffer(max_rows=100, flush_rows=10, flush_interval=0.05)
+        with mock.patch.object(writebehind, "close_old_connections"), mock.patch.object(
+            writebehind, "after_ingest", side_effect=RuntimeError("cache down")
+        ):
+            buffer._write([telemetry.clean_sample(sample(0))])
+        self.assertEqual(buffer.written, 1)
+
+    def test_full_queue_refuses_the_whole_offer(self):
+        buffer = writebehind.WriteBehindBuffer(max_rows=3, flush_rows=10, flush_interval=60)
+        with mock.patch.object(buffer, "start"):
+            self.assertTrue(buffer.offer([1, 2]))
+            self.assertFalse(buffer.offer([3, 4]))
+        self.assertEqual(len(buffer), 2)
+
+
+class RingBufferTests(TelemetryTestCase):
+    def ring(self, slots=2):
+        return ringbuffer.RingBuffer(os.path.join(self.tmp, "small.dat"), slots, 10)
+
+    def rows(self, machine_id, n=3):
+        return [telemetry.clean_sample(sample(i, machine_id=machine_id)) for i in range(n)]
+
+    def test_unknown_machines_get_no_slot(self):
+        ringbuffer.append(self.rows("TEST-1") + self.rows("bogus"))
+        self.assertEqual(len(ringbuffer.recent("TEST-1")), 3)
+        self.assertIsNone(ringbuffer.recent("bogus"))
+
+    def test_new_machine_is_buffered_once_registered(self):
+        ringbuffer.known_machine_ids()
+        CustomerMachine.objects.create(customer=self.customer, name="Line 2", telemetry_id="TEST-2")
+        ringbuffer.append(self.rows("TEST-2"))
+        self.assertEqual(len(ringbuffer.recent("TEST-2")), 3)
+
+    def test_idle_slot_is_evicted_when_full(self):
+        ring = self.ring()
+        ring.append(self.rows("A") + self.rows("B"))
+        ring.append(self.rows("C"))
+        self.assertIsNone(ring.recent("C"))  # every slot busy
+
+        ring._directory["updated"][ring._slot("A", create=False)] -= ringbuffer.EVICT_IDLE_SECONDS + 1
+        ring.append(self.rows("C", 2))
+        self.assertIsNone(ring.recent("A"))
+        self.assertEqual(len(ring.recent("B")), 3)
+        self.assertEqual(len(ring.recent("C")), 2)
+
+    def test_other_process_sees_an_evicted_slot(self):
+        mine, theirs = self.ring(slots=3), self.ring(slots=3)
+        mine.append(self.rows("A") + self.rows("B"))
+        self.assertEqual(len(theirs.recent("A")), 3)  # caches A's slot
+
+        mine.release(["A"])
+        mine.append(self.rows("C", 1))  # takes A's old slot
+        self.assertIsNone(theirs.recent("A"))
+        theirs.append(self.rows("A", 2))
+        self.assertEqual(len(mine.recent("C")), 1)
+        self.assertEqual(len(mine.recent("A")), 2)
+
+    def test_release_frees_slots(self):
+        ring = self.ring()
+        ring.append(self.rows("bench-1") + self.rows("bench-2"))
+        self.assertEqual(ring.release(["bench-1", "bench-2", "never"]), 2)
+        ring.append(self.rows("A") + self.rows("B"))
+        self.assertEqual(len(ring.recent("A")), 3)
+        self.assertEqual(len(ring.recent("B")), 3)
+
+
+class BenchIngestTests(TelemetryTestCase):
+    def test_prefix_must_not_cover_real_machines(self):
+        for prefix in ("", "  ", "TE", "TEST"):
+            with self.assertRaises(CommandError):
+                call_command("bench_ingest", prefix=prefix, duration=0.1)
+        self.assertTrue(CustomerMachine.objects.filter(telemetry_id="TEST-1").exists())
+
+
+class RollupTests(TelemetryTestCase):
+    def ingest(self, seconds, **extra):
+        telemetry.ingest_samples([sample(i, **extra) for i in seconds])
+
+    def roll(self, minutes=10):
+        return rollups.run_rollups(now=T0 + timedelta(minutes=minutes))
+
+    def buckets(self, resolution=rollups.MINUTE):
+        return {
+            r.bucket_start: r
+            for r in MachineTelemetryRollup.objects.filter(machine_id="TEST-1", resolution=resolution)
+        }
+
+    def test_in_order_ingest(self):
+        self.ingest(range(120))
+        self.assertEqual(self.roll(), 2)
+
+        first, second = (self.buckets()[T0 + timedelta(minutes=m)] for m in (0, 1))
+        self.assertEqual((first.sample_count, second.sample_count), (60, 60))
+        self.assertEqual((first.ppm_min, first.ppm_max, first.temp_min, first.temp_max), (30.0, 36.0, 40.0, 42.0))
+        self.assertAlmostEqual(first.ppm_avg, sum(30.0 + i % 7 for i in range(60)) / 60)
+        # The counter goes up by one per sample; the first sample has no predecessor.
+        self.assertEqual((first.batch_delta, second.batch_delta), (59, 60))
+        # The last sample's time only ends when the next one arrives.
+        self.assertEqual((first.status_seconds, second.status_seconds), ({"RUNNING": 60}, {"RUNNING": 59}))
+
+        hour = self.buckets(rollups.HOUR)[T0]
+        self.assertEqual((hour.sample_count, hour.batch_delta, hour.status_seconds), (120, 119, {"RUNNING": 119}))
+        day = self.buckets(rollups.DAY)[rollups.floor_time(T0, rollups.DAY)]
+        self.assertEqual((day.sample_count, day.batch_delta), (120, 119))
+
+    def test_rerun_gives_the_same_rollups(self):
+        self.ingest(range(90))
+        self.roll()
+        before = {k: (r.sample_count, r.ppm_avg, r.batch_delta, r.status_seconds) for k, r in self.buckets().items()}
+        TelemetryRollupMark.objects.all().delete()
+        self.roll()
+        after = {k: (r.sample_count, r.ppm_avg, r.batch_delta, r.status_seconds) for k, r in self.buckets().items()}
+        self.assertEqual(after, before)
+
+    def test_late_samples_are_rolled_up_again(self):
+        self.ingest(list(range(60)) + list(range(120, 180)))
+        TelemetryRollupMark.objects.filter(name=rollups.REDO_MARK_NAME).delete()
+        self.roll()
+        self.assertNotIn(T0 + timedelta(minutes=1), self.buckets())
+        self.assertEqual(self.buckets(rollups.HOUR)[T0].sample_count, 120)
+
+        # A store-and-forward replay of the missing minute.
+        self.ingest(range(60, 120))
+        redo = TelemetryRollupMark.objects.get(name=rollups.REDO_MARK_NAME)
+        self.assertEqual(redo.position, T0)  # one gap earlier: the sample before changes too
+
+        self.roll()
+        self.assertFalse(TelemetryRollupMark.objects.filter(name=rollups.REDO_MARK_NAME).exists())
+        minutes = self.buckets()
+        self.assertEqual([minutes[T0 + timedelta(minutes=m)].sample_count for m in range(3)], [60, 60, 60])
+        self.assertEqual(minutes[T0].status_seconds, {"RUNNING": 60})
+        self.assertEqual(minutes[T0 + timedelta(minutes=1)].batch_delta, 60)
+        hour = self.buckets(rollups.HOUR)[T0]
+        self.assertEqual((hour.sample_count, hour.batch_delta), (180, 179))
+
+    def test_live_samples_leave_no_redo_mark(self):
+        now = timezone.now()
+        rollups.note_late_samples([telemetry.clean_sample(sample(ts=now.timestamp()))])
+        self.assertFalse(TelemetryRollupMark.objects.filter(name=rollups.REDO_MARK_NAME).exists())
+
+        rollups.note_late_samples([telemetry.clean_sample(sample(ts=(now - timedelta(minutes=5)).timestamp()))])
+        rollups.note_late_samples([telemetry.clean_sample(sample(ts=(now - timedelta(minutes=2)).timestamp()))])
+        redo = TelemetryRollupMark.objects.get(name=rollups.REDO_MARK_NAME)
+        expected = rollups.floor_time(now - timedelta(minutes=5) - rollups.MAX_SAMPLE_GAP, rollups.MINUTE)
+        self.assertEqual(redo.position, expected)
+
+    def test_choose_resolution_boundaries(self):
+        for span, points, expected in [
+            (timedelta(0), 1, "raw"),
+            (timedelta(seconds=100), 100, "raw"),
+            (timedelta(seconds=101), 100, rollups.MINUTE),
+            (timedelta(minutes=100), 100, rollups.MINUTE),
+            (timedelta(minutes=100, seconds=1), 100, rollups.HOUR),
+            (timedelta(hours=100), 100, rollups.HOUR),
+            (timedelta(hours=101), 100, rollups.DAY),
+            (timedelta(days=10_000), 100, rollups.DAY),
+        ]:
+            self.assertEqual(rollups.choose_resolution(T0, T0 + span, points), expected, (span, points))
+
+
+@override_settings(TELEMETRY_ALERTS_ENABLED=True)
+class AlertTests(TelemetryTestCase):
+    def setUp(self):
+        super().setUp()
+        alerts.reset()
+        self.addCleanup(alerts.reset)
+
+    def configure(self, **thresholds):
+        MachineAlertSettings.objects.create(machine_id="TEST-1", **{"stopped_seconds": None, **thresholds})
+
+    def ingest(self, seconds, **extra):
+        telemetry.ingest_samples([sample(i, **extra) for i in seconds])
+
+    def open_kinds(self):
+        return set(Alert.objects.filter(cleared_at__isnull=True).values_list("kind", flat=True))
+
+    def test_temperature_must_stay_out_of_band_for_the_hold_time(self):
+        self.configure(temp_max=50)
+        self.ingest(range(alerts.TEMP_HOLD_SECONDS), temp=60.0)
+        self.assertEqual(self.open_kinds(), set())
+
+        self.ingest([alerts.TEMP_HOLD_SECONDS], temp=60.0)
+        alert = Alert.objects.get()
+        self.assertEqual((alert.kind, alert.value), (Alert.KIND_TEMP, 60.0))
+        self.assertEqual(alert.raised_at, T0 + timedelta(seconds=alerts.TEMP_HOLD_SECONDS))
+
+        self.ingest([alerts.TEMP_HOLD_SECONDS + 1])
+        alert.refresh_from_db()
+        self.assertEqual(alert.cleared_at, T0 + timedelta(seconds=alerts.TEMP_HOLD_SECONDS + 1))
+
+    def test_a_single_noisy_reading_does_not_alert(self):
+        self.configure(temp_max=50)
+        self.ingest([0], temp=60.0)
+        self.ingest(range(1, 30))
+        self.assertFalse(Alert.objects.exists())
+
+    def test_batch_stall_while_running(self):
+        self.configure(batch_stall_seconds=30)
+        self.ingest(range(30), batch_count=5)
+        self.assertEqual(self.open_kinds(), set())
+        self.ingest([30], batch_count=5)
+        self.assertEqual(self.open_kinds(), {Alert.KIND_BATCH_STALLED})
+        self.ingest([31], batch_count=6)
+        self.assertEqual(self.open_kinds(), set())
+
+    def test_stalled_counter_while_stopped_is_not_a_stall(self):
+        self.configure(batch_stall_seconds=30)
+        self.ingest(range(60), batch_count=5, status="STOPPED")
+        self.assertFalse(Alert.objects.exists())
+
+    def test_alert_is_cleared_before_it_reopens(self):
+        self.configure(stopped_seconds=0)
+        self.ingest([0], status="STOPPED")
+        # Recovery and a new episode arrive in the same request.
+        telemetry.ingest_samples([sample(1), sample(2, status="STOPPED")])
+
+        episodes = list(Alert.objects.order_by("raised_at").values_list("raised_at", "cleared_at"))
+        self.assertEqual(episodes, [(T0, T0 + timedelta(seconds=1)), (T0 + timedelta(seconds=2), None)])
+
+    def test_late_samples_are_skipped(self):
+        self.configure(temp_max=50)
+        self.ingest([60])
+        self.ingest(range(30), temp=60.0)  # replayed from before the newest sample
+        self.assertFalse(Alert.objects.exists())
+
+    def test_unknown_machines_are_ignored(self):
+        MachineAlertSettings.objects.create(machine_id="GHOST", stopped_seconds=0)
+        self.ingest([0], machine_id="GHOST", status="STOPPED")
+        self.assertFalse(Alert.objects.exists())
+        self.assertNotIn("GHOST", alerts._states)
+
+
+@override_settings(TELEMETRY_SHIFTS="Early=06:00,Late=14:00,Night=22:00", TELEMETRY_SHIFT_TIMEZONE="UTC")
+class UtilisationTests(TestCase):
+    def at(self, hour, minute=0, day=2):
+        return datetime(2026, 3, day, hour, minute, tzinfo=dt_timezone.utc)
+
+    def shift_at(self, ts):
+        return utilisation.current_period(ts)
+
+    def rollup(self, start, **status_seconds):
+        MachineTelemetryRollup.objects.create(
+            machine_id="TEST-1", resolution=rollups.HOUR, bucket_start=start, sample_count=3600,
+            ppm_min=30.0, ppm_max=30.0, ppm_avg=30.0, temp_min=40.0, temp_max=40.0, temp_avg=40.0,
+            status_seconds=status_seconds,
+        )
+
+    def test_parse_shifts(self):
+        self.assertEqual(
+            utilisation.parse_shifts("22:00, Early=06:00,,Late=14:00"),
+            [("Early", dt_time(6)), ("Late", dt_time(14)), ("Shift 1", dt_time(22))],
+        )
+        self.assertEqual(utilisation.parse_shifts(""), [])
+        with self.assertRaises(ValueError):
+            utilisation.parse_shifts("Early=6am")
+
+    def test_shift_boundaries(self):
+        self.assertEqual(self.shift_at(self.at(13, 59)).name, "Early")
+        late = self.shift_at(self.at(14))
+        self.assertEqual((late.name, late.start, late.end), ("Late", self.at(14), self.at(22)))
+        # The last shift runs over midnight, into the next day.
+        night = self.shift_at(self.at(2, day=3))
+        self.assertEqual((night.name, night.start, night.end), ("Night", self.at(22), self.at(6, day=3)))
+
+        periods = utilisation.periods_overlapping(self.at(6), self.at(14))
+        self.assertEqual([(p.kind, p.name) for p in periods], [("day", ""), ("shift", "Early")])
+
+    @override_settings(TELEMETRY_SHIFT_TIMEZONE="Europe/London")
+    def test_shifts_follow_the_local_clock(self):
+        # Clocks go forward on 29 March 2026: 06:00 BST is 05:00 UTC and the day is 23 hours long.
+        early = self.shift_at(self.at(5, day=29))
+        self.assertEqual((early.name, early.start), ("Early", self.at(5, day=29)))
+        day = [p for p in utilisation.periods_overlapping(self.at(12, day=29), self.at(13, day=29)) if p.kind == "day"]
+        self.assertEqual(day[0].end - day[0].start, timedelta(hours=23))
+
+    @override_settings(TELEMETRY_SHIFTS="")
+    def test_without_shifts_the_period_is_the_day(self):
+        period = self.shift_at(self.at(15))
+        self.assertEqual((period.kind, period.start, period.end), ("day", self.at(0), self.at(0, day=3)))
+
+    def test_build_splits_at_the_shift_change(self):
+        MachineAlertSettings.objects.create(machine_id="TEST-1", ppm_target=60.0)
+        self.rollup(self.at(13), RUNNING=3600)
+        self.rollup(self.at(14), RUNNING=1800)
+        utilisation.build_utilisation(self.at(13), self.at(15))
+
+        rows = {r.name: r for r in MachineUtilisation.objects.filter(period="shift")}
+        early, late = rows["Early"], rows["Late"]
+        self.assertEqual((early.running_seconds, early.elapsed_seconds), (3600, 8 * 3600))
+        self.assertEqual((late.running_seconds, late.elapsed_seconds), (1800, 3600))
+        self.assertEqual((late.reporting_seconds, late.utilisation, late.availability), (1800, 0.5, 1.0))
+        # 30 ppm against a target of 60.
+        self.assertEqual((late.performance, late.oee), (0.5, 0.5))
+
+    def test_zero_planned_time_gives_no_ratios(self):
+        row = MachineUtilisation(machine_id="TEST-1", period="shift", period_start=self.at(14), period_end=self.at(22))
+        self.assertEqual((row.utilisation, row.availability, row.performance, row.oee), (None, None, None, None))
+        snapshot = utilisation.utilisation_snapshot(row)
+        self.assertEqual((snapshot["utilisation"], snapshot["oee"]), (None, None))
+
+        row.elapsed_seconds = row.reporting_seconds = row.running_seconds = 600.0
+        row.ppm_target = 0.0
+        self.assertEqual((row.utilisation, row.availability, row.performance, row.oee), (1.0, 1.0, None, None))
+
+    def test_build_before_the_period_has_started(self):
+        self.rollup(self.at(14), RUNNING=3600)
+        utilisation.build_utilisation(self.at(14), self.at(15), mark=self.at(14))
+        self.assertFalse(MachineUtilisation.objects.exists())
+
+
+class AnomalyTests(TelemetryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.noise = np.random.default_rng(3).normal(0.0, 1.0, 1200)
+
+    def test_window_stats_match_direct_computation(self):
+        x = self.noise[:50] + 100.0
+        mean, std = anomalies._window_stats(x, 7, 0.0)
+        self.assertEqual(len(mean), 50 - 7 + 1)
+        for i in (0, 20, 43):
+            self.assertAlmostEqual(mean[i], x[i:i + 7].mean())
+            self.assertAlmostEqual(std[i], x[i:i + 7].std())
+        _, floored = anomalies._window_stats(np.zeros(20), 5, 0.5)
+        self.assertTrue(np.all(floored == 0.5))
+
+    def test_zscore_flags_one_run_per_spike(self):
+        x = self.noise.copy()
+        x[700:703] = 12.0
+        found = anomalies.zscore_anomalies(x, window=300)
+        self.assertEqual([(f.kind, f.start, f.end) for f in found], [(TelemetryAnomaly.KIND_ZSCORE, 700, 703)])
+        self.assertEqual(found[0].value, 12.0)
+        self.assertEqual(anomalies.zscore_anomalies(x[:300], window=300), [])
+
+    def test_change_point_finds_a_level_shift(self):
+        x = self.noise.copy()
+        x[600:] += 10.0
+        found = anomalies.change_points(x, window=100)
+        self.assertEqual(len(found), 1)
+        self.assertEqual((found[0].kind, found[0].start, found[0].end), (TelemetryAnomaly.KIND_CHANGE_POINT, 500, 700))
+        self.assertAlmostEqual(found[0].value - found[0].baseline, 10.0, delta=0.5)
+        self.assertEqual(anomalies.change_points(x[:199], window=100), [])
+
+    def test_detect_stores_and_replaces_anomalies(self):
+        samples = [sample(i, temp=175.0 + round(float(self.noise[i]) * 0.5, 2)) for i in range(400)]
+        samples[350]["temp"] = 200.0
+        # ppm drops to zero on a stop; that is not an anomaly.
+        for i in range(360, 380):
+            samples[i].update(ppm=0.0, status="STOPPED")
+        telemetry.ingest_samples(samples)
+
+        end = T0 + timedelta(minutes=10)
+        self.assertEqual(anomalies.detect_anomalies(T0, end, window=60), 1)
+        self.assertEqual(anomalies.detect_anomalies(T0, end, window=60), 1)
+        anomaly = TelemetryAnomaly.objects.get()
+        self.assertEqual((anomaly.metric, anomaly.kind, anomaly.value), ("temp", TelemetryAnomaly.KIND_ZSCORE, 200.0))
+        self.assertEqual(anomaly.window_start, T0 + timedelta(seconds=350))
+
+    def test_endpoint_is_staff_only(self):
+        TelemetryAnomaly.objects.create(
+            machine_id="TEST-1", metric="temp", kind=TelemetryAnomaly.KIND_ZSCORE, window_start=timezone.now(),
+            window_end=timezone.now(), sample_count=1, score=9.0, value=200.0, baseline=175.0,
+        )
+        client = Client(HTTP_HOST="localhost")
+        url = reverse("api_telemetry_anomalies")
+        self.assertEqual(client.get(url).status_code, 403)
+
+        CustomerProfile.objects.create(user=self.customer)
+        client.force_login(self.customer)
+        self.assertEqual(client.get(url).status_code, 403)
+
+        client.force_login(get_user_model().objects.create_user("staff", is_staff=True))
+        data = client.get(url).json()
+        machines = [(m["machine_id"], m["name"], m["customer"]) for m in data["machines"]]
+        self.assertEqual(machines, [("TEST-1", "Line 1", "acme")])
+        self.assertEqual(len(data["anomalies"]), 1)
+        self.assertEqual(client.get(url, {"kind": "spike"}).status_code, 400)
+
+
+# Templates without collectstatic's manifest.
+@override_settings(STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage")
+class PortalDashboardTests(TelemetryTestCase):
+    def setUp(self):
+        super().setUp()
+        CustomerProfile.objects.create(user=self.customer)
+        other = get_user_model().objects.create_user("other")
+        CustomerMachine.objects.create(customer=self.customer, name="Line 2", telemetry_id="TEST-2")
+        CustomerMachine.objects.create(customer=self.customer, name="Old line", telemetry_id="TEST-3", is_active=False)
+        CustomerMachine.objects.create(customer=other, name="Theirs", telemetry_id="OTHER-1")
+
+        now = timezone.now()
+        telemetry.ingest_samples(
+            [
+                sample(0, ts=now.timestamp()),
+                sample(0, machine_id="TEST-2", ts=(now - timedelta(minutes=10)).timestamp()),
+                sample(0, machine_id="TEST-3", ts=now.timestamp()),
+                sample(0, machine_id="OTHER-1", ts=now.timestamp()),
+            ]
+        )
+        for machine_id, cleared_at in (("TEST-1", None), ("TEST-2", now), ("TEST-3", None), ("OTHER-1", None)):
+            Alert.objects.create(
+                machine_id=machine_id, kind=Alert.KIND_TEMP, message="hot", raised_at=now, cleared_at=cleared_at
+            )
+        self.client = Client(HTTP_HOST="localhost")
+
+    def test_customer_sees_only_their_active_machines(self):
+        self.client.force_login(self.customer)
+        response = self.client.get(reverse("portal_dashboard"))
+        self.assertEqual(response.status_code, 200)
+
+        machines = {m["name"]: m for m in response.context["dashboard_machines"]}
+        self.assertEqual(sorted(machines), ["Line 1", "Line 2"])
+        self.assertNotContains(response, "OTHER-1")
+        self.assertEqual(machines["Line 1"]["status"], "RUNNING")
+        self.assertEqual(machines["Line 2"]["status"], "OFFLINE")  # last seen 10 minutes ago
+        self.assertEqual([a["message"] for a in machines["Line 1"]["alerts"]], ["hot"])
+        self.assertEqual(machines["Line 2"]["alerts"], [])
+        self.assertEqual(response.context["headline"], {"machines_online": 1, "alerts": 1})
+
+    def test_anonymous_is_sent_to_login(self):
+        response = self.client.get(reverse("portal_dashboard"))
+        self.assertRedirects(
+            response, f"{reverse('portal_login')}?next={reverse('portal_dashboard')}", fetch_redirect_response=False
+        )
+
+
+class MachineMetricsStreamTests(TelemetryTestCase):
+    def setUp(self):
+        super().setUp()
+        CustomerProfile.objects.create(user=self.customer)
+        CustomerMachine.objects.create(customer=self.customer, name="Line 2", telemetry_id="TEST-2")
+        other = get_user_model().objects.create_user("other")
+        CustomerMachine.objects.create(customer=other, name="Theirs", telemetry_id="OTHER-1")
+        telemetry.ingest_samples([sample(0, machine_id=m) for m in ("TEST-1", "TEST-2", "OTHER-1")])
+
+        poll = mock.patch("core.views.STREAM_POLL_SECONDS", 0.01)
+        poll.start()
+        self.addCleanup(poll.stop)
+
+    async def next_event(self, stream):
+        """(event, data) of the next message, skipping retry and keep-alive lines."""
+        while True:
+            chunk = await anext(stream)
+            chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+            if chunk.startswith("event:"):
+                event, data = chunk.strip().split("\n")
+                return event.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+
+    async def test_snapshot_then_diffs_for_own_machines_only(self):
+        client = AsyncClient(headers={"host": "localhost"})
+        await client.aforce_login(self.customer)
+        response = await client.get(reverse("api_machine_metrics_stream"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        stream = aiter(response.streaming_content)
+        try:
+            first = [await self.next_event(stream), await self.next_event(stream)]
+            self.assertEqual([e for e, _ in first], ["snapshot", "snapshot"])
+            self.assertEqual(sorted(d["machine_id"] for _, d in first), ["TEST-1", "TEST-2"])
+
+            await sync_to_async(telemetry.ingest_samples)([sample(1, ppm=55.0)])
+            event, data = await self.next_event(stream)
+            self.assertEqual(event, "metrics")
+            self.assertEqual(data["machine_id"], "TEST-1")
+            self.assertEqual(data["metrics"]["ppm"], 55.0)
+            self.assertNotIn("status", data)  # unchanged fields are left out
+        finally:
+            await stream.aclose()
+
+    async def test_anonymous_is_refused(self):
+        response = await AsyncClient(headers={"host": "localhost"}).get(reverse("api_machine_metrics_stream"))
+        self.assertEqual(response.status_code, 403)
+
+
+class DownsampleTests(TestCase):
+    def test_short_series_is_returned_whole(self):
+        x = np.arange(10.0)
+        for threshold in (10, 11, 1000, 2):
+            self.assertEqual(downsample.lttb_indices(x, x, threshold).tolist(), list(range(10)), threshold)
+
+    def test_keeps_first_last_and_extremes(self):
+        rng = np.random.default_rng(7)
+        x = np.arange(10_000.0)
+        y = rng.normal(30.0, 0.5, len(x))
+        y[1234], y[8765] = 80.0, -20.0
+        idx = downsample.lttb_indices(x, y, 100)
+
+        self.assertEqual(len(idx), 100)
+        self.assertEqual((idx[0], idx[-1]), (0, len(x) - 1))
+        self.assertTrue(np.all(np.diff(idx) > 0))
+        self.assertIn(1234, idx)
+        self.assertIn(8765, idx)
+
+    def test_lttb_returns_the_chosen_points(self):
+        x, y = np.arange(50.0), np.sin(np.arange(50.0))
+        xs, ys = downsample.lttb(x, y, 10)
+        self.assertEqual(len(xs), 10)
+        self.assertEqual(ys.tolist(), y[xs.astype(int)].tolist())
+
+
+class MachineHistoryTests(TelemetryTestCase):
+    def setUp(self):
+        super().setUp()
+        CustomerProfile.objects.create(user=self.customer)
+        self.client = Client(HTTP_HOST="localhost")
+        self.client.force_login(self.customer)
+        samples = [sample(i) for i in range(600)]
+        samples[300]["ppm"] = 99.0
+        telemetry.ingest_samples(samples)
+
+    def get(self, **params):
+        query = {"machine_id": "TEST-1", "from": T0.isoformat(), "to": (T0 + timedelta(minutes=10)).isoformat()}
+        return self.client.get(reverse("api_machine_metrics_history"), {**query, **params})
+
+    def test_downsamples_raw_samples(self):
+        response = self.get(points=50)
+        self.assertEqual(response.status_code, 200, response.content)
+        data = response.json()
+        self.assertEqual((data["resolution"], data["source_points"]), ("raw", 600))
+        ppm = data["series"]["ppm"]
+        self.assertEqual(len(ppm), 50)
+        self.assertEqual(ppm[0][0], int(T0.timestamp() * 1000))
+        self.assertEqual(ppm[-1][0], int(T0.timestamp() * 1000) + 599_000)
+        self.assertIn([int(T0.timestamp() * 1000) + 300_000, 99.0], ppm)
+
+    def test_fewer_samples_than_points_are_returned_as_is(self):
+        data = self.get(points=1000).json()
+        self.assertEqual(len(data["series"]["temp"]), 600)
+
+    def test_bad_parameters(self):
+        self.assertEqual(self.get(points="many").status_code, 400)
+        self.assertEqual(self.get(**{"from": "yesterday"}).status_code, 400)
+        self.assertEqual(self.get(to=T0.isoformat()).status_code, 400)
+
+    def test_only_the_customers_own_machines(self):
+        other = get_user_model().objects.create_user("other")
+        CustomerMachine.objects.create(customer=other, name="Theirs", telemetry_id="OTHER-1")
+        self.assertEqual(self.get(machine_id="OTHER-1").status_code, 404)
+
+        self.client.logout()
+        self.assertEqual(self.get().status_code, 403)
+
+
+class MachineClientTests(TestCase):
+    def setUp(self):
+        self.client_module = load_machine_client()
+        self.client_module.MACHINE_ID = "TEST-1"
+        self.client_module.print = mock.Mock()  # quiet its progress lines
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        self.spool = self.client_module.Spool(os.path.join(tmp, "spool.db"))
+        self.addCleanup(self.spool.db.close)
+        self.uploader = self.client_module.Uploader(self.spool)
+
+    def spool_samples(self, seconds):
+        for s in seconds:
+            self.spool.append({k: v for k, v in sample(s).items() if k != "seq"})
+        return self.spool.peek(100)
+
+    def test_long_gap_falls_back_to_ndjson(self):
+        headers, _ = self.uploader.encode(self.spool_samples([0, 1]))
+        self.assertEqual(headers["Content-Type"], self.client_module.COLUMNAR_CONTENT_TYPE)
+        headers, body = self.uploader.encode(self.spool_samples([30 * 24 * 3600]))
+        self.assertEqual(headers["Content-Type"], "application/x-ndjson")
+        self.assertEqual(len(gzip.decompress(body).splitlines()), 3)
+
+    def test_unencodable_batch_is_set_aside(self):
+        rows = self.spool_samples([0])
+        self.spool.db.execute("UPDATE samples SET payload = 'not json'")
+        with mock.patch.object(self.uploader.session, "post") as post:
+            self.assertTrue(self.uploader.flush())
+        post.assert_not_called()
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(self.spool.db.execute("SELECT id FROM set_aside").fetchall(), [(rows[0][0],)])
+
+    def test_repeated_500s_set_the_batch_aside(self):
+        self.spool_samples([0, 1])
+        error = mock.Mock(status_code=500, text="boom")
+        with mock.patch.object(self.uploader.session, "post", return_value=error):
+            for _ in range(self.client_module.MAX_SERVER_ERRORS - 1):
+                self.assertFalse(self.uploader.flush())
+            self.assertEqual(len(self.spool), 2)
+            self.assertTrue(self.uploader.flush())
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(self.spool.db.execute("SELECT COUNT(*) FROM set_aside").fetchone(), (2,))
+
+    def test_503s_are_retried_indefinitely(self):
+        self.spool_samples([0])
+        busy = mock.Mock(status_code=503, text="busy")
+        with mock.patch.object(self.uploader.session, "post", return_value=busy):
+            for _ in range(self.client_module.MAX_SERVER_ERRORS * 2):
+                self.assertFalse(self.uploader.flush())
+        self.assertEqual(len(self.spool), 1)
+
+
+class BlockCodecTests(TestCase):
+    def roundtrip(self, ts_us, ppm, temp, batch_count, status):
+        decoded = blocks.decode_block(blocks.encode_block(ts_us, ppm, temp, batch_count, status))
+        self.assertEqual(decoded["ts"].astype(np.int64).tolist(), list(ts_us))
+        # Bit for bit, so NaN and the sign of zero survive too.
+        for name, values in (("ppm", ppm), ("temp", temp)):
+            self.assertEqual(
+                decoded[name].view("<u8").tolist(), np.asarray(values, dtype="<f8").view("<u8").tolist(), name
+            )
+        self.assertEqual(decoded["batch_count"].tolist(), list(batch_count))
+        self.assertEqual(decoded["status"].tolist(), list(status))
+
+    def test_single_sample(self):
+        self.roundtrip([1_700_000_000_123_456], [30.5], [175.0], [42], ["RUNNING"])
+
+    def test_regular_clock_and_repeated_values(self):
+        n = 3600
+        ts = [1_700_000_000_000_000 + i * 1_000_000 for i in range(n)]
+        self.roundtrip(ts, [30.0] * n, [175.0] * n, [7] * n, ["RUNNING"] * n)
+
+    def test_special_floats(self):
+        values = [0.0, -0.0, float("nan"), float("inf"), -float("inf"), 5e-324, 1.7976931348623157e308, -1.5, -1.5, 0.0]
+        n = len(values)
+        self.roundtrip(list(range(n)), values, values[::-1], list(range(n)), ["RUNNING"] * n)
+
+    def test_large_and_irregular_gaps(self):
+        year = 365 * 86400 * 1_000_000
+        # Every delta-of-delta bucket, a clock stepping back, and batch_count's int32 extremes.
+        ts = [0, 1, 1_000_000, 1_000_001, 1_000_001 + 2**31, 30 * year, 30 * year + 1, -year, 0]
+        counts = [0, 2**31 - 1, -(2**31), 5, 5, 100, 2**31 - 1, -(2**31), 0]
+        n = len(ts)
+        self.roundtrip(ts, [1.0] * n, [2.0] * n, counts, ["RUNNING"] * n)
+
+    def test_status_runs(self):
+        status = ["RUNNING", "RUNNING", "STOPPED", "RUNNING", "ÉTAT", "ÉTAT", "IDLE"]
+        n = len(status)
+        self.roundtrip(list(range(n)), [0.0] * n, [0.0] * n, [0] * n, status)
+
+    def test_empty_block_is_refused(self):
+        with self.assertRaises(ValueError):
+            blocks.encode_block([], [], [], [], [])
+
+
+class CompactionTests(TelemetryTestCase):
+    def test_iter_samples_is_unchanged_by_compaction(self):
+        samples = [sample(i, ts=(T0 + timedelta(seconds=37 * i)).timestamp()) for i in range(200)]
+        samples[5]["ppm"] = float("-0.0")
+        samples[6]["status"] = "STOPPED"
+        telemetry.ingest_samples(samples)
+        start, end = T0 - timedelta(hours=1), T0 + timedelta(hours=4)
+        before = list(blocks.iter_samples("TEST-1", start, end))
+
+        result = blocks.compact_before(T0 + timedelta(hours=2))
+        self.assertGreater(result["rows"], 0)
+        self.assertTrue(MachineTelemetry.objects.filter(machine_id="TEST-1").exists())  # the hot tail stays raw
+        self.assertEqual(list(blocks.iter_samples("TEST-1", start, end)), before)
+
+        # A late sample in a compacted hour is merged in order, then compacted into the block.
+        telemetry.ingest_samples([sample(999, ts=(T0 + timedelta(seconds=38)).timestamp(), seq=999)])
+        with_late = list(blocks.iter_samples("TEST-1", start, end))
+        self.assertEqual(len(with_late), len(before) + 1)
+        self.assertEqual([r[0] for r in with_late], sorted(r[0] for r in with_late))
+        blocks.compact_before(T0 + timedelta(hours=2))
+        self.assertEqual(list(blocks.iter_samples("TEST-1", start, end)), with_late)
+
+
+class ExportTests(TelemetryTestCase):
+    def test_export_reads_windows_in_order_without_holding_a_transaction(self):
+        from django.db import connection
+
+        from .views import EXPORT_WINDOW, _export_chunks
+
+        step = EXPORT_WINDOW / 3
+        rows = [telemetry.clean_sample(sample(i, ts=(T0 + step * i).timestamp())) for i in range(10)]
+        telemetry.insert_rows(rows)
+
+        depth = len(connection.atomic_blocks)
+        chunks = _export_chunks("TEST-1", T0, T0 + step * 9, "ndjson")
+        body = next(chunks)
+        # Nothing is left open while the response waits on the client.
+        self.assertEqual(len(connection.atomic_blocks), depth)
+        body += "".join(chunks)
+
+        exported = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual([r["batch_count"] for r in exported], list(range(9)))
+
+
+@override_settings(TELEMETRY_REQUIRE_API_KEY=False)
+class ColumnarIngestTests(TelemetryTestCase):
+    """decode_columnar() against the machine client's encoder (the reference for the format)."""
+
+    def setUp(self):
+        super().setUp()
+        self.client = Client(HTTP_HOST="localhost")
+        self.samples = [sample(i) for i in range(5)]
+        self.body = load_machine_client().encode_columnar("TEST-1", self.samples)
+
+    def v1_body(self):
+        """The same samples as a version 1 body: no base_seq, no seq offsets."""
+        n = len(self.samples)
+        header = bytearray(self.body[:telemetry.COLUMNAR_HEADER.size])
+        header[4] = 1
+        machine_end = telemetry.COLUMNAR_HEADER.size + len("TEST-1")
+        return bytes(header) + self.body[telemetry.COLUMNAR_HEADER.size:machine_end] + self.body[machine_end + 8:-4 * n]
+
+    def post(self, body, **headers):
+        return self.client.post(
+            reverse("api_ingest_batch"), body, content_type=telemetry.COLUMNAR_CONTENT_TYPE, **headers
+        )
+
+    def test_v2_round_trip(self):
+        self.assertEqual(telemetry.decode_columnar(self.body), self.samples)
+
+    def test_v1_body_has_no_seq(self):
+        expected = [{k: v for k, v in s.items() if k != "seq"} for s in self.samples]
+        self.assertEqual(telemetry.decode_columnar(self.v1_body()), expected)
+
+    def test_gzip_upload_is_stored(self):
+        response = self.post(gzip.compress(self.body), HTTP_CONTENT_ENCODING="gzip")
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()["accepted"], 5)
+        stored = MachineTelemetry.objects.filter(machine_id="TEST-1").order_by("seq")
+        self.assertEqual([(r.seq, r.batch_count) for r in stored], [(i, i) for i in range(5)])
+
+        response = self.post(gzip.compress(self.v1_body()), HTTP_CONTENT_ENCODING="gzip")
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def test_unknown_status_code_rejects_that_sample_only(self):
+        body = bytearray(self.body)
+        status_at = len(body) - 4 * 5 - 5
+        body[status_at + 2] = 99
+        response = self.post(bytes(body))
+        self.assertEqual(response.status_code, 200, response.content)
+        data = response.json()
+        self.assertEqual((data["status"], data["accepted"], data["rejected"]), ("partial", 4, 1))
+        self.assertEqual(data["results"][2]["error"], "Unknown status code 99")
+
+    def test_malformed_bodies_are_400s(self):
+        bad_magic = b"XXXX" + self.body[4:]
+        bad_version = self.body[:4] + bytes([7]) + self.body[5:]
+        nan_base = self.body[:12] + struct.pack("<d", float("nan")) + self.body[20:]
+        bad_id = self.body[:20] + b"\xff" + self.body[21:]
+        gzipped = gzip.compress(self.body)
+        bodies = [self.body[:n] for n in range(len(self.body))]  # every truncation, empty included
+        bodies += [self.body + b"\0", bad_magic, bad_version, nan_base, bad_id]
+        for body in bodies:
+            with self.subTest(body=body[:24]):
+                self.assertEqual(self.post(body).status_code, 400)
+        for body in (gzipped[:-5], b"not gzip at all"):
+            with self.subTest(body=body[:24]):
+                self.assertEqual(self.post(body, HTTP_CONTENT_ENCODING="gzip").status_code, 400)
+        self.assertFalse(MachineTelemetry.objects.exists())
+
+
+class IngestAuthTests(TelemetryTestCase):
+    def setUp(self):
+        super().setUp()
+        ingest_auth.invalidate()
+        self.addCleanup(ingest_auth.invalidate)
+        self.key = MachineApiKey.objects.create(machine=self.machine)
+        self.client = Client(HTTP_HOST="localhost")
+
+    def post(self, samples, secret=None, timestamp=None, key_id=None):
+        body = json.dumps(samples).encode()
+        timestamp = str(int(time.time() if timestamp is None else timestamp))
+        headers = {
+            "HTTP_X_MPE_KEY": key_id or self.key.key_id,
+            "HTTP_X_MPE_TIMESTAMP": timestamp,
+            "HTTP_X_MPE_SIGNATURE": ingest_auth.sign(secret or self.key.secret, timestamp, body),
+        }
+        return self.client.post(reverse("api_ingest_batch"), body, content_type="application/json", **headers)
+
+    def test_signed_request_is_accepted(self):
+        response = self.post([sample(0), sample(1)])
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()["accepted"], 2)
+
+    def test_batch_reports_partial_reject(self):
+        response = self.post([sample(0), sample(1, ppm="fast"), sample(2)])
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data["status"], data["accepted"], data["rejected"]), ("partial", 2, 1))
+        self.assertEqual(data["results"][1]["status"], "rejected")
+
+        response = self.post([sample(3, ppm="fast")])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["status"], "error")
+
+    def test_bad_signature_unknown_key_and_skew_are_refused(self):
+        self.assertEqual(self.post([sample(0)], secret="wrong").status_code, 401)
+        self.assertEqual(self.post([sample(0)], key_id="nope").status_code, 401)
+        skew = ingest_auth.SIGNATURE_MAX_SKEW_SECONDS + 30
+        self.assertEqual(self.post([sample(0)], timestamp=time.time() - skew).status_code, 401)
+        self.assertEqual(self.post([sample(0)], timestamp=time.time() + skew).status_code, 401)
+        self.assertFalse(MachineTelemetry.objects.exists())
+
+    def test_timestamp_must_be_whole_seconds(self):
+        body = json.dumps([sample(0)]).encode()
+        for timestamp in ("nan", "inf", "-inf", "1e9", f"{time.time():.3f}", "soon"):
+            headers = {
+                "HTTP_X_MPE_KEY": self.key.key_id,
+                "HTTP_X_MPE_TIMESTAMP": timestamp,
+                "HTTP_X_MPE_SIGNATURE": ingest_auth.sign(self.key.secret, timestamp, body),
+            }
+            response = self.client.post(reverse("api_ingest_batch"), body, content_type="application/json", **headers)
+            self.assertEqual(response.status_code, 401, timestamp)
+        self.assertFalse(MachineTelemetry.objects.exists())
+
+    def test_key_may_only_send_its_own_machine(self):
+        self.assertEqual(self.post([sample(0, machine_id="OTHER")]).status_code, 403)
+
+    @override_settings(TELEMETRY_REQUIRE_API_KEY=True)
+    def test_unsigned_request_is_refused_when_keys_are_required(self):
+        response = self.client.post(reverse("api_ingest_batch"), json.dumps([sample(0)]), content_type="application/json")
+        self.assertEqual(response.status_code, 401)
+
+    def test_revoked_key_stops_working(self):
+        self.assertEqual(self.post([sample(0)]).status_code, 200)
+        self.key.is_active = False
+        self.key.save()
+        self.assertEqual(self.post([sample(1)]).status_code, 401)
+
+    def test_key_cache_is_bounded(self):
+        with mock.patch.object(ingest_auth, "MAX_CACHED_KEYS", 3):
+            for i in range(10):
+                self.post([sample(0)], key_id=f"made-up-{i}")
+            self.assertLessEqual(len(ingest_auth._keys), 3)
+
+
+class MetricKeyRegistryTests(TestCase):
+    def setUp(self):
+        metrics._key_ids.clear()
+        self.addCleanup(metrics._key_ids.clear)
+        customer = get_user_model().objects.create_user("acme")
+        CustomerMachine.objects.create(customer=customer, name="Line 1", telemetry_id="TEST-1")
+
+    def record(self, *names):
+        return {"machine_id": "TEST-1", "metrics": {name: 1.0 for name in names}}
+
+    def test_new_names_are_capped_per_request(self):
+        limit = metrics.MAX_NEW_KEYS_PER_REQUEST
+        records = [self.record(f"signal_{i}") for i in range(limit + 5)]
+        stored, results = metrics.ingest_metrics(records)
+
+        self.assertEqual(stored, limit)
+        self.assertEqual(MetricKey.objects.count(), limit)
+        self.assertEqual([r["status"] for r in results].count("rejected"), 5)
+        # Names already registered keep working whatever the cap.
+        self.assertEqual(metrics.ingest_metrics([self.record("signal_0")])[0], 1)
+
+    def test_registry_total_is_capped(self):
+        with mock.patch.object(metrics, "MAX_METRIC_KEYS", 3):
+            stored, results = metrics.ingest_metrics([self.record("a", "b"), self.record("c", "d")])
+        self.assertEqual(MetricKey.objects.count(), 3)
+        self.assertEqual([r["status"] for r in results], ["accepted", "rejected"])
+        self.assertEqual(MachineMetric.objects.count(), 2)
+
+
+class CataloguePageKeyTests(TestCase):
+    version = catalogue.Version(7, None)
+
+    def key(self, query):
+        return catalogue.page_key(self.version, QueryDict(query))
+
+    def test_unrecognised_parameters_share_a_key(self):
+        base = self.key("category=parts&limit=24")
+        self.assertEqual(self.key("category=parts&limit=24&x=1"), base)
+        self.assertEqual(self.key("limit=24&utm_source=ad&category=parts&_=123"), base)
+
+    def test_recognised_parameters_change_the_key(self):
+        base = self.key("category=parts")
+        for extra in ("q=seal", "in_stock=1", "fields=id", "limit=10", "cursor=abc", "material=Steel"):
+            self.assertNotEqual(self.key(f"category=parts&{extra}"), base, extra)
+        self.assertNotEqual(catalogue.page_key(self.version, QueryDict("category=parts"), "facets"), base)
+
+    def test_facet_value_order_and_blanks_do_not_matter(self):
+        self.assertEqual(
+            self.key("material=Steel&material=Brass&size="),
+            self.key("material=Brass&material=Steel&material=Steel"),
+        )
+
+    def test_pages_use_their_own_cache(self):
+        cache.clear()
+        caches[catalogue.PAGE_CACHE].clear()
+        catalogue.store_page("k", b"{}")
+        self.assertEqual(catalogue.get_page("k").body, b"{}")
+        self.assertIsNone(cache.get(catalogue.PAGE_CACHE_PREFIX + "k"))
+
+
+class ShopFacetTests(TestCase):
+    def counts(self):
+        return {(f, v): n for f, v, n in ShopFacetCount.objects.filter(count__gt=0).values_list("facet", "value", "count")}
+
+    def rebuilt(self):
+        current = self.counts()
+        facets.refresh_products()
+        self.assertEqual(self.counts(), current, "incremental counts differ from a full rebuild")
+        return current
+
+    def product(self, name, **fields):
+        return ShopProduct.objects.create(name=name, slug=name.lower().replace(" ", "-"), **fields)
+
+    def test_counts_follow_save_and_delete(self):
+        steel = self.product("Blade", specifications={"Material": "Steel", "Machine compatibility": "KP500, KP700"})
+        self.product("Seal", category="consumables", specifications={"material": "Silicone"})
+        self.assertEqual(
+            self.rebuilt(),
+            {
+                ("category", "parts"): 1,
+                ("category", "consumables"): 1,
+                ("material", "Steel"): 1,
+                ("material", "Silicone"): 1,
+                ("compatibility", "KP500"): 1,
+                ("compatibility", "KP700"): 1,
+            },
+        )
+
+        steel.specifications = {"material": "Silicone", "fits": "KP500"}
+        steel.save()
+        counts = self.rebuilt()
+        self.assertEqual(counts[("material", "Silicone")], 2)
+        self.assertNotIn(("material", "Steel"), counts)
+        self.assertNotIn(("compatibility", "KP700"), counts)
+
+        steel.is_active = False
+        steel.save()
+        self.assertEqual(self.rebuilt()[("material", "Silicone")], 1)
+
+        steel.is_active = True
+        steel.save()
+        steel.delete()
+        counts = self.rebuilt()
+        self.assertEqual(counts[("material", "Silicone")], 1)
+        self.assertNotIn(("compatibility", "KP500"), counts)
+        self.assertFalse(ShopProductFacet.objects.filter(product_id=steel.pk).exists())
+
+    def test_refresh_writes_the_stored_product(self):
+        product = self.product("Blade", specifications={"material": "Steel"})
+        stale = ShopProduct.objects.get(pk=product.pk)
+        ShopProduct.objects.filter(pk=product.pk).update(specifications={"material": "Brass"})
+        facets.refresh_product(stale)
+        self.assertEqual(self.rebuilt()[("material", "Brass")], 1)
+
+    def test_facet_counts_narrow_by_selection(self):
+        self.product("Blade", specifications={"material": "Steel", "size": "300mm"})
+        self.product("Knife", specifications={"material": "Steel", "size": "400mm"})
+        self.product("Seal", specifications={"material": "Silicone", "size": "300mm"})
+
+        out = {f["name"]: {v["value"]: v["count"] for v in f["values"]} for f in facets.facet_counts({"size": ["300mm"]})}
+        # Material counts follow the size pick; size counts ignore it.
+        self.assertEqual(out["material"], {"Steel": 1, "Silicone": 1})
+        self.assertEqual(out["size"], {"300mm": 2, "400mm": 1})
+
+    def test_stock_import_refreshes_once(self):
+        get_user_model().objects.create_user("staff", password="pw", is_staff=True)
+        body = {
+            "username": "staff",
+            "password": "pw",
+            "products": [{"name": f"Part {i}", "price": 1.5} for i in range(5)],
+        }
+        with mock.patch.object(catalogue, "bump_version", wraps=catalogue.bump_version) as bump, mock.patch.object(
+            facets, "refresh_product", wraps=facets.refresh_product
+        ) as refresh_one:
+            response = Client(HTTP_HOST="localhost").post(
+                reverse("api_import_stock"), json.dumps(body), content_type="application/json"
+            )
+        self.assertEqual(response.json(), {"status": "success", "created": 5, "updated": 0})
+        self.assertEqual(bump.call_count, 1)
+        self.assertEqual(refresh_one.call_count, 0)
+        self.assertEqual(self.counts()[("category", "parts")], 5)
+
+
+class ProductFeedTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        caches[catalogue.PAGE_CACHE].clear()
+        self.client = Client(HTTP_HOST="localhost")
+        # Ties on sort_order and on name, so the id tie-break matters.
+        for i in range(11):
+            ShopProduct.objects.create(name=f"Part {i % 4}", slug=f"part-{i}", sort_order=i % 3, in_stock=i % 2 == 0)
+        self.order = list(ShopProduct.objects.order_by("sort_order", "name", "id").values_list("id", flat=True))
+
+    def walk(self, query):
+        ids, url = [], f"{reverse('api_products')}?{query}"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, response.content)
+            data = response.json()
+            ids += [r["id"] for r in data["results"]]
+            url = data["next"]
+        return ids
+
+    def test_cursor_walk_visits_every_product_once_in_order(self):
+        for limit in (1, 3, 4, 11, 50):
+            self.assertEqual(self.walk(f"fields=id&limit={limit}"), self.order, limit)
+
+    def test_cursor_walk_with_filter(self):
+        expected = list(
+            ShopProduct.objects.filter(in_stock=True).order_by("sort_order", "name", "id").values_list("id", flat=True)
+        )
+        self.assertEqual(self.walk("fields=id&limit=2&in_stock=1"), expected)
+
+    def test_insert_before_the_cursor_does_not_shift_pages(self):
+        first = self.client.get(reverse("api_products"), {"fields": "id", "limit": 4}).json()
+        ShopProduct.objects.create(name="Aardvark", slug="aardvark", sort_order=0)
+        rest = self.walk(f"fields=id&limit=4&cursor={first['next_cursor']}")
+        self.assertEqual([r["id"] for r in first["results"]] + rest, self.order)
+
+    def test_next_link_only_carries_keyed_parameters(self):
+        url = reverse("api_products")
+        primed = self.client.get(f"{url}?fields=id&limit=1&utm=EVIL").json()
+        self.assertNotIn("utm", primed["next"])
+        plain = self.client.get(f"{url}?fields=id&limit=1").json()
+        self.assertEqual(plain, primed)
+        self.assertNotIn("EVIL", plain["next"])
+        self.assertIn("limit=1", plain["next"])
+
+    def test_bad_cursor_is_a_400(self):
+        response = self.client.get(reverse("api_products"), {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+
+class SearchTests(TestCase):
+    products = [
+        ("Belt seal", "SKU003418", "Replacement belt seal for the conveyor"),
+        ("Heater", "SKU000200", "Heats the sealing plate; pair with a belt seal kit"),
+        ("Cutting blade", "SKU000300", "Steel blade"),
+    ]
+
+    def setUp(self):
+        for i, (name, sku, description) in enumerate(self.products):
+            ShopProduct.objects.create(name=name, sku=sku, description=description, slug=f"p-{i}")
+
+    def names(self, query):
+        return list(search.search_products(ShopProduct.objects.all(), query).values_list("name", flat=True))
+
+    def test_name_matches_rank_above_description_matches(self):
+        self.assertEqual(self.names("belt seal"), ["Belt seal", "Heater"])
+
+    def test_prefixes_and_every_term_must_match(self):
+        self.assertEqual(self.names("bel sea"), ["Belt seal", "Heater"])
+        self.assertEqual(self.names("blade steel"), ["Cutting blade"])
+        self.assertEqual(self.names("blade seal"), [])
+        self.assertEqual(self.names("sku003418"), ["Belt seal"])
+        self.assertEqual(self.names("!!"), [])
+
+
+class SuggestTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        suggest._index = None
+        self.addCleanup(setattr, suggest, "_index", None)
+        self.client = Client(HTTP_HOST="localhost")
+        for i, (name, sku) in enumerate([("Belt seal", "SKU003418"), ("Seal kit", "SK-77"), ("Heater", "")]):
+            ShopProduct.objects.create(name=name, sku=sku, slug=f"p-{i}")
+
+    def labels(self, query, limit=suggest.LIMIT):
+        return [e.label for e in suggest.suggest(query, limit)]
+
+    def test_prefix_of_any_word_or_sku_part(self):
+        # Matches at the start of the label rank first.
+        self.assertEqual(self.labels("seal"), ["Seal kit", "Belt seal"])
+        self.assertEqual(self.labels("bel"), ["Belt seal"])
+        self.assertEqual(self.labels("3418"), ["Belt seal"])
+        self.assertEqual(self.labels("sku0034"), ["Belt seal"])
+        self.assertEqual(self.labels("77"), ["Seal kit"])
+        self.assertEqual(self.labels("eal"), [])
+        self.assertEqual(self.labels("h"), [])  # shorter than MIN_QUERY_LENGTH
+
+    def test_case_and_whitespace_are_folded(self):
+        self.assertEqual(self.labels("BELT"), ["Belt seal"])
+        self.assertEqual(self.labels("  belt   SEAL "), ["Belt seal"])
+
+    def test_limit(self):
+        for i in range(25):
+            ShopProduct.objects.create(name=f"Gasket {i:02d}", slug=f"gasket-{i}")
+        suggest._index = None
+        self.assertEqual(len(self.labels("gas")), suggest.LIMIT)
+        self.assertEqual(self.labels("gas", 3), ["Gasket 00", "Gasket 01", "Gasket 02"])
+
+        url = reverse("api_search_suggest")
+        self.assertEqual(len(self.client.get(url, {"q": "gas", "limit": 100}).json()["results"]), suggest.MAX_LIMIT)
+        self.assertEqual(len(self.client.get(url, {"q": "gas", "limit": 0}).json()["results"]), 1)
+        self.assertEqual(self.client.get(url, {"q": "gas", "limit": "all"}).status_code, 400)
+
+    def test_new_version_is_built_in_the_background(self):
+        self.assertEqual(self.labels("cut"), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            ShopProduct.objects.create(name="Cutting blade", slug="blade")
+
+        with mock.patch.object(suggest.threading, "Thread") as thread:
+            # Served from the previous index meanwhile, and only one rebuild is started.
+            self.assertEqual(self.labels("cut"), [])
+            self.assertEqual(self.labels("cut"), [])
+        thread.assert_called_once()
+
+        with mock.patch.object(suggest, "close_old_connections"), mock.patch.object(suggest, "connection"):
+            thread.call_args.kwargs["target"](*thread.call_args.kwargs["args"])
+        self.assertEqual(self.labels("cut"), ["Cutting blade"])
+        self.assertEqual(suggest._index.version, catalogue.get_version().number)
+
+
+class SqliteSearchTests(TestCase):
+    """The SQLite index from migration 0078 with the SQL core/search.py runs against it."""
+
+    def setUp(self):
+        migration = importlib.import_module("core.migrations.0078_shopproduct_search")
+        self.db = sqlite3.connect(":memory:")
+        self.addCleanup(self.db.close)
+        self.db.execute(
+            "CREATE TABLE core_shopproduct (id INTEGER PRIMARY KEY, name TEXT, sku TEXT, description TEXT)"
+        )
+        self.db.executemany(
+            "INSERT INTO core_shopproduct (name, sku, description) VALUES (?, ?, ?)", SearchTests.products
+        )
+        for sql in migration.SQLITE_FORWARD:
+            self.db.execute(sql)
+
+    def names(self, query):
+        with mock.patch.object(search, "connection", mock.Mock(vendor="sqlite")):
+            ids, rank, params = search._match(search._terms(query))
+        sql = f"SELECT name FROM core_shopproduct WHERE id IN ({ids}) ORDER BY {rank} DESC, name"
+        return [name for name, in self.db.execute(sql.replace("%s", "?"), params + params)]
+
+    def test_ranking_and_prefixes(self):
+        self.assertEqual(self.names("belt seal"), ["Belt seal", "Heater"])
+        self.assertEqual(self.names("bel"), ["Belt seal", "Heater"])
+        self.assertEqual(self.names("sealing"), ["Belt seal", "Heater"])  # porter stemming
+        self.assertEqual(self.names("blade seal"), [])
+
+    def test_triggers_follow_updates_and_deletes(self):
+        self.db.execute("UPDATE core_shopproduct SET name = 'Drive belt' WHERE name = 'Cutting blade'")
+        self.db.execute("DELETE FROM core_shopproduct WHERE name = 'Heater'")
+        self.assertEqual(sorted(self.names("belt")), ["Belt seal", "Drive belt"])
+        self.assertEqual(self.names("cutting"), [])
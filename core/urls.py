@@ -20,6 +20,7 @@ urlpatterns = [
     path("diag/email/", views.diag_email, name="diag_email"),
     path("documents/", views.documents, name="documents"),
     path("search/", views.search, name="search"),
+    path("api/search/suggest/", views.search_suggest, name="api_search_suggest"),
 
     # --- Legal / SEO ---
     path("cookie-policy/", views.cookie_policy, name="cookie_policy"),
@@ -41,6 +42,7 @@ urlpatterns = [
     path("api/cart/add/", views.api_cart_add, name="api_cart_add"),
     path("api/cart/update/", views.api_cart_update, name="api_cart_update"),
     path("api/products/", views.api_products, name="api_products"),
+    path("api/products/facets/", views.api_product_facets, name="api_product_facets"),
 
     # --- 3. Optional Tooling Section ---
     path("tooling/", tooling_view if tooling_view else views.shop, name="tooling"),
@@ -93,7 +95,15 @@ urlpatterns = [
 
     # --- 6. Machine Data APIs ---
     path("api/machine-metrics/", views.machine_metrics_api, name="api_machine_metrics"),
+    path("api/machine-metrics/history/", views.machine_metrics_history, name="api_machine_metrics_history"),
+    path("api/machine-metrics/live/", views.machine_metrics_live, name="api_machine_metrics_live"),
+    path("api/machine-metrics/export/", views.machine_telemetry_export, name="api_machine_telemetry_export"),
+    path("api/machine-metrics/stream/", views.machine_metrics_stream, name="api_machine_metrics_stream"),
+    path("api/anomalies/", views.telemetry_anomalies, name="api_telemetry_anomalies"),
     path("api/ingest/", views.telemetry_ingest, name="api_ingest"),
+    path("api/ingest/batch/", views.telemetry_ingest_batch, name="api_ingest_batch"),
+    path("api/ingest/async/", views.telemetry_ingest_async, name="api_ingest_async"),
+    path("api/metrics/ingest/", views.metrics_ingest, name="api_metrics_ingest"),
     path("api/import-stock/", views.api_import_stock, name="api_import_stock"),
 
     # --- 7. Diagnostics ---
@@ -0,0 +1,199 @@
+"""
+Per-shift and per-day utilisation / OEE, kept in MachineUtilisation.
+
+run_rollups() calls build_utilisation() for every window it rolls up, so
+the rows are maintained incrementally from the rollup tables: each affected
+period is re-summed from its hour rollups (or minute rollups if the period
+does not start and end on the hour), which is a few dozen rows per machine
+instead of a scan of raw telemetry. Readers fetch one precomputed row.
+"""
+
+from collections import namedtuple
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .models import MachineAlertSettings, MachineTelemetryRollup, MachineUtilisation
+
+UTILISATION_CACHE_PREFIX = "telemetry:util:"
+UTILISATION_CACHE_TTL = 60
+
+Period = namedtuple("Period", "kind name start end")
+
+
+def _shift_timezone():
+    return ZoneInfo(getattr(settings, "TELEMETRY_SHIFT_TIMEZONE", None) or settings.TIME_ZONE)
+
+
+def parse_shifts(spec: str) -> list:
+    """
+    "Early=06:00,Late=14:00,Night=22:00" (or just "06:00,14:00,22:00") ->
+    [(name, time), ...] sorted by start time. Each shift ends where the next
+    one starts; the last runs into the next day.
+    """
+    shifts = []
+    for i, part in enumerate(p.strip() for p in (spec or "").split(",")):
+        if not part:
+            continue
+        name, _, start = part.rpartition("=")
+        try:
+            hours, minutes = (int(x) for x in start.split(":"))
+            start_time = time(hours, minutes)
+        except ValueError:
+            raise ValueError(f"Invalid shift start '{part}' (expected HH:MM or Name=HH:MM)")
+        shifts.append((name.strip() or f"Shift {i + 1}", start_time))
+    return sorted(shifts, key=lambda s: s[1])
+
+
+def _shifts() -> list:
+    return parse_shifts(getattr(settings, "TELEMETRY_SHIFTS", ""))
+
+
+def periods_overlapping(start: datetime, end: datetime) -> list:
+    """Day and shift periods (UTC bounds) that overlap [start, end), in the shift timezone."""
+    tz = _shift_timezone()
+    shifts = _shifts()
+    day = start.astimezone(tz).date() - timedelta(days=1)
+    last = end.astimezone(tz).date()
+
+    periods = []
+    while day <= last:
+        next_day = day + timedelta(days=1)
+        candidates = [
+            Period(
+                MachineUtilisation.PERIOD_DAY,
+                "",
+                datetime.combine(day, time(0), tz),
+                datetime.combine(next_day, time(0), tz),
+            )
+        ]
+        for i, (name, shift_start) in enumerate(shifts):
+            if i + 1 < len(shifts):
+                shift_end = datetime.combine(day, shifts[i + 1][1], tz)
+            else:
+                shift_end = datetime.combine(next_day, shifts[0][1], tz)
+            candidates.append(Period(MachineUtilisation.PERIOD_SHIFT, name, datetime.combine(day, shift_start, tz), shift_end))
+
+        for p in candidates:
+            p_start, p_end = p.start.astimezone(dt_timezone.utc), p.end.astimezone(dt_timezone.utc)
+            if p_start < end and p_end > start:
+                periods.append(p._replace(start=p_start, end=p_end))
+        day = next_day
+    return periods
+
+
+def current_period(now=None):
+    """The shift containing `now`, or the day if no shifts are configured."""
+    now = now or timezone.now()
+    kind = MachineUtilisation.PERIOD_SHIFT if _shifts() else MachineUtilisation.PERIOD_DAY
+    for p in periods_overlapping(now, now + timedelta(microseconds=1)):
+        if p.kind == kind:
+            return p
+    return None
+
+
+def _build_period(period: Period, mark: datetime, targets: dict) -> int:
+    covered_end = min(period.end, mark)
+    elapsed = max(0.0, (covered_end - period.start).total_seconds())
+    aligned = period.start.minute == 0 and period.end.minute == 0
+    resolution = MachineTelemetryRollup.RESOLUTION_HOUR if aligned else MachineTelemetryRollup.RESOLUTION_MINUTE
+
+    totals = {}
+    rows = MachineTelemetryRollup.objects.filter(
+        resolution=resolution, bucket_start__gte=period.start, bucket_start__lt=covered_end
+    ).values_list("machine_id", "ppm_avg", "status_seconds")
+    for machine_id, ppm_avg, status_seconds in rows.iterator(chunk_size=5000):
+        t = totals.setdefault(machine_id, {"status": {}, "packs": 0.0})
+        seconds = 0.0
+        for status, value in (status_seconds or {}).items():
+            t["status"][status] = t["status"].get(status, 0.0) + value
+            seconds += value
+        t["packs"] += ppm_avg * seconds / 60
+
+    out = []
+    for machine_id, t in totals.items():
+        status = {k: round(v, 1) for k, v in t["status"].items()}
+        out.append(
+            MachineUtilisation(
+                machine_id=machine_id,
+                period=period.kind,
+                name=period.name,
+                period_start=period.start,
+                period_end=period.end,
+                elapsed_seconds=elapsed,
+                reporting_seconds=sum(v for k, v in status.items() if k != "OFFLINE"),
+                running_seconds=status.get("RUNNING", 0.0),
+                status_seconds=status,
+                packs=round(t["packs"], 1),
+                ppm_target=targets.get(machine_id),
+            )
+        )
+
+    with transaction.atomic():
+        MachineUtilisation.objects.filter(period=period.kind, period_start=period.start).delete()
+        MachineUtilisation.objects.bulk_create(out, batch_size=1000)
+    return len(out)
+
+
+def build_utilisation(start: datetime, end: datetime, mark: datetime = None) -> int:
+    """
+    Rebuild the shift and day rows of every period overlapping [start, end),
+    counting rolled-up data before `mark` (default `end`). Idempotent.
+    """
+    mark = mark or end
+    targets = dict(
+        MachineAlertSettings.objects.exclude(ppm_target__isnull=True).values_list("machine_id", "ppm_target")
+    )
+    written = 0
+    for period in periods_overlapping(start, end):
+        written += _build_period(period, mark, targets)
+    return written
+
+
+# -----------------------------------------------------------------------------
+# Reading
+# -----------------------------------------------------------------------------
+
+def _percent(value):
+    return None if value is None else round(value * 100, 1)
+
+
+def utilisation_snapshot(row: MachineUtilisation) -> dict:
+    return {
+        "period": row.period,
+        "name": row.name,
+        "period_start": row.period_start.isoformat(),
+        "utilisation": _percent(row.utilisation),
+        "availability": _percent(row.availability),
+        "performance": _percent(row.performance),
+        "oee": _percent(row.oee),
+    }
+
+
+def get_current_utilisation_many(machine_ids, now=None) -> dict:
+    """
+    {machine_id: snapshot dict or None} for the current shift (or day), from
+    the cache, with one query for all misses. Entries live for a minute,
+    which is how often rollups normally run.
+    """
+    machine_ids = list(machine_ids)
+    period = current_period(now)
+    if period is None or not machine_ids:
+        return {m: None for m in machine_ids}
+
+    prefix = f"{UTILISATION_CACHE_PREFIX}{period.kind}:{period.start:%Y%m%d%H%M}:"
+    cached = cache.get_many([prefix + m for m in machine_ids])
+    missing = [m for m in machine_ids if prefix + m not in cached]
+    if missing:
+        rows = MachineUtilisation.objects.filter(
+            machine_id__in=missing, period=period.kind, period_start=period.start
+        )
+        found = {row.machine_id: utilisation_snapshot(row) for row in rows}
+        fresh = {prefix + m: found.get(m, {}) for m in missing}
+        cache.set_many(fresh, timeout=UTILISATION_CACHE_TTL)
+        cached.update(fresh)
+    return {m: cached[prefix + m] or None for m in machine_ids}
@@ -1,31 +1,67 @@
+import asyncio
+import base64
+import csv
+import io
 import json
 import logging
-import math
-import random
+import re
 from collections import namedtuple
+from datetime import timedelta, timezone as dt_timezone
 from decimal import Decimal
 
 # NOTE: Do NOT import weasyprint here at the top level.
 # It is imported inside order_pdf() to prevent deployment crashes.
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
+from django.core.handlers.asgi import ASGIRequest
 from django.core.mail import EmailMultiAlternatives
-from django.db.models import Q
-from django.http import JsonResponse, HttpResponse
+from django.db import connection
+from django.db.models import BooleanField, Count, Max, Q
+from django.db.models.expressions import RawSQL
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views.decorators.http import require_POST
 from django.shortcuts import redirect, render, get_object_or_404
 from django.template.loader import render_to_string
 from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_vary_headers
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, urlencode
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_GET
 
+from . import catalogue, facets, ingest_auth, ringbuffer, suggest, writebehind
+from .search import filter_products, search_products
+from .blocks import iter_samples
 from .forms import SiteConfigurationForm
+from .ingest_auth import IngestAuthError
 from .shop_forms import CheckoutForm
+from .signals import catalogue_batch
 from .email_utils import send_order_emails
+from .metrics import ingest_metrics, latest_values
+from .rollups import choose_resolution, rollup_sparklines, telemetry_series
+from .telemetry import (
+    COLUMNAR_CONTENT_TYPE,
+    TelemetryError,
+    UnsupportedEncoding,
+    after_ingest,
+    clean_sample,
+    decode_body,
+    decode_columnar,
+    get_latest,
+    get_latest_many,
+    ingest_samples,
+    insert_rows,
+    parse_samples,
+    validate_samples,
+)
+from .utilisation import get_current_utilisation_many
 
 from .models import (
+    Alert,
     BackgroundImage,
     CustomerDocument,
     CustomerMachine,
@@ -42,6 +78,7 @@ from .models import (
     ShopOrderItem,
     ShopProduct,
     SiteConfiguration,
+    TelemetryAnomaly,
 )
 
 logger = logging.getLogger(__name__)
@@ -140,6 +177,16 @@ def _customer_ok(user) -> bool:
     return bool(getattr(prof, "is_active", False))
 
 
+def _customer_telemetry_ids(user) -> list:
+    """Telemetry machine_ids of the customer's active machines."""
+    return list(
+        CustomerMachine.objects.filter(customer=user, is_active=True)
+        .exclude(telemetry_id="")
+        .values_list("telemetry_id", flat=True)
+        .distinct()
+    )
+
+
 # -----------------------------------------------------------------------------
 # Public pages
 # -----------------------------------------------------------------------------
@@ -246,7 +293,7 @@ def search(request):
 
     if q:
         machines = machines.filter(Q(name__icontains=q) | Q(description__icontains=q))
-        shop_items = shop_items.filter(Q(name__icontains=q) | Q(description__icontains=q))
+        shop_items = search_products(shop_items, q)
 
     ctx = {
         "q": q,
@@ -257,6 +304,33 @@ def search(request):
     return render(request, "core/search.html", ctx)
 
 
+@require_GET
+def search_suggest(request):
+    """
+    Typeahead for the search box: GET ?q=bel&limit=8
+
+    Served from the per-process prefix index in core/suggest.py, so a
+    keystroke costs no query. Matches any word of a product or machine
+    name, or any part of a SKU.
+    """
+    try:
+        limit = int(request.GET.get("limit") or suggest.LIMIT)
+    except ValueError:
+        return JsonResponse({"error": "limit must be an integer"}, status=400)
+    limit = max(1, min(limit, suggest.MAX_LIMIT))
+
+    results = []
+    for entry in suggest.suggest(request.GET.get("q") or "", limit):
+        if not entry.slug:
+            url = ""
+        elif entry.kind == suggest.KIND_MACHINE:
+            url = reverse("machine_detail", args=[entry.slug])
+        else:
+            url = reverse("shop_product_detail", args=[entry.slug])
+        results.append({"kind": entry.kind, "label": entry.label, "sku": entry.sku, "url": url})
+    return JsonResponse({"results": results})
+
+
 # -----------------------------------------------------------------------------
 # Shop pages (Phase 1 + 2)
 # -----------------------------------------------------------------------------
@@ -265,30 +339,204 @@ def shop(request):
     """
     Main shop page uses AJAX to load products.
     """
-    query = request.GET.get('q')
+    query = (request.GET.get('q') or "").strip()
     products = ShopProduct.objects.filter(is_active=True).order_by("sort_order", "name")
 
     if query:
-        products = products.filter(
-            Q(name__icontains=query) |
-            Q(description__icontains=query) |
-            Q(sku__icontains=query)
-        )
+        products = search_products(products, query)
+    picked = facets.selection(request.GET)
 
     ctx = {
-        "products": products,
+        "products": facets.narrow(products, picked),
+        "facets": facets.facet_counts(picked, products if query else None),
         "search_query": query,
         "background_images_json": _background_images_json()
     }
     return render(request, "core/shop.html", ctx)
 
 
+PRODUCTS_PAGE_SIZE = 48
+PRODUCTS_MAX_PAGE_SIZE = 200
+# Model columns behind each field of the feed (for ?fields=).
+PRODUCT_FEED_COLUMNS = {
+    "id": ("id",),
+    "name": ("name",),
+    "sku": ("sku",),
+    "category": ("category",),
+    "description": ("description",),
+    "price": ("price_gbp", "show_price"),
+    "image_url": ("image",),
+    "stock_status": ("in_stock",),
+    "slug": ("slug",),
+    "detail_url": ("slug",),
+    "created_at": ("created_at",),
+}
+# Keyset order of the feed; a cursor is the last row's values of these.
+PRODUCT_FEED_ORDER = ("sort_order", "name", "id")
+_ACCEPTS_GZIP = re.compile(r"\bgzip\b")
+
+
+def _encode_product_cursor(row: dict) -> str:
+    raw = json.dumps([row[c] for c in PRODUCT_FEED_ORDER], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_product_cursor(value: str) -> list:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)))
+        sort_order, name, pk = key
+        if not (isinstance(sort_order, int) and isinstance(name, str) and isinstance(pk, int)):
+            raise ValueError
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    return key
+
+
+def _products_after(qs, key: list):
+    """
+    Rows after `key` in PRODUCT_FEED_ORDER. A row-value comparison rather
+    than the equivalent OR of three conditions, so the database can seek
+    straight to the cursor in core_shopprod_feed_idx.
+    """
+    qn = connection.ops.quote_name
+    table = qn(ShopProduct._meta.db_table)
+    columns = ", ".join(f"{table}.{qn(c)}" for c in PRODUCT_FEED_ORDER)
+    return qs.filter(RawSQL(f"({columns}) > (%s, %s, %s)", key, output_field=BooleanField()))
+
+
+def _cached_catalogue_json(request, build, kind: str = ""):
+    """
+    Serve the JSON response `build(request)` from the catalogue cache
+    (core/catalogue.py), with an ETag and Last-Modified so a matching
+    If-None-Match gets a 304. Error responses are returned uncached.
+    """
+    version = catalogue.get_version()
+    key = catalogue.page_key(version, request.GET, kind)
+    etag = catalogue.etag(key)
+    last_modified = int(version.updated_at.timestamp())
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    page = catalogue.get_page(key)
+    if page is None:
+        built = build(request)
+        if built.status_code != 200:
+            return built
+        page = catalogue.store_page(key, built.content)
+
+    if _ACCEPTS_GZIP.search(request.headers.get("Accept-Encoding", "")):
+        response = HttpResponse(page.gzipped, content_type="application/json")
+        response["Content-Encoding"] = "gzip"
+    else:
+        response = HttpResponse(page.body, content_type="application/json")
+    patch_vary_headers(response, ("Accept-Encoding",))
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    # Cacheable, but revalidated on every use, which is a 304 until the catalogue changes.
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+def _filtered_products(request):
+    """
+    Active products narrowed by in_stock and q, the facet selection
+    (core/facets.py) still to apply, and whether in_stock or q narrowed
+    anything. Raises ValueError for an unknown category.
+    """
+    products = ShopProduct.objects.filter(is_active=True)
+    picked = facets.selection(request.GET)
+    unknown = [c for c in picked.get("category", ()) if c not in dict(ShopProduct.CATEGORY_CHOICES)]
+    if unknown:
+        raise ValueError(f"Unknown category '{unknown[0]}'")
+    in_stock = (request.GET.get("in_stock") or "").lower()
+    if in_stock:
+        products = products.filter(in_stock=in_stock in ("1", "true", "yes", "on"))
+    query = (request.GET.get("q") or "").strip()
+    if query:
+        # Matches stay in feed order, so the keyset cursor still works.
+        products = filter_products(products, query)
+    return products, picked, bool(in_stock or query)
+
+
 @require_GET
 def api_products(request):
     """
-    AJAX product feed for the shop grid.
+    AJAX product feed for the shop grid, one page at a time.
+
+    GET ?category=parts&material=Steel&in_stock=1&q=seal&fields=id,name,price&limit=48&cursor=...
+
+    Pages follow (sort_order, name, id) and are fetched by keyset, so every
+    page costs the same however deep into the catalogue it is. Pass the
+    returned next_cursor (or follow "next") for the following page; it is
+    null on the last one. fields= limits each product to the listed keys,
+    and only the columns those need are read. Facet parameters (see
+    api_product_facets) may repeat to pick several values.
+
+    Built pages are cached per catalogue version (core/catalogue.py) and
+    carry an ETag and Last-Modified; a matching If-None-Match gets a 304.
     """
-    products = ShopProduct.objects.filter(is_active=True).order_by("sort_order", "name")
+    return _cached_catalogue_json(request, _products_page)
+
+
+@require_GET
+def api_product_facets(request):
+    """
+    Facet counts for the shop filters, over the products the same
+    parameters would give api_products:
+
+    GET ?category=parts&material=Steel&material=Brass&in_stock=1&q=seal
+
+    {"total": 12, "facets": [{"name": "material", "label": "Material",
+      "values": [{"value": "Steel", "label": "Steel", "count": 9, "selected": true}, ...]}, ...]}
+
+    Counts come from the facet tables (core/facets.py), not the products'
+    specifications, and are cached per catalogue version like the feed
+    pages.
+    """
+    return _cached_catalogue_json(request, _facets_page, kind="facets")
+
+
+def _facets_page(request):
+    try:
+        products, picked, narrowed = _filtered_products(request)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse({
+        "total": facets.narrow(products, picked).count(),
+        "facets": facets.facet_counts(picked, products if narrowed else None),
+    })
+
+
+def _products_page(request):
+    fields = [f.strip() for f in (request.GET.get("fields") or "").split(",") if f.strip()]
+    unknown = [f for f in fields if f not in PRODUCT_FEED_COLUMNS]
+    if unknown:
+        return JsonResponse({"error": f"Unknown field(s): {', '.join(unknown)}"}, status=400)
+    fields = fields or list(PRODUCT_FEED_COLUMNS)
+
+    try:
+        limit = int(request.GET.get("limit") or PRODUCTS_PAGE_SIZE)
+        cursor = request.GET.get("cursor")
+        key = _decode_product_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    limit = max(1, min(limit, PRODUCTS_MAX_PAGE_SIZE))
+
+    try:
+        products, picked, _ = _filtered_products(request)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    products = facets.narrow(products, picked)
+    if key:
+        products = _products_after(products, key)
+
+    columns = set(PRODUCT_FEED_ORDER)
+    for f in fields:
+        columns.update(PRODUCT_FEED_COLUMNS[f])
+    rows = list(products.order_by(*PRODUCT_FEED_ORDER).values(*columns)[: limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
 
     # Optional global toggle (hide prices)
     show_prices_global = True
@@ -299,32 +547,32 @@ def api_products(request):
         # If config table not ready, default True
         show_prices_global = True
 
-    data = []
-    for p in products:
-        price_val = None
-        if show_prices_global and bool(getattr(p, "show_price", True)):
-            try:
-                price_val = float(p.price_gbp)
-            except Exception:
-                price_val = None
+    # Resolved once per page rather than once per product.
+    detail_url = reverse("shop_product_detail", kwargs={"slug": "__slug__"})
+    image_storage = ShopProduct._meta.get_field("image").storage
+
+    values = {
+        "id": lambda r: r["id"],
+        "name": lambda r: r["name"],
+        "sku": lambda r: r["sku"] or "",
+        "category": lambda r: r["category"] or "",
+        "description": lambda r: r["description"],
+        "price": lambda r: float(r["price_gbp"]) if show_prices_global and r["show_price"] else None,
+        "image_url": lambda r: image_storage.url(r["image"]) if r["image"] else "",
+        "stock_status": lambda r: "In Stock" if r["in_stock"] else "Out of Stock",
+        "slug": lambda r: r["slug"] or "",
+        "detail_url": lambda r: detail_url.replace("__slug__", r["slug"]) if r["slug"] else "",
+        "created_at": lambda r: r["created_at"].isoformat() if r["created_at"] else "",
+    }
+    data = [{f: values[f](r) for f in fields} for r in rows]
 
-        slug = getattr(p, "slug", "") or ""
-        data.append(
-            {
-                "id": p.id,
-                "name": p.name,
-                "sku": getattr(p, "sku", "") or "",
-                "category": getattr(p, "category", "") or "",
-                "description": p.description,
-                "price": price_val,
-                "image_url": p.image.url if p.image else "",
-                "stock_status": "In Stock" if getattr(p, "in_stock", True) else "Out of Stock",
-                "slug": slug,
-                "detail_url": reverse("shop_product_detail", kwargs={"slug": slug}) if slug else "",
-                "created_at": p.created_at.isoformat() if getattr(p, "created_at", None) else "",
-            }
-        )
-    return JsonResponse(data, safe=False)
+    next_cursor = _encode_product_cursor(rows[-1]) if has_more else None
+    next_url = None
+    if next_cursor:
+        # Only keyed parameters: the page is cached and shared by every request with the same key.
+        params = [(k, v) for k, v in catalogue.page_params(request.GET) if k != "cursor"]
+        next_url = f"{request.path}?{urlencode(params + [('cursor', next_cursor)])}"
+    return JsonResponse({"results": data, "next_cursor": next_cursor, "next": next_url})
 
 
 def shop_product_detail(request, slug):
@@ -818,9 +1066,14 @@ def staff_homepage_editor(request):
 # Customer portal
 # -----------------------------------------------------------------------------
 
-_Machine = namedtuple("PortalMachine", "id name serial_number")
 _Metric = namedtuple("PortalMetric", "metric_key value unit ts sparkline")
 
+# A machine counts as online if its last sample is newer than this.
+PORTAL_ONLINE_WINDOW = timedelta(minutes=5)
+PORTAL_SPARKLINE_HOURS = 24
+# Generic metrics (MachineMetric) older than this are not shown.
+PORTAL_METRIC_LOOKBACK = timedelta(days=7)
+
 
 def _sparkline(values, width=120, height=34, pad=3):
     if not values:
@@ -838,27 +1091,68 @@ def _sparkline(values, width=120, height=34, pad=3):
     return " ".join(pts)
 
 
-def _build_sample_portal_data(username: str):
-    seed = sum(ord(c) for c in (username or "user")) % 10_000
-    random.seed(seed)
+def _portal_machines(user) -> list:
+    return list(CustomerMachine.objects.filter(customer=user, is_active=True).order_by("name", "id"))
 
-    machines = [
-        _Machine(1, "MPE i6 Tray Sealer", "I6-" + str(1000 + seed % 900)),
-        _Machine(2, "MPE i3 Tray Sealer", "I3-" + str(2000 + seed % 900)),
-    ]
 
+def _build_portal_data(machines):
+    """
+    Latest values and sparklines for a customer's machines.
+
+    The number of queries does not grow with the fleet: one cache round trip
+    (plus one query for any misses) for the latest telemetry, one query for
+    generic metrics, one for the hourly rollups behind the sparklines and
+    one for open alerts, plus at most one for the current shift's utilisation.
+
+    Returns (latest_by_machine, dashboard_machines, online_count, open_alerts),
+    where dashboard_machines is the JSON-ready list the dashboard script
+    starts from.
+    """
     now = timezone.now()
+    telemetry_ids = sorted({m.telemetry_id for m in machines if m.telemetry_id})
+    latest = get_latest_many(telemetry_ids)
+    sparklines = rollup_sparklines(telemetry_ids, now - timedelta(hours=PORTAL_SPARKLINE_HOURS))
+    extra = latest_values([m.pk for m in machines], now - PORTAL_METRIC_LOOKBACK)
+    utilisation = get_current_utilisation_many(telemetry_ids, now)
+    open_alerts = list(Alert.objects.filter(machine_id__in=telemetry_ids, cleared_at__isnull=True).order_by("-raised_at"))
+    alerts_by_machine = {}
+    for alert in open_alerts:
+        alerts_by_machine.setdefault(alert.machine_id, []).append(
+            {"kind": alert.kind, "message": alert.message, "raised_at": alert.raised_at.isoformat()}
+        )
+
     latest_by_machine = {}
+    dashboard_machines = []
+    online = 0
     for m in machines:
-        t = [i for i in range(24)]
-        base_ppm = random.uniform(18, 32)
-        ppm_series = [base_ppm + 3 * (random.random() - 0.5) + 2 * math.sin(i / 3) for i in t]
+        sample = latest.get(m.telemetry_id) if m.telemetry_id else None
+        ts = parse_datetime(sample["created_at"]) if sample else None
+        is_online = bool(ts and now - ts <= PORTAL_ONLINE_WINDOW and sample["status"] != "OFFLINE")
+        online += is_online
+        history = sparklines.get(m.telemetry_id, [])
+
+        metrics = []
+        if sample:
+            metrics += [
+                _Metric("Packs/min", f"{sample['ppm']:.1f}", "ppm", ts, _sparkline(history)),
+                _Metric("Seal temp", f"{sample['temp']:.1f}", "°C", ts, ""),
+                _Metric("Status", sample["status"] if is_online else "OFFLINE", "", ts, ""),
+            ]
+        metrics += [_Metric(key, f"{value:g}", unit, t, "") for key, unit, value, t in extra.get(m.pk, [])]
+        latest_by_machine[m.pk] = metrics
+
+        payload = _machine_metrics_payload(m.telemetry_id or f"machine-{m.pk}", sample, utilisation.get(m.telemetry_id))
+        payload.update(
+            name=m.name,
+            serial=m.serial_number,
+            history=history,
+            alerts=alerts_by_machine.get(m.telemetry_id, []) if m.telemetry_id else [],
+        )
+        if not is_online:
+            payload["status"] = "OFFLINE"
+        dashboard_machines.append(payload)
 
-        latest_by_machine[m.id] = [
-            _Metric("Packs/min", f"{ppm_series[-1]:.1f}", "ppm", now, _sparkline(ppm_series)),
-            _Metric("Status", "RUNNING", "", now, ""),
-        ]
-    return machines, latest_by_machine
+    return latest_by_machine, dashboard_machines, online, open_alerts
 
 
 def portal_login(request):
@@ -901,7 +1195,7 @@ def portal_logout(request):
 def portal_home(request):
     if not _customer_ok(request.user):
         return redirect(f"{reverse('portal_login')}?next={reverse('portal_home')}")
-    machines, _latest = _build_sample_portal_data(request.user.get_username())
+    machines = _portal_machines(request.user)
     ctx = {"machines": machines, "docs": [], "background_images_json": _background_images_json()}
     return render(request, "core/portal_home.html", ctx)
 
@@ -917,12 +1211,14 @@ def portal_documents(request):
 def portal_dashboard(request):
     if not _customer_ok(request.user):
         return redirect(f"{reverse('portal_login')}?next={reverse('portal_dashboard')}")
-    machines, latest_by_machine = _build_sample_portal_data(request.user.get_username())
+    machines = _portal_machines(request.user)
+    latest_by_machine, dashboard_machines, online, open_alerts = _build_portal_data(machines)
 
-    headline = {"machines_online": len(machines), "alerts": 0}
+    headline = {"machines_online": online, "alerts": len(open_alerts)}
     ctx = {
         "machines": machines,
         "latest_metrics_by_machine": latest_by_machine,
+        "dashboard_machines": dashboard_machines,
         "headline": headline,
         "background_images_json": _background_images_json(),
     }
@@ -950,6 +1246,20 @@ def portal_orders(request):
 # API: Machine Metrics Ingest & Read
 # -----------------------------------------------------------------------------
 
+def _ingest_error(e) -> JsonResponse:
+    """
+    Error response for a rejected ingest request: 401/403 for API key
+    failures, 415 (advertising gzip) for unsupported encodings, else 400.
+    """
+    if isinstance(e, IngestAuthError):
+        return JsonResponse({"status": "error", "message": str(e)}, status=e.status)
+    if isinstance(e, UnsupportedEncoding):
+        response = JsonResponse({"status": "error", "message": str(e)}, status=415)
+        response["Accept-Encoding"] = "gzip"
+        return response
+    return JsonResponse({"status": "error", "message": str(e)}, status=400)
+
+
 @csrf_exempt
 def telemetry_ingest(request):
     """
@@ -957,62 +1267,622 @@ def telemetry_ingest(request):
     """
     if request.method == "POST":
         try:
-            data = json.loads(request.body)
-            MachineTelemetry.objects.create(
-                machine_id=data.get("machine_id"),
-                ppm=data.get("ppm"),
-                temp=data.get("temp"),
-                batch_count=data.get("batch_count"),
-                status=data.get("status"),
-            )
+            key = ingest_auth.authenticate(request)
+            data = json.loads(decode_body(request.body, request.headers.get("Content-Encoding", "")))
+            ingest_auth.check_machines(key, [data])
+            row = clean_sample(data)
+            after_ingest(insert_rows([row]))
             return JsonResponse({"status": "success", "message": "Telemetry saved"})
+        except (IngestAuthError, UnsupportedEncoding) as e:
+            return _ingest_error(e)
         except Exception as e:
             return JsonResponse({"status": "error", "message": str(e)}, status=400)
 
     return JsonResponse({"status": "error", "message": "Only POST allowed"}, status=405)
 
 
+@csrf_exempt
+def telemetry_ingest_batch(request):
+    """
+    Batched ingest: POST a JSON array or NDJSON body with many samples, or
+    the compact columnar body (Content-Type: application/vnd.mpe.telemetry,
+    see core/telemetry.py), optionally gzip-compressed (Content-Encoding: gzip).
+
+    All samples are validated up front and the accepted ones are written in a
+    single transaction. The response reports accept/reject per record (by
+    index), so a client can drop what was stored and fix or discard the rest.
+    """
+    if request.method != "POST":
+        return JsonResponse({"status": "error", "message": "Only POST allowed"}, status=405)
+
+    try:
+        key = ingest_auth.authenticate(request)
+        body = decode_body(request.body, request.headers.get("Content-Encoding", ""))
+        if request.content_type == COLUMNAR_CONTENT_TYPE:
+            samples = decode_columnar(body)
+        else:
+            samples = parse_samples(body)
+        ingest_auth.check_machines(key, samples)
+    except (IngestAuthError, TelemetryError) as e:
+        return _ingest_error(e)
+
+    try:
+        accepted, results = ingest_samples(samples)
+    except Exception as e:
+        logger.exception("Batched telemetry ingest failed: %s", e)
+        return JsonResponse({"status": "error", "message": str(e)}, status=500)
+
+    rejected = len(results) - accepted
+    if not rejected:
+        status = "success"
+    elif accepted:
+        status = "partial"
+    else:
+        status = "error"
+
+    return JsonResponse(
+        {"status": status, "accepted": accepted, "rejected": rejected, "results": results},
+        status=400 if status == "error" else 200,
+    )
+
+
+@csrf_exempt
+async def telemetry_ingest_async(request):
+    """
+    Write-behind ingest: accepts the same bodies as /api/ingest/batch/ (a
+    single JSON object is a one-line NDJSON body), validates them and hands
+    the accepted rows to the in-process queue in core/writebehind.py, then
+    answers 202 without waiting for the database. Answers 503 with
+    Retry-After when the queue is full; nothing from that request was kept.
+    """
+    if request.method != "POST":
+        return JsonResponse({"status": "error", "message": "Only POST allowed"}, status=405)
+
+    try:
+        key = await ingest_auth.aauthenticate(request)
+        body = decode_body(request.body, request.headers.get("Content-Encoding", ""))
+        if request.content_type == COLUMNAR_CONTENT_TYPE:
+            samples = decode_columnar(body)
+        else:
+            samples = parse_samples(body)
+        ingest_auth.check_machines(key, samples)
+    except (IngestAuthError, TelemetryError) as e:
+        return _ingest_error(e)
+
+    rows, results = validate_samples(samples)
+    rejected = len(results) - len(rows)
+    if not rows:
+        return JsonResponse(
+            {"status": "error", "accepted": 0, "rejected": rejected, "results": results}, status=400
+        )
+
+    if not writebehind.get_buffer().offer(rows):
+        response = JsonResponse({"status": "error", "message": "Ingest queue is full, retry later"}, status=503)
+        response["Retry-After"] = "1"
+        return response
+
+    return JsonResponse(
+        {
+            "status": "partial" if rejected else "accepted",
+            "accepted": len(rows),
+            "rejected": rejected,
+            "results": results,
+        },
+        status=202,
+    )
+
+
+@csrf_exempt
+def metrics_ingest(request):
+    """
+    Generic metrics ingest: POST a JSON array or NDJSON of records, each
+    {"machine_id", optional "ts", "metrics": {name: value or {"value", "unit"}}}.
+    machine_id is matched against CustomerMachine.telemetry_id; metric names
+    are registered on first use, so new signals need no schema change
+    (within the caps in core/metrics.py; records over them are rejected).
+    """
+    if request.method != "POST":
+        return JsonResponse({"status": "error", "message": "Only POST allowed"}, status=405)
+
+    try:
+        key = ingest_auth.authenticate(request)
+        records = parse_samples(decode_body(request.body, request.headers.get("Content-Encoding", "")))
+        ingest_auth.check_machines(key, records)
+    except (IngestAuthError, TelemetryError) as e:
+        return _ingest_error(e)
+
+    try:
+        stored, results = ingest_metrics(records)
+    except Exception as e:
+        logger.exception("Metrics ingest failed: %s", e)
+        return JsonResponse({"status": "error", "message": str(e)}, status=500)
+
+    accepted = sum(1 for r in results if r["status"] == "accepted")
+    rejected = len(results) - accepted
+    if not rejected:
+        status = "success"
+    elif accepted:
+        status = "partial"
+    else:
+        status = "error"
+
+    return JsonResponse(
+        {"status": status, "accepted": accepted, "rejected": rejected, "values": stored, "results": results},
+        status=400 if status == "error" else 200,
+    )
+
+
+_MACHINE_NAMES = {
+    "i6": "MPE i6 Tray Sealer",
+    "i3": "MPE i3 Tray Sealer",
+    "test": "LAB-01 Test Unit",
+}
+
+
+def _machine_metrics_payload(machine_id: str, latest, utilisation=None) -> dict:
+    """
+    Response body shared by machine_metrics_api and the SSE stream.
+    `utilisation` is the current shift's precomputed figures
+    (utilisation.get_current_utilisation_many), as percentages.
+    """
+    name = _MACHINE_NAMES.get(machine_id, "Unknown Machine")
+    oee = {
+        "utilisation": (utilisation or {}).get("utilisation") or 0,
+        "availability": (utilisation or {}).get("availability"),
+        "performance": (utilisation or {}).get("performance"),
+        "oee": (utilisation or {}).get("oee"),
+    }
+    if not latest:
+        return {
+            "machine_id": machine_id,
+            "name": name,
+            "status": "OFFLINE",
+            "metrics": {"ppm": 0, "temp": 0, "batch": 0, **oee},
+        }
+    return {
+        "machine_id": machine_id,
+        "name": name,
+        "status": latest["status"],
+        "metrics": {
+            "ppm": latest["ppm"],
+            "temp": latest["temp"],
+            "batch": latest["batch_count"],
+            **oee,
+        },
+    }
+
+
 @require_GET
 def machine_metrics_api(request):
     if not _customer_ok(request.user):
         return JsonResponse({"error": "Unauthorized"}, status=403)
 
     machine_id = request.GET.get("machine_id", "i6")
+    utilisation = get_current_utilisation_many([machine_id])[machine_id]
+    return JsonResponse(_machine_metrics_payload(machine_id, get_latest(machine_id), utilisation))
 
-    machines_db = {
-        "i6": {"name": "MPE i6 Tray Sealer"},
-        "i3": {"name": "MPE i3 Tray Sealer"},
-        "test": {"name": "LAB-01 Test Unit"},
-    }
-    config = machines_db.get(machine_id, {"name": "Unknown Machine"})
 
-    latest = MachineTelemetry.objects.filter(machine_id=machine_id).first()
+HISTORY_DEFAULT_POINTS = 500
+HISTORY_MAX_POINTS = 5000
+# LTTB works from at most this many source points per output point, which
+# decides whether raw rows or a rollup level is read.
+HISTORY_OVERSAMPLE = 20
 
-    if latest:
-        return JsonResponse(
-            {
-                "machine_id": machine_id,
-                "name": config["name"],
-                "status": latest.status,
-                "metrics": {
-                    "ppm": latest.ppm,
-                    "temp": latest.temp,
-                    "batch": latest.batch_count,
-                    "utilisation": 88 if latest.status == "RUNNING" else 0,
-                },
-            }
+
+def _parse_when(value: str, default):
+    if not value:
+        return default
+    dt = parse_datetime(value)
+    if dt is None:
+        raise ValueError(f"Invalid datetime: {value}")
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt, dt_timezone.utc)
+    return dt
+
+
+@require_GET
+def machine_metrics_history(request):
+    """
+    Telemetry history for one machine, downsampled on the server.
+
+    GET ?machine_id=i6&from=<ISO>&to=<ISO>&points=N (defaults: last 24h, 500)
+
+    Reads raw samples for short ranges and rollups for long ones, then
+    reduces each metric to at most N points with LTTB. Timestamps are epoch
+    milliseconds: {"series": {"ppm": [[t, v], ...], "temp": [[t, v], ...]}}.
+    """
+    if not _customer_ok(request.user):
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+
+    machine_id = (request.GET.get("machine_id") or "").strip()
+    if machine_id not in _customer_telemetry_ids(request.user):
+        return JsonResponse({"error": "Unknown machine"}, status=404)
+
+    now = timezone.now()
+    try:
+        end = _parse_when(request.GET.get("to"), now)
+        start = _parse_when(request.GET.get("from"), end - timedelta(hours=24))
+        points = int(request.GET.get("points") or HISTORY_DEFAULT_POINTS)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    if start >= end:
+        return JsonResponse({"error": "'from' must be before 'to'"}, status=400)
+    points = max(3, min(points, HISTORY_MAX_POINTS))
+
+    resolution = choose_resolution(start, end, points * HISTORY_OVERSAMPLE)
+    rows = telemetry_series(machine_id, start, end, resolution)
+
+    series = {"ppm": [], "temp": []}
+    if rows:
+        import numpy as np  # lazy import, like weasyprint in order_pdf()
+        from .downsample import lttb
+
+        ts = np.fromiter((r["ts"].timestamp() * 1000 for r in rows), dtype=np.float64, count=len(rows))
+        for key in series:
+            values = np.fromiter((r[key] for r in rows), dtype=np.float64, count=len(rows))
+            xs, ys = lttb(ts, values, points)
+            series[key] = [[int(x), round(float(y), 3)] for x, y in zip(xs, ys)]
+
+    return JsonResponse(
+        {
+            "machine_id": machine_id,
+            "from": start.isoformat(),
+            "to": end.isoformat(),
+            "resolution": resolution,
+            "source_points": len(rows),
+            "series": series,
+        }
+    )
+
+
+LIVE_DEFAULT_SECONDS = 300
+LIVE_MAX_SECONDS = 3600
+
+
+@require_GET
+def machine_metrics_live(request):
+    """
+    Recent raw samples of one machine, for the live charts.
+
+    GET ?machine_id=i6&seconds=300
+
+    Served from the shared ring buffer (core/ringbuffer.py), which holds the
+    last TELEMETRY_RING_SAMPLES samples per machine, so reading it costs no
+    query. Falls back to MachineTelemetry when the machine has nothing
+    buffered (e.g. first start of the node). Timestamps are epoch
+    milliseconds: {"series": {"ppm": [[t, v], ...], "temp": [[t, v], ...]}}.
+    """
+    if not _customer_ok(request.user):
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+
+    machine_id = (request.GET.get("machine_id") or "").strip()
+    if machine_id not in _customer_telemetry_ids(request.user):
+        return JsonResponse({"error": "Unknown machine"}, status=404)
+
+    try:
+        seconds = int(request.GET.get("seconds") or LIVE_DEFAULT_SECONDS)
+    except ValueError:
+        return JsonResponse({"error": "'seconds' must be an integer"}, status=400)
+    seconds = max(1, min(seconds, LIVE_MAX_SECONDS))
+    since = timezone.now() - timedelta(seconds=seconds)
+
+    samples = ringbuffer.recent(machine_id, since.timestamp())
+    if samples is not None and len(samples):
+        source = "ring"
+        ts = (samples["ts"] * 1000).astype("int64").tolist()
+        ppm = samples["ppm"].astype("float64").round(3).tolist()
+        temp = samples["temp"].astype("float64").round(3).tolist()
+        status = ringbuffer.status_name(int(samples["status"][-1]))
+    else:
+        source = "db"
+        rows = list(
+            MachineTelemetry.objects.filter(machine_id=machine_id, created_at__gte=since)
+            .order_by("-created_at")
+            .values_list("created_at", "ppm", "temp", "status")[: settings.TELEMETRY_RING_SAMPLES]
         )
+        rows.reverse()
+        ts = [int(r[0].timestamp() * 1000) for r in rows]
+        ppm = [round(r[1], 3) for r in rows]
+        temp = [round(r[2], 3) for r in rows]
+        status = rows[-1][3] if rows else None
 
     return JsonResponse(
         {
             "machine_id": machine_id,
-            "name": config["name"],
-            "status": "OFFLINE",
-            "metrics": {"ppm": 0, "temp": 0, "batch": 0, "utilisation": 0},
+            "source": source,
+            "points": len(ts),
+            "status": status,
+            "series": {"ppm": list(zip(ts, ppm)), "temp": list(zip(ts, temp))},
         }
     )
 
 
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+}
+EXPORT_MAX_DAYS = 92
+# Rows fetched per round trip, and per chunk of the response body.
+EXPORT_CHUNK_SIZE = 5000
+# Span read per query; one window of 1 Hz data is ~21,600 rows.
+EXPORT_WINDOW = timedelta(hours=6)
+EXPORT_COLUMNS = ("timestamp", "ppm", "temp", "batch_count", "status")
+
+
+def _export_windows(machine_id: str, start, end):
+    """
+    Rows of [start, end) read EXPORT_WINDOW at a time. Each window is read
+    in full before its rows are handed on, so no query, snapshot or
+    transaction stays open while the client downloads; a slow download
+    would otherwise hold locks that block partition pruning and the ingest
+    queued behind it. Memory is bounded by one window.
+    """
+    while start < end:
+        upper = min(start + EXPORT_WINDOW, end)
+        yield from list(iter_samples(machine_id, start, upper, chunk_size=EXPORT_CHUNK_SIZE))
+        start = upper
+
+
+def _export_chunks(machine_id: str, start, end, fmt: str):
+    """Yield the export body in chunks of EXPORT_CHUNK_SIZE rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == "csv" else None
+    if writer:
+        writer.writerow(EXPORT_COLUMNS)
+
+    count = 0
+    for created_at, ppm, temp, batch_count, status in _export_windows(machine_id, start, end):
+        if writer:
+            writer.writerow((created_at.isoformat(), ppm, temp, batch_count, status))
+        else:
+            buffer.write(
+                json.dumps(
+                    {
+                        "timestamp": created_at.isoformat(),
+                        "ppm": ppm,
+                        "temp": temp,
+                        "batch_count": batch_count,
+                        "status": status,
+                    },
+                    separators=(",", ":"),
+                )
+            )
+            buffer.write("\n")
+        count += 1
+        if count % EXPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+async def _aiter_sync(iterator):
+    """
+    Serve a sync iterator to the ASGI handler chunk by chunk. Handed a sync
+    iterator, Django's ASGI handler reads it to the end before sending
+    anything, which would hold the whole export in memory.
+    """
+    next_chunk = sync_to_async(next, thread_sensitive=True)
+    sentinel = object()
+    try:
+        while (chunk := await next_chunk(iterator, sentinel)) is not sentinel:
+            yield chunk
+    finally:
+        await sync_to_async(iterator.close, thread_sensitive=True)()
+
+
+@require_GET
+def machine_telemetry_export(request):
+    """
+    Raw telemetry for one of the customer's machines as a download.
+
+    GET ?machine_id=i6&from=<ISO>&to=<ISO>&format=csv|ndjson
+    (defaults: last 7 days, CSV; at most EXPORT_MAX_DAYS per request)
+
+    The body is streamed while the rows are read, so the first bytes go out
+    straight away and a month of 1 Hz data does not sit in memory.
+    """
+    if not _customer_ok(request.user):
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+
+    machine_id = (request.GET.get("machine_id") or "").strip()
+    if machine_id not in _customer_telemetry_ids(request.user):
+        return JsonResponse({"error": "Unknown machine"}, status=404)
+
+    fmt = (request.GET.get("format") or "csv").lower()
+    if fmt not in EXPORT_FORMATS:
+        return JsonResponse({"error": f"Unsupported format '{fmt}' (use csv or ndjson)"}, status=400)
+
+    try:
+        end = _parse_when(request.GET.get("to"), timezone.now())
+        start = _parse_when(request.GET.get("from"), end - timedelta(days=7))
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    if start >= end:
+        return JsonResponse({"error": "'from' must be before 'to'"}, status=400)
+    if end - start > timedelta(days=EXPORT_MAX_DAYS):
+        return JsonResponse({"error": f"Range is limited to {EXPORT_MAX_DAYS} days per export"}, status=400)
+
+    chunks = _export_chunks(machine_id, start, end, fmt)
+    if isinstance(request, ASGIRequest):
+        chunks = _aiter_sync(chunks)
+
+    response = StreamingHttpResponse(chunks, content_type=EXPORT_FORMATS[fmt])
+    safe_id = re.sub(r"[^A-Za-z0-9_.-]", "_", machine_id)
+    response["Content-Disposition"] = (
+        f'attachment; filename="{safe_id}_{start:%Y%m%d}-{end:%Y%m%d}.{fmt}"'
+    )
+    response["Cache-Control"] = "no-store"
+    return response
+
+
+ANOMALY_DEFAULT_DAYS = 7
+ANOMALY_DEFAULT_LIMIT = 100
+ANOMALY_MAX_LIMIT = 1000
+
+
+@require_GET
+def telemetry_anomalies(request):
+    """
+    Anomalies stored by the `detect_anomalies` command, for staff triage.
+
+    GET ?machine_id=i6&metric=ppm|temp&kind=zscore|change_point
+        &from=<ISO>&to=<ISO>&limit=N
+    (defaults: every machine, last 7 days, 100 newest)
+
+    "machines" ranks machines by their strongest anomaly in the range, so
+    the worst ones can be looked at first; "anomalies" lists the flagged
+    windows, newest first.
+    """
+    if not (request.user.is_authenticated and request.user.is_staff):
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+
+    try:
+        end = _parse_when(request.GET.get("to"), timezone.now())
+        start = _parse_when(request.GET.get("from"), end - timedelta(days=ANOMALY_DEFAULT_DAYS))
+        limit = int(request.GET.get("limit") or ANOMALY_DEFAULT_LIMIT)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    limit = max(1, min(limit, ANOMALY_MAX_LIMIT))
+
+    qs = TelemetryAnomaly.objects.filter(window_start__gte=start, window_start__lt=end)
+    machine_id = (request.GET.get("machine_id") or "").strip()
+    if machine_id:
+        qs = qs.filter(machine_id=machine_id)
+    for field, choices in (("metric", TelemetryAnomaly.METRIC_CHOICES), ("kind", TelemetryAnomaly.KIND_CHOICES)):
+        value = request.GET.get(field)
+        if value:
+            if value not in dict(choices):
+                return JsonResponse({"error": f"Unknown {field} '{value}'"}, status=400)
+            qs = qs.filter(**{field: value})
+
+    ranked = list(
+        qs.values("machine_id")
+        .annotate(anomalies=Count("id"), max_score=Max("score"), last_seen=Max("window_end"))
+        .order_by("-max_score", "machine_id")
+    )
+    names = {
+        telemetry_id: (name, customer)
+        for telemetry_id, name, customer in CustomerMachine.objects.filter(
+            telemetry_id__in=[m["machine_id"] for m in ranked]
+        ).values_list("telemetry_id", "name", "customer__username")
+    }
+    machines = [
+        {
+            "machine_id": m["machine_id"],
+            "name": names.get(m["machine_id"], (None, None))[0],
+            "customer": names.get(m["machine_id"], (None, None))[1],
+            "anomalies": m["anomalies"],
+            "max_score": m["max_score"],
+            "last_seen": m["last_seen"].isoformat(),
+        }
+        for m in ranked
+    ]
+
+    anomalies = [
+        {
+            "id": a.id,
+            "machine_id": a.machine_id,
+            "metric": a.metric,
+            "kind": a.kind,
+            "window_start": a.window_start.isoformat(),
+            "window_end": a.window_end.isoformat(),
+            "samples": a.sample_count,
+            "score": a.score,
+            "value": a.value,
+            "baseline": a.baseline,
+        }
+        for a in qs.order_by("-window_start")[:limit]
+    ]
+
+    return JsonResponse(
+        {"from": start.isoformat(), "to": end.isoformat(), "machines": machines, "anomalies": anomalies}
+    )
+
+
+# Live stream (Server-Sent Events). The connection is closed after
+# STREAM_MAX_SECONDS; EventSource reconnects on its own, which re-checks the
+# session and picks up machines added to the account in the meantime.
+STREAM_POLL_SECONDS = 1.0
+STREAM_KEEPALIVE_SECONDS = 15
+STREAM_MAX_SECONDS = 300
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+async def _machine_metrics_events(machine_ids):
+    """
+    Yield SSE messages for the given machines: a full snapshot first, then
+    only the fields that changed since the previous message for that machine.
+    Reads come from the latest-sample cache, never from the telemetry table.
+    """
+    loop = asyncio.get_running_loop()
+    started = last_sent = loop.time()
+    sent = {}
+
+    yield f"retry: {int(STREAM_POLL_SECONDS * 3000)}\n\n"
+
+    while loop.time() - started < STREAM_MAX_SECONDS:
+        latest = await sync_to_async(get_latest_many)(machine_ids)
+        utilisation = await sync_to_async(get_current_utilisation_many)(machine_ids)
+        for machine_id in machine_ids:
+            payload = _machine_metrics_payload(machine_id, latest.get(machine_id), utilisation.get(machine_id))
+            previous = sent.get(machine_id)
+            if previous is None:
+                yield _sse("snapshot", payload)
+            else:
+                changes = {"machine_id": machine_id}
+                if payload["status"] != previous["status"]:
+                    changes["status"] = payload["status"]
+                metrics = {k: v for k, v in payload["metrics"].items() if previous["metrics"].get(k) != v}
+                if metrics:
+                    changes["metrics"] = metrics
+                if len(changes) == 1:
+                    continue
+                yield _sse("metrics", changes)
+            sent[machine_id] = payload
+            last_sent = loop.time()
+
+        if loop.time() - last_sent >= STREAM_KEEPALIVE_SECONDS:
+            yield ": keep-alive\n\n"
+            last_sent = loop.time()
+
+        await asyncio.sleep(STREAM_POLL_SECONDS)
+
+
+async def machine_metrics_stream(request):
+    """
+    Server-Sent Events feed of live metrics for the customer's machines.
+
+    One long-lived connection replaces the dashboard's 1 Hz polling; auth and
+    the machine list are resolved once per connection. Serve it through the
+    ASGI entry point (myproject/asgi.py) so an open stream does not hold a
+    worker thread.
+
+    Optional ?machine_id=i6,i3 narrows the stream to some of the customer's
+    machines.
+    """
+    if request.method != "GET":
+        return JsonResponse({"error": "GET only"}, status=405)
+
+    user = await request.auser()
+    if not await sync_to_async(_customer_ok)(user):
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+
+    machine_ids = await sync_to_async(_customer_telemetry_ids)(user)
+    requested = [m.strip() for m in (request.GET.get("machine_id") or "").split(",") if m.strip()]
+    if requested:
+        machine_ids = [m for m in machine_ids if m in requested]
+
+    response = StreamingHttpResponse(_machine_metrics_events(machine_ids), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
 @csrf_exempt
 def api_import_stock(request):
     """
@@ -1036,21 +1906,23 @@ def api_import_stock(request):
         created_count = 0
         updated_count = 0
 
-        for item in products_data:
-            obj, created = ShopProduct.objects.update_or_create(
-                name=item["name"],
-                defaults={
-                    "description": item.get("description", ""),
-                    "price_gbp": item.get("price", 0.0),
-                    "stock_status": "In Stock",
-                    "is_active": True,
-                },
-            )
+        # Shop facets and the catalogue version are refreshed once, after the last product.
+        with catalogue_batch():
+            for item in products_data:
+                obj, created = ShopProduct.objects.update_or_create(
+                    name=item["name"],
+                    defaults={
+                        "description": item.get("description", ""),
+                        "price_gbp": item.get("price", 0.0),
+                        "in_stock": True,
+                        "is_active": True,
+                    },
+                )
 
-            if created:
-                created_count += 1
-            else:
-                updated_count += 1
+                if created:
+                    created_count += 1
+                else:
+                    updated_count += 1
 
         return JsonResponse({"status": "success", "created": created_count, "updated": updated_count})
 
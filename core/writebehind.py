@@ -0,0 +1,179 @@
+"""
+Write-behind buffer behind the async ingest endpoint (/api/ingest/async/).
+
+The view validates a request, offers the rows to a bounded in-process
+queue and answers 202 straight away; a single flusher thread drains the
+queue every TELEMETRY_WRITE_BEHIND_FLUSH_MS milliseconds, or as soon as
+TELEMETRY_WRITE_BEHIND_FLUSH_ROWS rows are waiting, into one bulk_create
+(telemetry.insert_rows).
+Request latency therefore no longer includes a database commit.
+
+The flusher is a thread rather than an asyncio task so it outlives the
+per-request event loop Django uses for async views under WSGI (runserver),
+and because the ORM is synchronous anyway. A full queue is refused as a
+whole (the view answers 503) instead of blocking the event loop. A write
+that fails because the database is unreachable (OperationalError,
+InterfaceError) keeps its batch and retries with backoff, so while the
+database is down the queue fills up and clients see 503s rather than
+losing data. Any other failure would only repeat: the batch is written
+again row by row and the rows that still fail are logged and dropped, so
+one bad row cannot stall the queue.
+
+shutdown() stops intake and flushes whatever is queued. asgi.py calls it on
+the ASGI lifespan shutdown event; it is also registered with atexit.
+Rows accepted but not yet flushed are lost if the process is killed.
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, close_old_connections, connection
+
+from .telemetry import after_ingest, insert_rows
+
+logger = logging.getLogger(__name__)
+
+RETRY_BACKOFF_MAX = 30.0
+# Write attempts per batch once shutdown has begun, before giving up on it.
+SHUTDOWN_ATTEMPTS = 3
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+
+class WriteBehindBuffer:
+    def __init__(self, max_rows: int, flush_rows: int, flush_interval: float):
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_rows)
+        self._offer_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.written = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="telemetry-write-behind", daemon=True)
+            self._thread.start()
+
+    def offer(self, rows: list) -> bool:
+        """
+        Queue all of `rows` or none of them. Returns False when the queue
+        has no room (or the buffer is shutting down); never blocks.
+        """
+        if self._stopping.is_set():
+            return False
+        self.start()
+        with self._offer_lock:
+            # Only offer() adds to the queue, under this lock, so the check cannot go stale.
+            if self._queue.qsize() + len(rows) > self._queue.maxsize:
+                return False
+            for row in rows:
+                self._queue.put_nowait(row)
+        return True
+
+    def shutdown(self, timeout: float = 30.0) -> None:
+        """Refuse new rows, flush the queue and wait (up to `timeout` s) for the flusher."""
+        self._stopping.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+            if thread.is_alive():
+                logger.error("Write-behind flusher did not finish; %d telemetry row(s) still queued", len(self))
+
+    def _take(self) -> list:
+        """Wait for a first row, then gather more until flush_rows or flush_interval has passed."""
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.flush_rows:
+            remaining = 0 if self._stopping.is_set() else deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _insert(self, rows: list) -> list:
+        """insert_rows() with retries for transient errors. Returns the rows written."""
+        attempts = 0
+        while True:
+            attempts += 1
+            close_old_connections()
+            try:
+                return insert_rows(rows)
+            except TRANSIENT_ERRORS as e:
+                logger.exception("Write-behind flush of %d telemetry row(s) failed: %s", len(rows), e)
+                connection.close()
+                if self._stopping.is_set() and attempts >= SHUTDOWN_ATTEMPTS:
+                    self.dropped += len(rows)
+                    logger.error("Dropping %d telemetry row(s) at shutdown", len(rows))
+                    return []
+                time.sleep(min(RETRY_BACKOFF_MAX, 0.5 * 2 ** attempts))
+            except Exception as e:
+                if len(rows) == 1:
+                    row = rows[0]
+                    self.dropped += 1
+                    logger.error(
+                        "Dropping telemetry row %s @ %s, it cannot be stored: %s", row.machine_id, row.created_at, e
+                    )
+                    return []
+                logger.warning(
+                    "Write-behind flush of %d telemetry row(s) failed (%s); writing them one by one", len(rows), e
+                )
+                return [written for row in rows for written in self._insert([row])]
+
+    def _write(self, rows: list) -> None:
+        written = self._insert(rows)
+        self.written += len(written)
+        try:
+            after_ingest(written)
+        except Exception as e:
+            # The rows are stored; losing their cache, ring and alert updates must not stop the flusher.
+            logger.exception("After-ingest processing of %d telemetry row(s) failed: %s", len(written), e)
+
+    def _run(self) -> None:
+        try:
+            while True:
+                batch = self._take()
+                if batch:
+                    self._write(batch)
+                elif self._stopping.is_set():
+                    return
+        finally:
+            connection.close()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer() -> WriteBehindBuffer:
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = WriteBehindBuffer(
+                    max_rows=settings.TELEMETRY_WRITE_BEHIND_MAX_ROWS,
+                    flush_rows=settings.TELEMETRY_WRITE_BEHIND_FLUSH_ROWS,
+                    flush_interval=settings.TELEMETRY_WRITE_BEHIND_FLUSH_MS / 1000,
+                )
+                atexit.register(_buffer.shutdown)
+    return _buffer
+
+
+def shutdown() -> None:
+    """Flush and stop the process-wide buffer, if one was created."""
+    if _buffer is not None:
+        _buffer.shutdown()
@@ -3,14 +3,40 @@ ASGI config for myproject project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Production serves this through gunicorn's uvicorn worker (see Procfile) so
+long-lived responses such as the live metrics stream
+(/api/machine-metrics/stream/) don't each hold a worker thread.
+
+Django's handler only speaks HTTP, so ``application`` answers the ASGI
+lifespan protocol itself: on shutdown it flushes the async ingest queue
+(core/writebehind.py) before the worker exits.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 """
 
+import asyncio
 import os
 
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myproject.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from core import writebehind  # noqa: E402  (needs the app registry loaded above)
+
+
+async def application(scope, receive, send):
+    if scope["type"] != "lifespan":
+        await django_application(scope, receive, send)
+        return
+
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await asyncio.to_thread(writebehind.shutdown)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -6,6 +6,7 @@ Generated by 'django-admin startproject' using Django 5.0.1.
 
 from pathlib import Path
 import os
+import tempfile
 import dj_database_url
 
 # -----------------------------------------------------------------------------
@@ -136,13 +137,100 @@ WSGI_APPLICATION = "myproject.wsgi.application"
 
 # Railway: DATABASE_URL (Postgres)
 # Local fallback: SQLite
+# conn_max_age stays 0: under the ASGI server (Procfile) sync code runs on
+# executor threads that come and go, so persistent connections would be
+# left open on threads that never serve another request and pile up until
+# Postgres runs out of slots.
 DATABASES = {
     "default": dj_database_url.config(
         default=f"sqlite:///{BASE_DIR / 'db.sqlite3'}",
-        conn_max_age=600,
+        conn_max_age=0,
     )
 }
 
+# -----------------------------------------------------------------------------
+# CACHE
+# -----------------------------------------------------------------------------
+
+# Local-memory cache by default (one per process). To share cached values
+# between gunicorn workers, point these at a shared backend, e.g.
+# DJANGO_CACHE_BACKEND=django.core.cache.backends.filebased.FileBasedCache
+# DJANGO_CACHE_LOCATION=/tmp/mpe-cache
+# Pre-serialised shop pages (core/catalogue.py) get their own "catalogue"
+# cache, so a burst of distinct shop queries can only evict other shop
+# pages, never telemetry or session data (DJANGO_CATALOGUE_CACHE_LOCATION
+# must differ from DJANGO_CACHE_LOCATION).
+CACHES = {
+    "default": {
+        "BACKEND": os.getenv("DJANGO_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.getenv("DJANGO_CACHE_LOCATION", "mpe-default"),
+    },
+    "catalogue": {
+        "BACKEND": os.getenv("DJANGO_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.getenv("DJANGO_CATALOGUE_CACHE_LOCATION", "mpe-catalogue"),
+        "OPTIONS": {"MAX_ENTRIES": int(os.getenv("CATALOGUE_CACHE_MAX_ENTRIES", "1000"))},
+    },
+}
+
+# -----------------------------------------------------------------------------
+# SHOP CATALOGUE
+# -----------------------------------------------------------------------------
+
+# Seconds each process keeps the catalogue version (core/catalogue.py). Saves
+# refresh it straight away in a shared cache; the TTL only bounds how long
+# another process can serve the previous version when the cache is not shared.
+CATALOGUE_VERSION_CACHE_SECONDS = int(os.getenv("CATALOGUE_VERSION_CACHE_SECONDS", "5"))
+
+# Seconds a pre-serialised product feed page is kept. Pages are keyed by the
+# catalogue version, so this only decides when unused ones are evicted.
+CATALOGUE_CACHE_SECONDS = int(os.getenv("CATALOGUE_CACHE_SECONDS", "86400"))
+
+# -----------------------------------------------------------------------------
+# MACHINE TELEMETRY
+# -----------------------------------------------------------------------------
+
+# Seconds the latest sample per machine is kept in the cache. Ingest refreshes
+# the entry on every write; the TTL only bounds how stale another process's
+# copy can be when the cache is not shared between workers.
+TELEMETRY_LATEST_CACHE_TTL = int(os.getenv("TELEMETRY_LATEST_CACHE_TTL", "5"))
+
+# Evaluate per-machine alert rules (core/alerts.py) on every ingest.
+TELEMETRY_ALERTS_ENABLED = os.getenv("TELEMETRY_ALERTS_ENABLED", "1").lower() in ("1", "true", "yes", "on")
+
+# Shift start times for utilisation/OEE (core/utilisation.py), e.g.
+# "Early=06:00,Late=14:00,Night=22:00"; each shift ends where the next starts.
+# Empty means per-day figures only. Times are in TELEMETRY_SHIFT_TIMEZONE
+# (defaults to TIME_ZONE).
+TELEMETRY_SHIFTS = os.getenv("TELEMETRY_SHIFTS", "Early=06:00,Late=14:00,Night=22:00")
+TELEMETRY_SHIFT_TIMEZONE = os.getenv("TELEMETRY_SHIFT_TIMEZONE", "")
+
+# Ring buffer of recent samples per machine (core/ringbuffer.py), shared by
+# all workers on a node through a memory-mapped file; the live chart API
+# reads it instead of the database. SAMPLES per machine (600 = 10 minutes
+# at 1 Hz), SLOTS = machines (registered CustomerMachines only; idle slots
+# are reused when full). An empty path disables it.
+TELEMETRY_RING_PATH = os.getenv(
+    "TELEMETRY_RING_PATH", os.path.join(tempfile.gettempdir(), "mpe-telemetry-ring.dat")
+)
+TELEMETRY_RING_SLOTS = int(os.getenv("TELEMETRY_RING_SLOTS", "256"))
+TELEMETRY_RING_SAMPLES = int(os.getenv("TELEMETRY_RING_SAMPLES", "600"))
+
+# Per-machine ingest keys (MachineApiKey, core/ingest_auth.py). Signed
+# requests are always verified; with REQUIRE on (the default), unsigned ones
+# get 401. Set it to 0 only while handing keys out to existing clients (see
+# the rollout notes in core/ingest_auth.py); `manage.py check` warns while
+# it is off. Keys are cached per process for CACHE_SECONDS, which bounds how
+# long a revoked key keeps working in other worker processes.
+TELEMETRY_REQUIRE_API_KEY = os.getenv("TELEMETRY_REQUIRE_API_KEY", "1").lower() in ("1", "true", "yes", "on")
+TELEMETRY_API_KEY_CACHE_SECONDS = int(os.getenv("TELEMETRY_API_KEY_CACHE_SECONDS", "60"))
+
+# Async ingest (/api/ingest/async/, core/writebehind.py): rows queued per
+# process before requests get 503, and how often / at how many queued rows
+# the queue is flushed to the database.
+TELEMETRY_WRITE_BEHIND_MAX_ROWS = int(os.getenv("TELEMETRY_WRITE_BEHIND_MAX_ROWS", "50000"))
+TELEMETRY_WRITE_BEHIND_FLUSH_MS = int(os.getenv("TELEMETRY_WRITE_BEHIND_FLUSH_MS", "200"))
+TELEMETRY_WRITE_BEHIND_FLUSH_ROWS = int(os.getenv("TELEMETRY_WRITE_BEHIND_FLUSH_ROWS", "2000"))
+
 # -----------------------------------------------------------------------------
 # PASSWORD VALIDATION
 # -----------------------------------------------------------------------------